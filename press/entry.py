@@ -86,7 +86,7 @@ def apply(namespace):
             raise
         error = True
     finally:
-        if orchestrator.layout.committed:
+        if not orchestrator.has_layout or orchestrator.layout.committed:
             orchestrator.teardown()
 
         del logging.getLogger('press').handlers[:]
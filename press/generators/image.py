@@ -1,6 +1,12 @@
 import logging
+
+from size import Size
+
 from press import exceptions
-from press.helpers.imagefile import ImageFile
+from press.helpers.blockimage import SPARSE_POLICIES
+from press.helpers.image_cache import ImageCache
+from press.helpers.imagefile import BlockImageFile, ImageFile
+from press.helpers.udev import UDevHelper
 from press.hooks.hooks import run_hooks
 
 log = logging.getLogger(__name__)
@@ -8,9 +14,54 @@ log = logging.getLogger(__name__)
 _default_chunk_size = 1048576
 _default_image_format = 'tgz'
 _default_hash_method = 'sha1'
+_default_connections = 1
+_default_segment_size = 67108864
+_default_retries = 3
+_default_retry_backoff = 2
+_default_timeout = 60
+_default_cache_path = '/var/cache/press/images'
+_default_verify_policy = 'before_extract'
+_verify_policies = ('before_extract', 'after_extract')
+_default_block_writers = 4
+_default_block_size = 4194304
+_default_sparse = 'zeroout'
+
+
+def image_cache_generator(cache_config):
+    """
+    :param cache_config: the image.cache configuration section
+    :return: ImageCache
+    """
+    return ImageCache(
+        path=cache_config.get('path', _default_cache_path),
+        max_size=Size(cache_config.get('size', 0)).bytes,
+        device=cache_config.get('device'))
+
+
+def is_block_image(image_config):
+    return image_config.get('format') in BlockImageFile.formats
 
 
-def imagefile_generator(image_config, target, proxy_info=None):
+def block_device_from_config(device_ref, reserved_devices=None):
+    """
+    :param device_ref: a device path, or 'first' for the first storage device
+    :param reserved_devices: devices which must not be overwritten
+    """
+    if device_ref != 'first':
+        return device_ref
+    udev = UDevHelper()
+    reserved = [udev.get_disk_devname(d) for d in reserved_devices or []]
+    for disk in udev.discover_valid_storage_devices():
+        if disk['DEVNAME'] not in reserved:
+            return disk['DEVNAME']
+    raise exceptions.GeneratorError('Could not find a device for the image')
+
+
+def imagefile_generator(image_config,
+                        target,
+                        proxy_info=None,
+                        cache=None,
+                        reserved_devices=None):
     checksum_details = image_config.get('checksum')
     if checksum_details:
         image_hash = checksum_details.get('hash')
@@ -22,12 +73,42 @@ def imagefile_generator(image_config, target, proxy_info=None):
         image_hash = None
         hash_method = None
 
-    dl = ImageFile(
+    verify_policy = image_config.get('verify_policy', _default_verify_policy)
+    if verify_policy not in _verify_policies:
+        raise exceptions.GeneratorError(
+            'verify_policy must be one of: %s' % ', '.join(_verify_policies))
+
+    options = dict(
         url=image_config['url'],
-        target=target,
         hash_method=hash_method,
         expected_hash=image_hash,
+        download_directory=image_config.get('download_directory'),
         buffer_size=image_config.get('chunk_size', _default_chunk_size),
-        proxy=proxy_info)
+        proxy=proxy_info,
+        stream=image_config.get('stream', False),
+        connections=image_config.get('connections', _default_connections),
+        segment_size=Size(
+            image_config.get('segment_size', _default_segment_size)).bytes,
+        retries=image_config.get('retries', _default_retries),
+        retry_backoff=image_config.get('retry_backoff', _default_retry_backoff),
+        timeout=image_config.get('timeout', _default_timeout),
+        cache=cache,
+        verify_after_extract=verify_policy == 'after_extract')
+
+    if is_block_image(image_config):
+        sparse = image_config.get('sparse', _default_sparse)
+        if sparse not in SPARSE_POLICIES:
+            raise exceptions.GeneratorError(
+                'sparse must be one of: %s' % ', '.join(SPARSE_POLICIES))
+        return BlockImageFile(
+            device=block_device_from_config(
+                image_config.get('device', 'first'), reserved_devices),
+            image_format=image_config['format'],
+            writers=image_config.get('writers', _default_block_writers),
+            block_size=Size(
+                image_config.get('block_size', _default_block_size)).bytes,
+            sparse=sparse,
+            discard=image_config.get('discard', False),
+            **options)
 
-    return dl
+    return ImageFile(target=target, **options)
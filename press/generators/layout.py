@@ -7,13 +7,18 @@ from press.layout import (
     Partition,
 )
 from press.exceptions import (GeneratorError)
-from press.layout.lvm import (PhysicalVolume, LogicalVolume)
+from press.layout.lvm import (PhysicalVolume, LogicalVolume, ThinPool,
+                              CachePool, CACHE_MODES,
+                              CACHE_POOL_MINIMUM_CHUNK_SIZE)
 from press.layout.filesystems.extended import (EXT2, EXT3, EXT4)
 from press.layout.filesystems.swap import (SWAP)
 from press.layout.filesystems.xfs import XFS
 from press.layout.filesystems.fat import FAT32, EFI
 from press.layout.filesystems.ntfs import NTFS
-from press.layout.raid import MDRaid
+from press.layout.filesystems.btrfs import Btrfs, PROFILES
+from press.layout.filesystems import WORKLOADS, INSTALL_MOUNT_PROFILES
+from press.layout.disk import AUTO
+from press.layout.raid import MDRaid, parse_level, raid10_copies
 from press.models.lvm import VolumeGroupModel
 from press.models.partition import PartitionTableModel
 
@@ -31,11 +36,25 @@ __pv_linker__ = dict()
 __partition_linker__ = dict()
 
 fs_selector = dict(
-    ext2=EXT2, ext3=EXT3, ext4=EXT4, swap=SWAP, xfs=XFS, efi=EFI, fat32=FAT32, ntfs=NTFS)
+    ext2=EXT2, ext3=EXT3, ext4=EXT4, swap=SWAP, xfs=XFS, efi=EFI, fat32=FAT32, ntfs=NTFS,
+    btrfs=Btrfs)
 
 default_use_fibre_channel = False
 default_loop_only = False
 default_clear_device_mapper = True
+default_udev_timeout = 30
+default_batch_parted = False
+default_partition_engine = 'parted'
+partition_engines = ('parted', 'native')
+default_parallel_disks = False
+default_max_workers = 0
+default_concurrent_apply = False
+default_discovery = 'sysfs'
+discovery_methods = ('sysfs', 'parted')
+default_discovery_workers = 1
+default_fast_format = False
+default_discarded = False
+default_install_mount_profile = 'default'
 
 
 def has_logical(partitions):
@@ -80,18 +99,76 @@ def generate_size(size):
     return size
 
 
+def parse_workload(name, workload):
+    if workload is not None and workload not in WORKLOADS:
+        raise GeneratorError('%s: workload must be one of %s' %
+                             (name, ', '.join(WORKLOADS)))
+    return workload
+
+
+def parse_install_mount_profile(name, profile):
+    if profile is not None and profile not in INSTALL_MOUNT_PROFILES:
+        raise GeneratorError('%s: install_mount_profile must be one of %s' %
+                             (name, ', '.join(INSTALL_MOUNT_PROFILES)))
+    return profile
+
+
 def generate_file_system(fs_dict):
     fs_type = fs_dict.get('type', 'undefined')
 
     fs_class = fs_selector.get(fs_type)
     if not fs_class:
         raise GeneratorError('%s type is not supported!' % fs_type)
+    parse_workload(fs_type, fs_dict.get('workload'))
+    parse_install_mount_profile(fs_type, fs_dict.get('install_mount_profile'))
+    if fs_class is Btrfs:
+        validate_btrfs(fs_dict)
 
     fs_object = fs_class(**fs_dict)
 
     return fs_object
 
 
+def validate_btrfs(fs_dict):
+    device_count = 1 + len(fs_dict.get('devices', []))
+    for option in ('data_profile', 'metadata_profile'):
+        profile = fs_dict.get(option)
+        if profile is None:
+            continue
+        if profile not in PROFILES:
+            raise GeneratorError('btrfs: %s must be one of %s' %
+                                 (option, ', '.join(sorted(PROFILES))))
+        if device_count < PROFILES[profile]:
+            raise GeneratorError('btrfs: %s requires %d devices' %
+                                 (profile, PROFILES[profile]))
+    for subvolume in fs_dict.get('subvolumes', []):
+        if not subvolume.get('name'):
+            raise GeneratorError('btrfs: subvolumes need a name')
+
+
+def link_btrfs_devices(layout):
+    """Multi-device btrfs file systems reference partitions by name, which
+    may belong to disks generated after them
+    """
+    for obj in layout.software_raid_objects + layout.logical_volumes:
+        if isinstance(obj.file_system, Btrfs) and \
+                obj.file_system.device_names:
+            raise GeneratorError('btrfs: only file systems on partitions can '
+                                 'span several devices')
+    for partition in layout.partitions:
+        file_system = partition.file_system
+        if not isinstance(file_system, Btrfs):
+            continue
+        for name in file_system.device_names:
+            if name not in __partition_linker__:
+                raise GeneratorError('btrfs: %s is not a partition' % name)
+            device = __partition_linker__[name]
+            if device.file_system:
+                raise GeneratorError('btrfs: %s already has a file system' %
+                                     name)
+            file_system.devices.append(device)
+
+
 def generate_partition(type_or_name, partition_dict):
     fs_dict = partition_dict.get('file_system')
 
@@ -195,6 +272,20 @@ def generate_partitions(table_type, partition_dicts):
         raise GeneratorError('Table type is invalid: %s' % table_type)
 
 
+def parse_alignment(name, value):
+    """
+    :param value: a size, or auto to let the disk topology decide
+    :return: bytes, or auto
+    """
+    if value == AUTO:
+        return value
+    try:
+        return Size(value).bytes
+    except ValueError:
+        raise GeneratorError('%s must be a size or %s: %s' % (name, AUTO,
+                                                              value))
+
+
 def generate_partition_table_model(partition_table_dict,
                                    default_partition_start, default_alignment):
     """
@@ -219,9 +310,13 @@ def generate_partition_table_model(partition_table_dict,
     pm = PartitionTableModel(
         table_type=table_type,
         disk=partition_table_dict['disk'],
-        partition_start=partition_table_dict.get('partition_start',
-                                                 default_partition_start),
-        alignment=partition_table_dict.get('alignment', default_alignment))
+        partition_start=parse_alignment(
+            'partition_start',
+            partition_table_dict.get('partition_start',
+                                     default_partition_start)),
+        alignment=parse_alignment(
+            'alignment',
+            partition_table_dict.get('alignment', default_alignment)))
 
     partition_dicts = partition_table_dict.get('partitions')
     if partition_dicts:
@@ -230,6 +325,101 @@ def generate_partition_table_model(partition_table_dict,
     return pm
 
 
+def get_physical_volumes(name, pv_names, pvs_by_name):
+    physical_volumes = list()
+    for pv in pv_names:
+        if pv not in pvs_by_name:
+            raise GeneratorError('%s: %s is not in the volume group' %
+                                 (name, pv))
+        physical_volumes.append(pvs_by_name[pv])
+    return physical_volumes
+
+
+def generate_cache_pool(name, cache_dict, pvs_by_name):
+    """
+    :param name: the name of the cached logical volume
+    :param cache_dict: size, physical_volumes, mode, chunk_size, metadata_size
+    :return: CachePool
+    """
+    if not cache_dict.get('physical_volumes'):
+        raise GeneratorError('%s: the cache pool needs physical_volumes' %
+                             name)
+    physical_volumes = get_physical_volumes(
+        name, cache_dict['physical_volumes'], pvs_by_name)
+    mode = cache_dict.get('mode', 'writethrough')
+    if mode not in CACHE_MODES:
+        raise GeneratorError('%s: cache mode must be one of %s' %
+                             (name, ', '.join(CACHE_MODES)))
+    chunk_size = cache_dict.get('chunk_size')
+    if chunk_size is not None:
+        chunk_size = Size(chunk_size).bytes
+        if not chunk_size or chunk_size % CACHE_POOL_MINIMUM_CHUNK_SIZE:
+            raise GeneratorError('%s: cache chunk_size must be a multiple of '
+                                 '32KiB' % name)
+    metadata_size = cache_dict.get('metadata_size')
+    return CachePool(generate_size(cache_dict['size']),
+                     physical_volumes,
+                     mode=mode,
+                     chunk_size=chunk_size,
+                     metadata_size=metadata_size and Size(
+                         metadata_size).bytes,
+                     name=cache_dict.get('name'))
+
+
+def generate_logical_volume(lv_dict, pvs_by_name, **kwargs):
+    """
+    :param lv_dict: a logical volume, striped volume, cached volume, thin
+        pool or thin volume definition
+    :param pvs_by_name: PhysicalVolume objects of the volume group, by name
+    :return: LogicalVolume or ThinPool
+    """
+    name = lv_dict['name']
+    physical_volumes = None
+    if lv_dict.get('physical_volumes'):
+        physical_volumes = get_physical_volumes(
+            name, lv_dict['physical_volumes'], pvs_by_name)
+
+    stripes = lv_dict.get('stripes')
+    stripe_size = lv_dict.get('stripe_size')
+    if stripe_size is not None:
+        stripe_size = Size(stripe_size).bytes
+        if stripe_size < 4096 or stripe_size & (stripe_size - 1):
+            raise GeneratorError('%s: stripe_size must be a power of two, '
+                                 'at least 4KiB' % name)
+
+    pool_name = lv_dict.get('pool')
+    if pool_name and (stripes or physical_volumes):
+        raise GeneratorError('%s: thin volumes allocate from their pool, '
+                             'they cannot be striped' % name)
+
+    cache = None
+    if lv_dict.get('cache'):
+        if pool_name or lv_dict.get('thin_pool'):
+            raise GeneratorError('%s: thin pools and thin volumes cannot be '
+                                 'cached' % name)
+        cache = generate_cache_pool(name, lv_dict['cache'], pvs_by_name)
+
+    kwargs.update(stripes=stripes,
+                  stripe_size=stripe_size,
+                  physical_volumes=physical_volumes,
+                  pool_name=pool_name,
+                  cache=cache)
+    size = generate_size(lv_dict['size'])
+    if lv_dict.get('thin_pool'):
+        if kwargs.get('file_system'):
+            raise GeneratorError('%s: thin pools cannot hold a file system, '
+                                 'thin volumes do' % name)
+        chunk_size = lv_dict.get('chunk_size')
+        metadata_size = lv_dict.get('metadata_size')
+        return ThinPool(name, size,
+                        chunk_size=chunk_size and Size(chunk_size).bytes,
+                        metadata_size=metadata_size and Size(
+                            metadata_size).bytes,
+                        zero=lv_dict.get('zero'),
+                        **kwargs)
+    return LogicalVolume(name, size, **kwargs)
+
+
 def generate_volume_group_models(volume_group_dict, default_pe_size):
     """
     We use __pv_linker__ to reference partition objects by name
@@ -243,16 +433,20 @@ def generate_volume_group_models(volume_group_dict, default_pe_size):
     vgs = list()
     for vg in volume_group_dict:
         pvs = list()
+        pvs_by_name = dict()
         if not vg.get('physical_volumes'):
             raise GeneratorError('No physical volumes are defined')
         for pv in vg.get('physical_volumes'):
             ref = __pv_linker__.get(pv)
             if not ref:
                 raise GeneratorError('invalid ref: %s' % pv)
-            pvs.append(PhysicalVolume(ref))
+            pvs_by_name[pv] = PhysicalVolume(ref)
+            pvs.append(pvs_by_name[pv])
         vgm = VolumeGroupModel(vg['name'], pvs, pe_size=default_pe_size)
         lv_dicts = vg.get('logical_volumes')
-        lv_dicts.sort(key=lambda s: (s.get('mount_point', '')).count('/'))
+        # thin pools are allocated before the volumes they hold
+        lv_dicts.sort(key=lambda s: (not s.get('thin_pool', False),
+                                     (s.get('mount_point', '')).count('/')))
         lvs = list()
         if lv_dicts:
             for lv in lv_dicts:
@@ -264,25 +458,44 @@ def generate_volume_group_models(volume_group_dict, default_pe_size):
 
                 fsck_option = fsck_pass(fs, lv, mount_point)
                 lvs.append(
-                    LogicalVolume(
-                        name=lv['name'],
-                        size_or_percent=generate_size(lv['size']),
-                        file_system=fs,
-                        mount_point=mount_point,
-                        fsck_option=fsck_option))
+                    generate_logical_volume(lv, pvs_by_name,
+                                            file_system=fs,
+                                            mount_point=mount_point,
+                                            fsck_option=fsck_option))
             vgm.add_logical_volumes(lvs)
         vgs.append(vgm)
     return vgs
 
 
-def generate_layout_stub(layout_config, parted_path):
+def generate_layout_stub(layout_config, parted_path, reserved_devices=None):
     LOG.debug('Using parted at: %s' % parted_path)
+    partition_engine = layout_config.get('partition_engine',
+                                         default_partition_engine)
+    if partition_engine not in partition_engines:
+        raise GeneratorError('partition_engine must be one of: %s' %
+                             ', '.join(partition_engines))
+    discovery = layout_config.get('discovery', default_discovery)
+    if discovery not in discovery_methods:
+        raise GeneratorError('discovery must be one of: %s' %
+                             ', '.join(discovery_methods))
     return Layout(
         use_fibre_channel=layout_config.get('use_fibre_channel',
                                             default_use_fibre_channel),
         loop_only=layout_config.get('loop_only', default_loop_only),
         parted_path=parted_path,
-        clear_dm=layout_config.get('clear_device_mapper', default_clear_device_mapper)
+        clear_dm=layout_config.get('clear_device_mapper', default_clear_device_mapper),
+        reserved_devices=reserved_devices,
+        udev_timeout=layout_config.get('udev_timeout', default_udev_timeout),
+        batch_parted=layout_config.get('batch_parted', default_batch_parted),
+        partition_engine=partition_engine,
+        parallel_disks=layout_config.get('parallel_disks',
+                                         default_parallel_disks),
+        max_workers=layout_config.get('max_workers', default_max_workers),
+        concurrent_apply=layout_config.get('concurrent_apply',
+                                           default_concurrent_apply),
+        discovery=discovery,
+        discovery_workers=layout_config.get('discovery_workers',
+                                            default_discovery_workers)
     )
 
 
@@ -400,15 +613,45 @@ def generate_software_raid(raid_config):
         partitions = list()
         for part_name in raid['partitions']:
             partitions.append(__partition_linker__[part_name])
+        spares = list()
+        for part_name in raid.get('spares', list()):
+            spares.append(__partition_linker__[part_name])
+        try:
+            level = parse_level(raid['level'])
+            if level == 10:
+                raid10_copies(raid.get('layout'))
+        except ValueError as e:
+            raise GeneratorError('%s: %s' % (raid['name'], e))
+        chunk_size = raid.get('chunk_size')
+        if chunk_size is not None:
+            chunk_size = Size(chunk_size).bytes
+            if chunk_size < 4096 or chunk_size & (chunk_size - 1):
+                raise GeneratorError('%s: chunk_size must be a power of two, '
+                                     'at least 4KiB' % raid['name'])
+        bitmap = raid.get('bitmap')
+        if bitmap not in (None, 'internal', 'none'):
+            raise GeneratorError('%s: bitmap must be internal or none' %
+                                 raid['name'])
+        resync_speed_limit = raid.get('resync_speed_limit')
+        if resync_speed_limit is not None:
+            resync_speed_limit = Size(resync_speed_limit).bytes // 1024
+            if resync_speed_limit < 1:
+                raise GeneratorError('%s: resync_speed_limit is too low' %
+                                     raid['name'])
         mdraid = MDRaid(
             devname=raid['name'],
-            level=raid['level'],
+            level=level,
             members=partitions,
-            spare_members=None,  # We might add support for this later
+            spare_members=spares,
             file_system=fs_object,
             fsck_option=fsck_option,
             pv_name=raid.get('pv'),
-            mount_point=raid.get('mount_point'))
+            mount_point=raid.get('mount_point'),
+            chunk_size=chunk_size,
+            assume_clean=raid.get('assume_clean', False),
+            bitmap=bitmap,
+            resync_speed_limit=resync_speed_limit,
+            layout=raid.get('layout'))
         raid_objects.append(mdraid)
 
         if mdraid.pv_name:
@@ -418,6 +661,36 @@ def generate_software_raid(raid_config):
     return raid_objects
 
 
+def set_format_profile(layout, layout_config):
+    """Apply the layout wide fast_format, workload and discarded options to
+    the file systems which do not set them
+    """
+    fast_format = layout_config.get('fast_format', default_fast_format)
+    workload = parse_workload('layout', layout_config.get('workload'))
+    discarded = layout_config.get('discarded', default_discarded)
+    for obj in layout.partitions + layout.software_raid_objects + \
+            layout.logical_volumes:
+        if not obj.file_system:
+            continue
+        # unprovisioned blocks of a thin volume read zeroes
+        obj.file_system.set_format_profile(
+            fast_format, workload,
+            discarded or bool(getattr(obj, 'pool', None)))
+
+
+def set_install_mount_profile(layout, layout_config):
+    """Apply the layout wide install_mount_profile to the file systems which
+    do not set it
+    """
+    profile = parse_install_mount_profile(
+        'layout', layout_config.get('install_mount_profile',
+                                    default_install_mount_profile))
+    for obj in layout.partitions + layout.software_raid_objects + \
+            layout.logical_volumes:
+        if obj.file_system:
+            obj.file_system.set_install_mount_profile(profile)
+
+
 def clear_linkers():
     __pv_linker__.clear()
     __partition_linker__.clear()
@@ -427,10 +700,11 @@ def layout_from_config(layout_config,
                        parted_path='parted',
                        partition_start=1048576,
                        alignment=1048576,
-                       pe_size='4MiB'):
+                       pe_size='4MiB',
+                       reserved_devices=None):
     LOG.info('Generating Layout')
     clear_linkers()  # Long running processes will leave these behind
-    layout = generate_layout_stub(layout_config, parted_path)
+    layout = generate_layout_stub(layout_config, parted_path, reserved_devices)
     partition_tables = layout_config.get('partition_tables')
     if not partition_tables:
         raise GeneratorError('No partition tables have been defined')
@@ -454,4 +728,8 @@ def layout_from_config(layout_config,
         for vg in vg_objects:
             layout.add_volume_group_from_model(vg)
 
+    link_btrfs_devices(layout)
+    set_format_profile(layout, layout_config)
+    set_install_mount_profile(layout, layout_config)
+
     return layout
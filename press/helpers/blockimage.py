@@ -0,0 +1,360 @@
+"""
+Block image deployment
+
+Raw and qcow2 images are written straight to a block device. Reading is done
+sequentially by a single producer (a raw stream, or qcow2 clusters in guest
+order), writing by a pool of threads issuing pwrite at the image offset.
+Runs of zeroes are not written, depending on the sparse policy they are
+either zeroed out by the device (BLKZEROOUT) or skipped altogether.
+"""
+import errno
+import fcntl
+import logging
+import os
+import struct
+import threading
+import zlib
+
+import six
+# noinspection PyUnresolvedReferences
+from six.moves import queue
+
+from press.helpers.cli import run
+
+log = logging.getLogger(__name__)
+
+BLKZEROOUT = 0x127f
+
+SPARSE_ZEROOUT = 'zeroout'
+SPARSE_SKIP = 'skip'
+SPARSE_WRITE = 'write'
+SPARSE_POLICIES = (SPARSE_ZEROOUT, SPARSE_SKIP, SPARSE_WRITE)
+
+QCOW2_MAGIC = b'QFI\xfb'
+QCOW2_OFFSET_MASK = 0x00fffffffffffe00
+QCOW2_COMPRESSED = 1 << 62
+QCOW2_ZERO = 1
+
+
+class BlockImageException(Exception):
+    pass
+
+
+def is_qcow2(path):
+    with open(path, 'rb') as fp:
+        return fp.read(4) == QCOW2_MAGIC
+
+
+def iter_raw(chunks, block_size):
+    """
+    Re-chunk a byte stream into (offset, data) blocks of block_size
+
+    :param chunks: an iterable of bytes, of any size
+    """
+    offset = 0
+    pending = bytearray()
+    for chunk in chunks:
+        pending += chunk
+        while len(pending) >= block_size:
+            yield offset, bytes(pending[:block_size])
+            del pending[:block_size]
+            offset += block_size
+    if pending:
+        yield offset, bytes(pending)
+
+
+def coalesce(blocks, block_size):
+    """
+    Merge contiguous (offset, data) blocks into blocks of up to block_size
+    """
+    start = length = 0
+    pending = list()
+    for offset, data in blocks:
+        if pending and (offset != start + length or
+                        length + len(data) > block_size):
+            yield start, b''.join(pending)
+            pending = list()
+        if not pending:
+            start, length = offset, 0
+        pending.append(data)
+        length += len(data)
+    if pending:
+        yield start, b''.join(pending)
+
+
+def fill_gaps(blocks, size):
+    """
+    Yield (offset, length) for the ranges of size not covered by blocks,
+    interleaved with the blocks themselves. Holes in an image must still
+    read as zeroes once written.
+    """
+    position = 0
+    for offset, data in blocks:
+        if offset > position:
+            yield position, offset - position
+        yield offset, data
+        position = offset + len(data)
+    if size > position:
+        yield position, size - position
+
+
+class QCOW2Reader(object):
+    """
+    Reads a qcow2 image cluster by cluster, without converting it first.
+
+    Backing files and encryption are not supported. Compressed clusters
+    (deflate) are.
+    """
+
+    header_format = '>4sIQIIQIIQQIIQ'
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = open(path, 'rb')
+        header = self.fp.read(struct.calcsize(self.header_format))
+        (magic, self.version, backing_file_offset, _, self.cluster_bits,
+         self.size, crypt_method, self.l1_size, self.l1_table_offset, _, _,
+         _, _) = struct.unpack(self.header_format, header)
+
+        if magic != QCOW2_MAGIC:
+            raise BlockImageException('%s is not a qcow2 image' % path)
+        if self.version not in (2, 3):
+            raise BlockImageException(
+                'Unsupported qcow2 version: %d' % self.version)
+        if backing_file_offset:
+            raise BlockImageException('qcow2 backing files are not supported')
+        if crypt_method:
+            raise BlockImageException('Encrypted qcow2 images are not '
+                                      'supported')
+        if self.version == 3:
+            self.fp.seek(72)
+            incompatible_features, = struct.unpack('>Q', self.fp.read(8))
+            # bit 0 is the dirty flag, anything else changes the format
+            if incompatible_features & ~1:
+                raise BlockImageException(
+                    'Unsupported qcow2 features: %#x' % incompatible_features)
+
+        self.cluster_size = 1 << self.cluster_bits
+        self.l2_entries = self.cluster_size // 8
+        self.compressed_bits = 62 - (self.cluster_bits - 8)
+
+    def _read(self, offset, length):
+        self.fp.seek(offset)
+        return self.fp.read(length)
+
+    def _read_table(self, offset, entries):
+        return struct.unpack('>%dQ' % entries, self._read(offset, entries * 8))
+
+    def _read_compressed(self, entry):
+        host_offset = entry & ((1 << self.compressed_bits) - 1)
+        sectors = ((entry >> self.compressed_bits) &
+                   ((1 << (self.cluster_bits - 8)) - 1)) + 1
+        length = sectors * 512 - (host_offset & 511)
+        data = zlib.decompressobj(-12).decompress(
+            self._read(host_offset, length))
+        return data[:self.cluster_size]
+
+    def clusters(self):
+        """
+        Yield (guest offset, data) for every cluster holding data. Clusters
+        which are unallocated or read as zeroes are left out.
+        """
+        l1_table = self._read_table(self.l1_table_offset, self.l1_size)
+        for l1_index, l1_entry in enumerate(l1_table):
+            l2_offset = l1_entry & QCOW2_OFFSET_MASK
+            if not l2_offset:
+                continue
+            l2_table = self._read_table(l2_offset, self.l2_entries)
+            base = l1_index * self.l2_entries * self.cluster_size
+            for l2_index, entry in enumerate(l2_table):
+                guest_offset = base + l2_index * self.cluster_size
+                if guest_offset >= self.size:
+                    return
+                if entry & QCOW2_COMPRESSED:
+                    data = self._read_compressed(entry)
+                elif self.version == 3 and entry & QCOW2_ZERO:
+                    continue
+                elif entry & QCOW2_OFFSET_MASK:
+                    data = self._read(entry & QCOW2_OFFSET_MASK,
+                                      self.cluster_size)
+                else:
+                    continue
+                yield guest_offset, data[:self.size - guest_offset]
+
+    def close(self):
+        self.fp.close()
+
+
+class BlockWriter(object):
+    """
+    Writes (offset, data) blocks to a device using a pool of threads.
+    """
+
+    def __init__(self,
+                 device,
+                 writers=4,
+                 sparse=SPARSE_ZEROOUT,
+                 zero_granularity=65536,
+                 queue_depth=16):
+        """
+        :param device: block device (or file) to write to
+        :param writers: number of writer threads
+        :param sparse: what to do with runs of zeroes
+            zeroout: have the device zero them (BLKZEROOUT)
+            skip: leave them alone, the device must already read zeroes
+            write: write them like any other data
+        :param zero_granularity: smallest run of zeroes that is not written
+        :param queue_depth: blocks read ahead of the writers
+        """
+        if sparse not in SPARSE_POLICIES:
+            raise BlockImageException('Invalid sparse policy: %s' % sparse)
+        self.device = device
+        self.writers = writers
+        self.sparse = sparse
+        self.zero_granularity = zero_granularity
+        self.queue = queue.Queue(queue_depth)
+        self.error = None
+        self.bytes_written = 0
+        self.bytes_skipped = 0
+        self._zeroes = b'\0' * zero_granularity
+        self._lock = threading.Lock()
+        self._threads = list()
+        self._fd = None
+        self._zeroout_supported = True
+
+    @property
+    def device_size(self):
+        fd = os.open(self.device, os.O_RDONLY)
+        try:
+            return os.lseek(fd, 0, os.SEEK_END)
+        finally:
+            os.close(fd)
+
+    def open(self):
+        self._fd = os.open(self.device, os.O_WRONLY)
+        for _ in range(self.writers):
+            thread = threading.Thread(target=self._writer)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _write_zeroes(self, offset, length):
+        end = offset + length
+        while offset < end:
+            size = min(end - offset, len(self._zeroes))
+            os.pwrite(self._fd, self._zeroes[:size], offset)
+            offset += size
+
+    def _zeroout(self, offset, length):
+        if self.sparse == SPARSE_SKIP:
+            return
+        aligned = not (offset % 512 or length % 512)
+        if self._zeroout_supported and aligned:
+            try:
+                fcntl.ioctl(self._fd, BLKZEROOUT,
+                            struct.pack('QQ', offset, length))
+                return
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.ENOTTY, errno.EOPNOTSUPP,
+                                   errno.EINVAL):
+                    raise
+                log.debug('BLKZEROOUT is not supported on %s, writing '
+                          'zeroes' % self.device)
+                self._zeroout_supported = False
+        self._write_zeroes(offset, length)
+
+    def _write_block(self, offset, data):
+        if isinstance(data, six.integer_types):
+            # a hole, data is its length
+            self._zeroout(offset, data)
+            with self._lock:
+                self.bytes_skipped += data
+            return
+
+        if self.sparse == SPARSE_WRITE:
+            os.pwrite(self._fd, data, offset)
+            with self._lock:
+                self.bytes_written += len(data)
+            return
+
+        # split the block into runs of data and runs of zeroes, each run is
+        # a single pwrite or zeroout
+        runs = list()
+        for position in range(0, len(data), self.zero_granularity):
+            piece = data[position:position + self.zero_granularity]
+            is_zero = piece == self._zeroes[:len(piece)]
+            if runs and runs[-1][0] == is_zero:
+                runs[-1][2] = position + len(piece)
+            else:
+                runs.append([is_zero, position, position + len(piece)])
+
+        written = skipped = 0
+        for is_zero, start, end in runs:
+            if is_zero:
+                self._zeroout(offset + start, end - start)
+                skipped += end - start
+            else:
+                os.pwrite(self._fd, data[start:end], offset + start)
+                written += end - start
+        with self._lock:
+            self.bytes_written += written
+            self.bytes_skipped += skipped
+
+    def _writer(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error:
+                continue
+            try:
+                self._write_block(*item)
+            except Exception as e:
+                log.error('Error writing to %s: %s' % (self.device, e))
+                self.error = e
+
+    def write(self, offset, data):
+        """
+        :param offset: byte offset on the device
+        :param data: bytes, or the length of a hole which must read as zeroes
+        """
+        if self.error:
+            raise self.error
+        self.queue.put((offset, data))
+
+    def abort(self):
+        if not self.error:
+            self.error = BlockImageException('Write aborted')
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def close(self):
+        for _ in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        if self._fd is not None:
+            if not self.error:
+                os.fsync(self._fd)
+            os.close(self._fd)
+            self._fd = None
+        if self.error:
+            raise self.error
+        log.info('%s: %d bytes written, %d bytes of zeroes not written' %
+                 (self.device, self.bytes_written, self.bytes_skipped))
+
+
+def discard(device):
+    log.info('Discarding %s' % device)
+    result = run('blkdiscard %s' % device)
+    if result.returncode:
+        log.warning('Could not discard %s: %s' % (device, result.stderr))
+        return False
+    return True
+
+
+def wipe_signatures(device):
+    log.info('Wiping signatures on %s' % device)
+    run('wipefs -a %s' % device)
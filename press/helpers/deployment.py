@@ -1,7 +1,11 @@
 from . import cli
+import errno
 import logging
 import os
+import shlex
 import shutil
+import subprocess
+import tempfile
 
 from tempfile import mkstemp
 
@@ -155,18 +159,222 @@ def remove_file(path):
     os.unlink(path)
 
 
+# (compression, magic bytes found at the start of the stream)
+COMPRESSION_MAGIC = (
+    ('gzip', b'\x1f\x8b'),
+    ('bzip2', b'BZh'),
+    ('xz', b'\xfd7zXZ\x00'),
+    ('zstd', b'\x28\xb5\x2f\xfd'),
+    ('lz4', b'\x04\x22\x4d\x18'),
+)
+
+# Decompressors in order of preference, the first one found in PATH is used.
+# Multi-threaded implementations come first.
+DECOMPRESSORS = {
+    'gzip': ('pigz -dc', 'gzip -dc'),
+    'bzip2': ('pbzip2 -dc', 'lbzip2 -dc', 'bzip2 -dc'),
+    'xz': ('pixz -d', 'xz -dc -T0'),
+    'zstd': ('zstd -dc -T0', ),
+    'lz4': ('lz4 -dc', ),
+}
+
+MAGIC_LENGTH = max([len(magic) for _, magic in COMPRESSION_MAGIC])
+
+
+def detect_compression(header):
+    """
+    :param header: the first bytes of an archive, at least MAGIC_LENGTH
+    :return: gzip, bzip2, xz, zstd, lz4, or None for an uncompressed stream
+    """
+    for compression, magic in COMPRESSION_MAGIC:
+        if header.startswith(magic):
+            return compression
+    return None
+
+
+def detect_file_compression(path):
+    with open(path, 'rb') as fp:
+        return detect_compression(fp.read(MAGIC_LENGTH))
+
+
+def decompress_command(compression):
+    for command in DECOMPRESSORS[compression]:
+        if cli.find_in_path(command.split()[0]):
+            return command
+    raise TarStreamException(
+        'No %s decompressor found, install one of: %s' %
+        (compression, ', '.join([c.split()[0]
+                                 for c in DECOMPRESSORS[compression]])))
+
+
 def tar_extract(archive_path, chdir=''):
-    # TODO: read header to determine compression / archive type?
+    compression = detect_file_compression(archive_path)
+    log.info('Extracting %s (%s)' % (archive_path, compression or
+                                     'uncompressed'))
+    extractor = TarStream(compression, chdir=chdir, archive_path=archive_path)
+    try:
+        extractor.close()
+    except TarStreamException as e:
+        log.error('Error extracting %s: %s' % (archive_path, e))
+
+    result = cli.AttributeString('')
+    result.stderr = extractor.stderr
+    result.returncode = extractor.returncode
+    result.command = extractor.command
+    return result
+
+
+class TarStream(object):
+    """
+    Extract an archive, decompressing it in a separate process piped into
+    tar so that threaded decompressors can be used.
+
+    Without archive_path, the archive is fed chunk by chunk with write().
+    This is used to lay down an image while it is still being downloaded.
+    close() waits for the pipeline and raises if it did not exit cleanly.
+    abort() kills it, the caller is then responsible for removing whatever
+    was extracted.
+    """
+
     base_tar_cmd = 'tar --numeric-owner --xattrs --xattrs-include=* --acls'
-    bzip_extensions = ('bz2', 'tbz', 'tbz2')
-    compress_method = 'z'
-    use_bzip = bool([i for i in bzip_extensions if archive_path.endswith(i)])
-    if use_bzip:
-        compress_method = 'j'
 
-    return cli.run('%s -%sxf %s%s' %
-                   (base_tar_cmd, compress_method, archive_path,
-                    chdir and ' -C %s' % chdir or ''))
+    def __init__(self, compression=None, chdir='', archive_path=None):
+        """
+        :param compression: as returned by detect_compression()
+        :param chdir: extract here
+        :param archive_path: (optional) read the archive from this file
+        """
+        tar_command = '%s -xf -%s' % (self.base_tar_cmd,
+                                      chdir and ' -C %s' % chdir or '')
+        commands = [tar_command]
+        if compression:
+            commands.insert(0, decompress_command(compression))
+        self.commands = commands
+        self.command = ' | '.join(commands)
+        self.returncode = None
+
+        # stderr goes to a file, a chatty tar would otherwise fill the pipe
+        # and dead lock against our writes
+        self._stderr = tempfile.TemporaryFile()
+        self._source = archive_path and open(archive_path, 'rb')
+        log.debug('Running: %s%s' % (self.command, archive_path and
+                                     ' < %s' % archive_path or ''))
+
+        self.processes = list()
+        stdin = self._source or subprocess.PIPE
+        try:
+            for command in commands:
+                is_last = command is commands[-1]
+                process = subprocess.Popen(
+                    shlex.split(command),
+                    stdin=stdin,
+                    stdout=self._stderr if is_last else subprocess.PIPE,
+                    stderr=self._stderr)
+                if self.processes:
+                    # Only the next process in line should hold the pipe open
+                    self.processes[-1].stdout.close()
+                self.processes.append(process)
+                stdin = process.stdout
+        except Exception:
+            # tar could not be started, do not leave the decompressor behind
+            self._kill()
+            raise
+
+    def _kill(self):
+        for process in self.processes:
+            for pipe in (process.stdin, process.stdout):
+                if pipe:
+                    pipe.close()
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+        if self._source:
+            self._source.close()
+        self._stderr.close()
+
+    @property
+    def stdin(self):
+        return self.processes[0].stdin
+
+    @property
+    def stderr(self):
+        self._stderr.seek(0)
+        return self._stderr.read().decode('utf-8', 'replace')
+
+    def _wait(self):
+        returncodes = [process.wait() for process in self.processes]
+        if self._source:
+            self._source.close()
+        for command, returncode in zip(self.commands, returncodes):
+            if returncode < 0:
+                log.warning('%s was killed by signal %d' %
+                            (command, -returncode))
+            elif returncode:
+                log.warning('%s returned %d' % (command, returncode))
+        # a killed process returns a negative code, it must not be hidden
+        # behind a clean exit of the next one
+        self.returncode = next((returncode for returncode in returncodes
+                                if returncode), 0)
+        return self.returncode
+
+    def write(self, data):
+        try:
+            self.stdin.write(data)
+        except IOError as e:
+            if e.errno != errno.EPIPE:
+                raise
+            # tar has exited early, reap it so that close() can report why
+            self._wait()
+            raise TarStreamException('tar exited during extraction: %s' %
+                                     self.stderr)
+
+    def close(self):
+        if self.stdin:
+            try:
+                self.stdin.close()
+            except IOError as e:
+                if e.errno != errno.EPIPE:
+                    raise
+        returncode = self._wait()
+        log.debug('Return Code: %d' % returncode)
+        if returncode:
+            raise TarStreamException('%s returned %d: %s' %
+                                     (self.command, returncode, self.stderr))
+        return returncode
+
+    def abort(self):
+        for process in self.processes:
+            if process.poll() is None:
+                log.warning('Aborting extraction')
+                process.kill()
+        self._wait()
+
+
+class TarStreamException(Exception):
+    pass
+
+
+def wipe_directory(path):
+    """
+    Remove everything below path, leaving path itself in place. Directories
+    which are mount points are emptied rather than removed.
+    """
+    for entry in os.listdir(path):
+        full_path = os.path.join(path, entry)
+        if os.path.isdir(full_path) and not os.path.islink(full_path):
+            wipe_directory(full_path)
+            if not os.path.ismount(full_path):
+                os.rmdir(full_path)
+        else:
+            os.unlink(full_path)
+
+
+def free_space(path):
+    """
+    :return: bytes available to unprivileged users below path
+    """
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
 
 
 def create_fstab(fstab, target):
@@ -185,6 +393,10 @@ def find_root(layout):
             if logical_volume.mount_point == '/':
                 return logical_volume
 
+    for subvolume in layout.subvolumes:
+        if subvolume.mount_point == '/':
+            return subvolume
+
 
 def copy(src,
          dst,
@@ -0,0 +1,418 @@
+"""
+Native GPT and MBR partition table writer
+
+The table is computed in memory and written with a handful of pwrite calls,
+followed by a single request for the kernel to re-read it. Partitions are
+placed exactly as PartedInterface.create_partition places them, so that both
+engines produce the same layout from the same PartitionTable.
+"""
+import errno
+import fcntl
+import logging
+import os
+import struct
+import uuid
+import zlib
+
+from press.helpers.cli import run
+
+log = logging.getLogger(__name__)
+
+BLKRRPART = 0x125f
+
+GPT = 'gpt'
+MSDOS = 'msdos'
+
+GPT_SIGNATURE = b'EFI PART'
+GPT_REVISION = 0x00010000
+GPT_HEADER_SIZE = 92
+GPT_ENTRY_SIZE = 128
+GPT_MIN_ENTRIES = 128
+GPT_ATTRIBUTE_LEGACY_BOOT = 1 << 2
+
+GPT_TYPE_LINUX = uuid.UUID('0fc63daf-8483-4772-8e79-3d69d8477de4')
+GPT_TYPE_BIOS_BOOT = uuid.UUID('21686148-6449-6e6f-744e-656564454649')
+GPT_TYPE_ESP = uuid.UUID('c12a7328-f81f-11d2-ba4b-00a0c93ec93b')
+GPT_TYPE_LVM = uuid.UUID('e6d6d379-f507-44c2-a23c-238f2a3df928')
+GPT_TYPE_RAID = uuid.UUID('a19d880f-05fc-4d3b-a006-743f0f84911e')
+GPT_TYPE_SWAP = uuid.UUID('0657fd6d-a4ab-43c4-84e5-0933c84b4f4f')
+GPT_TYPE_MSDATA = uuid.UUID('ebd0a0a2-b9e5-4433-87c0-68b6b72699c7')
+
+MBR_TYPE_LINUX = 0x83
+MBR_TYPE_SWAP = 0x82
+MBR_TYPE_LVM = 0x8e
+MBR_TYPE_RAID = 0xfd
+MBR_TYPE_FAT32 = 0x0c
+MBR_TYPE_NTFS = 0x07
+MBR_TYPE_EXTENDED = 0x0f
+MBR_TYPE_PROTECTIVE = 0xee
+MBR_SIGNATURE = b'\x55\xaa'
+MBR_BOOTABLE = 0x80
+MBR_ENTRIES_OFFSET = 446
+# CHS addressing is not used, every address is past 1024 cylinders
+MBR_CHS_MAX = b'\xfe\xff\xff'
+
+# flag: (gpt type, mbr type), in order of precedence
+FLAG_TYPES = (
+    ('bios_grub', GPT_TYPE_BIOS_BOOT, None),
+    ('esp', GPT_TYPE_ESP, MBR_TYPE_FAT32),
+    ('raid', GPT_TYPE_RAID, MBR_TYPE_RAID),
+    ('lvm', GPT_TYPE_LVM, MBR_TYPE_LVM),
+    ('swap', GPT_TYPE_SWAP, MBR_TYPE_SWAP),
+)
+
+# parted file system type alias: (gpt type, mbr type)
+FS_TYPES = {
+    'linux-swap': (GPT_TYPE_SWAP, MBR_TYPE_SWAP),
+    'fat32': (GPT_TYPE_MSDATA, MBR_TYPE_FAT32),
+    'fat16': (GPT_TYPE_MSDATA, MBR_TYPE_FAT32),
+    'NTFS': (GPT_TYPE_MSDATA, MBR_TYPE_NTFS),
+}
+
+
+class DiskLabelException(Exception):
+    pass
+
+
+def crc32(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+class DiskPartition(object):
+
+    def __init__(self, number, first_lba, last_lba, name='', flags=None,
+                 fs_type='', logical=False, extended=False):
+        self.number = number
+        self.first_lba = first_lba
+        self.last_lba = last_lba
+        self.name = name
+        self.flags = flags or list()
+        self.fs_type = fs_type
+        self.logical = logical
+        self.extended = extended
+        self.guid = uuid.uuid4()
+
+    @property
+    def sectors(self):
+        return self.last_lba - self.first_lba + 1
+
+    def _type(self, index):
+        for flag, gpt_type, mbr_type in FLAG_TYPES:
+            if flag in self.flags:
+                return (gpt_type, mbr_type)[index]
+        if 'boot' in self.flags and index == 0:
+            # parted maps boot to the EFI system partition on gpt
+            return GPT_TYPE_ESP
+        default = (GPT_TYPE_LINUX, MBR_TYPE_LINUX)
+        return FS_TYPES.get(self.fs_type, default)[index]
+
+    @property
+    def gpt_type(self):
+        return self._type(0)
+
+    @property
+    def mbr_type(self):
+        if self.extended:
+            return MBR_TYPE_EXTENDED
+        return self._type(1)
+
+    def __repr__(self):
+        return '%d: %d-%d %s' % (self.number, self.first_lba, self.last_lba,
+                                 self.name)
+
+
+class DiskLabel(object):
+    """
+    An in-memory GPT or MBR partition table for a device.
+    """
+
+    def __init__(self,
+                 device,
+                 table_type,
+                 size=None,
+                 sector_size=512,
+                 partition_start=1048576,
+                 alignment=1048576,
+                 alignment_offset=0):
+        """
+        :param device: block device or file
+        :param table_type: gpt or msdos
+        :param size: device size in bytes, read from the device if None
+        :param sector_size: logical sector size
+        :param partition_start: offset of the first partition
+        :param alignment: partitions start on a multiple of alignment
+        :param alignment_offset: added to each multiple of alignment
+        """
+        if table_type not in (GPT, MSDOS):
+            raise DiskLabelException('Unsupported label: %s' % table_type)
+        self.device = device
+        self.type = table_type
+        self.sector_size = sector_size
+        self.partition_start = partition_start
+        self.alignment = alignment
+        self.alignment_offset = alignment_offset
+        if size is None:
+            fd = os.open(device, os.O_RDONLY)
+            try:
+                size = os.lseek(fd, 0, os.SEEK_END)
+            finally:
+                os.close(fd)
+        self.size = size
+        self.total_sectors = size // sector_size
+        self.disk_guid = uuid.uuid4()
+        self.partitions = list()
+
+    @property
+    def gpt_entry_count(self):
+        # the entry array fills whole sectors
+        per_sector = self.sector_size // GPT_ENTRY_SIZE
+        count = max(GPT_MIN_ENTRIES, len(self.partitions))
+        return -(-count // per_sector) * per_sector
+
+    @property
+    def gpt_entry_sectors(self):
+        return self.gpt_entry_count * GPT_ENTRY_SIZE // self.sector_size
+
+    @property
+    def first_usable_lba(self):
+        if self.type == GPT:
+            return 2 + self.gpt_entry_sectors
+        return 1
+
+    @property
+    def last_usable_lba(self):
+        if self.type == GPT:
+            return self.total_sectors - 2 - self.gpt_entry_sectors
+        return self.total_sectors - 1
+
+    @property
+    def extended_partition(self):
+        for partition in self.partitions:
+            if partition.extended:
+                return partition
+
+    @property
+    def logical_partitions(self):
+        return [p for p in self.partitions if p.logical]
+
+    @property
+    def primary_partitions(self):
+        return [p for p in self.partitions if not p.logical]
+
+    def _lba(self, offset):
+        return offset // self.sector_size
+
+    def _add(self, number, start, end, **kwargs):
+        partition = DiskPartition(number, self._lba(start), self._lba(end),
+                                  **kwargs)
+        if partition.first_lba < self.first_usable_lba or \
+                partition.last_lba > self.last_usable_lba:
+            raise DiskLabelException(
+                'Partition %d (%d-%d) is outside of the usable area (%d-%d)' %
+                (number, partition.first_lba, partition.last_lba,
+                 self.first_usable_lba, self.last_usable_lba))
+        self.partitions.append(partition)
+        return partition
+
+    def add_partition(self, type_or_name, size, flags=None, fs_type=''):
+        """Place a partition after the last one
+
+        :param type_or_name: the partition name on gpt, primary or logical on
+            msdos
+        :param size: size in bytes
+        :param flags: parted style flags (boot, lvm, raid, bios_grub...)
+        :param fs_type: parted file system type alias
+        :return: partition number
+        """
+        flags = flags or list()
+        start = self.partition_start
+        number = 1
+        last = self.partitions and max(self.partitions,
+                                       key=lambda p: p.number)
+        if last:
+            # the last byte of the previous partition, as printed by parted
+            end = (last.last_lba + 1) * self.sector_size - 1
+            start = end + (self.alignment -
+                           (end - self.alignment_offset) % self.alignment)
+            number = last.number + 1
+        end = start + size
+
+        if self.type == GPT:
+            self._add(number, start, end, name=type_or_name, flags=flags,
+                      fs_type=fs_type)
+            return number
+
+        if 'bios_grub' in flags:
+            raise DiskLabelException('bios_grub requires a gpt label')
+
+        if type_or_name == 'logical':
+            extended = self.extended_partition
+            if not extended:
+                if len(self.primary_partitions) > 3:
+                    raise DiskLabelException('No primary partition left for '
+                                             'an extended partition')
+                self._add(number, start, self.size - 1, extended=True)
+                start += self.partition_start
+                number = 5
+                end = start + size
+            elif len(self.logical_partitions) and \
+                    self._lba(start) - 1 <= self.logical_partitions[-1].last_lba:
+                raise DiskLabelException('No room for the logical partition '
+                                         'boot record')
+            self._add(number, start, end, flags=flags, fs_type=fs_type,
+                      logical=True)
+            return number
+
+        if self.extended_partition:
+            raise DiskLabelException('Primary partitions must be created '
+                                     'before logical partitions')
+        if len(self.primary_partitions) > 3:
+            raise DiskLabelException('msdos labels have 4 primary partitions')
+        self._add(number, start, end, flags=flags, fs_type=fs_type)
+        return number
+
+    @staticmethod
+    def _mbr_entry(partition, first_lba, sectors, mbr_type=None):
+        return struct.pack(
+            '<B3sB3sII', MBR_BOOTABLE if 'boot' in partition.flags and
+            not partition.extended else 0,
+            MBR_CHS_MAX, mbr_type or partition.mbr_type, MBR_CHS_MAX,
+            first_lba, sectors)
+
+    def _boot_record(self, entries, bootstrap=b''):
+        data = bytearray(self.sector_size)
+        data[:len(bootstrap)] = bootstrap
+        offset = MBR_ENTRIES_OFFSET
+        for entry in entries:
+            data[offset:offset + 16] = entry
+            offset += 16
+        data[510:512] = MBR_SIGNATURE
+        return bytes(data)
+
+    def _ebr_lba(self, index):
+        logical = self.logical_partitions
+        if not index:
+            return self.extended_partition.first_lba
+        return logical[index].first_lba - 1
+
+    def _mbr(self, bootstrap):
+        entries = list()
+        for partition in self.primary_partitions:
+            entries.append(
+                self._mbr_entry(partition, partition.first_lba,
+                                partition.sectors))
+        # bytes 440-443 hold the disk signature
+        bootstrap = bootstrap[:440] + struct.pack(
+            '<I', self.disk_guid.int & 0xffffffff)
+        writes = [(0, self._boot_record(entries, bootstrap))]
+
+        logical = self.logical_partitions
+        extended = self.extended_partition
+        for index, partition in enumerate(logical):
+            ebr_lba = self._ebr_lba(index)
+            entries = [
+                self._mbr_entry(partition, partition.first_lba - ebr_lba,
+                                partition.sectors)
+            ]
+            if index + 1 < len(logical):
+                next_ebr = self._ebr_lba(index + 1)
+                entries.append(
+                    self._mbr_entry(
+                        extended, next_ebr - extended.first_lba,
+                        logical[index + 1].last_lba - next_ebr + 1))
+            writes.append((ebr_lba * self.sector_size,
+                           self._boot_record(entries)))
+        return writes
+
+    def _gpt_entries(self):
+        data = bytearray(self.gpt_entry_count * GPT_ENTRY_SIZE)
+        for partition in self.partitions:
+            attributes = 0
+            if 'legacy_boot' in partition.flags:
+                attributes |= GPT_ATTRIBUTE_LEGACY_BOOT
+            offset = (partition.number - 1) * GPT_ENTRY_SIZE
+            data[offset:offset + GPT_ENTRY_SIZE] = struct.pack(
+                '<16s16sQQQ72s', partition.gpt_type.bytes_le,
+                partition.guid.bytes_le, partition.first_lba,
+                partition.last_lba, attributes,
+                partition.name[:36].encode('utf-16-le'))
+        return bytes(data)
+
+    def _gpt_header(self, my_lba, alternate_lba, entries_lba, entries_crc):
+        fields = [
+            GPT_SIGNATURE, GPT_REVISION, GPT_HEADER_SIZE, 0, 0, my_lba,
+            alternate_lba, self.first_usable_lba, self.last_usable_lba,
+            self.disk_guid.bytes_le, entries_lba, self.gpt_entry_count,
+            GPT_ENTRY_SIZE, entries_crc
+        ]
+        header_format = '<8sIIIIQQQQ16sQIII'
+        fields[3] = crc32(struct.pack(header_format, *fields))
+        header = struct.pack(header_format, *fields)
+        return header + b'\0' * (self.sector_size - len(header))
+
+    def _gpt(self):
+        protective = DiskPartition(0, 1, self.total_sectors - 1)
+        mbr = self._boot_record([
+            self._mbr_entry(protective, 1,
+                            min(self.total_sectors - 1, 0xffffffff),
+                            MBR_TYPE_PROTECTIVE)
+        ])
+        entries = self._gpt_entries()
+        entries_crc = crc32(entries)
+        last_lba = self.total_sectors - 1
+        backup_entries_lba = last_lba - self.gpt_entry_sectors
+        ss = self.sector_size
+        return [
+            (0, mbr),
+            (ss, self._gpt_header(1, last_lba, 2, entries_crc) + entries),
+            (backup_entries_lba * ss, entries + self._gpt_header(
+                last_lba, 1, backup_entries_lba, entries_crc)),
+        ]
+
+    def write(self):
+        """Write the table, replacing any existing gpt or msdos label"""
+        log.info('Writing %s label with %d partitions to %s' %
+                 (self.type, len(self.partitions), self.device))
+        ss = self.sector_size
+        # the primary and backup gpt areas are cleared for both labels, a
+        # stale backup gpt would otherwise be picked up by blkid
+        gpt_area = (2 + self.gpt_entry_sectors) * ss
+        fd = os.open(self.device, os.O_RDWR)
+        try:
+            bootstrap = os.pread(fd, 440, 0)
+            os.pwrite(fd, b'\0' * gpt_area, 0)
+            os.pwrite(fd, b'\0' * (gpt_area - ss),
+                      self.size - (gpt_area - ss))
+            if self.type == GPT:
+                writes = self._gpt()
+            else:
+                writes = self._mbr(bootstrap)
+            for offset, data in writes:
+                os.pwrite(fd, data, offset)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def reread(self):
+        """Ask the kernel to re-read the table
+
+        BLKRRPART fails when a partition of the device is in use, partx then
+        updates the partitions one by one (BLKPG).
+        """
+        fd = os.open(self.device, os.O_RDONLY)
+        try:
+            fcntl.ioctl(fd, BLKRRPART)
+            return
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOTTY:
+                log.debug('%s is not a block device' % self.device)
+                return
+            log.warning('BLKRRPART failed on %s: %s, using partx' %
+                        (self.device, e))
+        finally:
+            os.close(fd)
+        result = run('partx -u %s' % self.device)
+        if result.returncode:
+            raise DiskLabelException(
+                'Could not update the kernel partition table: %s' %
+                result.stderr)
@@ -0,0 +1,124 @@
+"""
+A content addressed cache for downloaded images.
+
+Images are stored under their configured checksum, so a cached entry has
+already been validated and can be used without downloading or hashing it
+again. When the cache grows beyond max_size, the least recently used
+entries are evicted.
+"""
+import errno
+import logging
+import os
+import shutil
+
+from press.helpers.cli import run
+from press.helpers.deployment import recursive_makedir
+
+log = logging.getLogger(__name__)
+
+
+class ImageCacheException(Exception):
+    pass
+
+
+class ImageCache(object):
+    temp_suffix = '.partial'
+
+    def __init__(self, path, max_size=0, device=None):
+        """
+        :param path: cache directory, or mount point when device is set
+        :param max_size: size budget in bytes, 0 means unlimited
+        :param device: (optional) a block device reserved for the cache, it
+            is mounted on path by open()
+        """
+        self.path = path
+        self.max_size = max_size
+        self.device = device
+        self.mounted = False
+
+    def open(self):
+        recursive_makedir(self.path)
+        if self.device and not os.path.ismount(self.path):
+            log.info('Mounting image cache %s on %s' % (self.device,
+                                                        self.path))
+            result = run('mount %s %s' % (self.device, self.path))
+            if result.returncode:
+                raise ImageCacheException(
+                    'Could not mount image cache: %s' % result.stderr)
+            self.mounted = True
+
+    def close(self):
+        if self.mounted:
+            run('umount %s' % self.path)
+            self.mounted = False
+
+    def entry_path(self, hash_method, checksum):
+        return os.path.join(self.path, '%s-%s' % (hash_method.lower(),
+                                                  checksum.lower()))
+
+    def lookup(self, hash_method, checksum):
+        """
+        :return: path to the cached image or None
+        """
+        path = self.entry_path(hash_method, checksum)
+        if not os.path.isfile(path):
+            return None
+        # mtime tracks the last use, atime is unreliable with noatime
+        os.utime(path, None)
+        log.info('Image cache hit: %s' % path)
+        return path
+
+    @property
+    def entries(self):
+        """
+        :return: a list of (mtime, size, path), least recently used first
+        """
+        entries = list()
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if name.endswith(self.temp_suffix) or not os.path.isfile(path):
+                continue
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        return entries
+
+    @property
+    def usage(self):
+        return sum([size for _, size, _ in self.entries])
+
+    def evict(self, needed=0):
+        """Remove least recently used entries until needed bytes fit"""
+        if not self.max_size:
+            return
+        usage = self.usage
+        for _, size, path in self.entries:
+            if usage + needed <= self.max_size:
+                break
+            log.info('Evicting %s from image cache' % path)
+            os.unlink(path)
+            usage -= size
+
+    def store(self, filename, hash_method, checksum):
+        """Move a validated image into the cache
+
+        :return: path of the cached image or None if it does not fit
+        """
+        size = os.path.getsize(filename)
+        if self.max_size and size > self.max_size:
+            log.info('Image is larger than the image cache, not caching')
+            return None
+
+        self.evict(size)
+        path = self.entry_path(hash_method, checksum)
+        try:
+            os.rename(filename, path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            temp_path = path + self.temp_suffix
+            shutil.copyfile(filename, temp_path)
+            os.rename(temp_path, path)
+            os.unlink(filename)
+        log.info('Stored image in cache: %s' % path)
+        return path
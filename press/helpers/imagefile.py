@@ -1,10 +1,22 @@
 import hashlib
+import json
 import logging
 import os
 import requests
+import tempfile
+import time
 
 from press.exceptions import PressCriticalException
-from press.helpers.deployment import tar_extract
+from press.helpers.segmented_download import (SegmentedDownload,
+                                              RETRYABLE_EXCEPTIONS,
+                                              retry_delay)
+from press.helpers.blockimage import (BlockWriter, QCOW2Reader, SPARSE_ZEROOUT,
+                                      coalesce, fill_gaps, iter_raw,
+                                      wipe_signatures)
+from press.helpers.blockimage import discard as discard_device
+from press.helpers.deployment import (tar_extract, detect_compression,
+                                      MAGIC_LENGTH, TarStream,
+                                      TarStreamException, wipe_directory)
 
 # noinspection PyUnresolvedReferences
 from six.moves import urllib
@@ -21,7 +33,16 @@ class ImageFile(object):
                  expected_hash=None,
                  download_directory=None,
                  buffer_size=20480,
-                 proxy=None):
+                 proxy=None,
+                 stream=False,
+                 connections=1,
+                 segment_size=67108864,
+                 retries=0,
+                 retry_backoff=2,
+                 timeout=60,
+                 checkpoint_interval=67108864,
+                 cache=None,
+                 verify_after_extract=False):
         """
         Extending (or renaming really) Chad Catlett's Download class.
 
@@ -31,9 +52,28 @@ class ImageFile(object):
         :param target: a top-level directory where we extract/copy image files to
         :param hash_method: sha1, md5, sha256 or None
         :param expected_hash: pre-recorded hash
-        :param download_directory: where to place the temporary file
+        :param download_directory: where to place the temporary file,
+            target by default. A partial download only survives a restart
+            outside of the layout.
         :param buffer_size: maximum size of buffer for stream operations
         :param proxy: a proxy server in host:port format
+        :param stream: extract remote images as they are downloaded, without
+            writing the archive to download_directory
+        :param connections: number of concurrent range requests used by
+            download(), 1 disables segmented downloads
+        :param segment_size: size of each range request
+        :param retries: how many times in a row a dropped connection is
+            resumed with a range request before giving up
+        :param retry_backoff: seconds to wait before the first retry, doubled
+            on every following attempt
+        :param timeout: seconds to wait on a stalled connection
+        :param checkpoint_interval: how often download progress is recorded
+            next to the partial file, allowing a later run to resume
+        :param cache: (optional) an opened ImageCache, used when a checksum
+            is configured
+        :param verify_after_extract: hash local images while they are being
+            extracted, reading them only once. The caller must rollback() if
+            validation fails.
         """
 
         self.url = url
@@ -43,8 +83,18 @@ class ImageFile(object):
         self.download_directory = download_directory
         self.buffer_size = buffer_size
         self.proxy = proxy
+        self.stream = stream
+        self.connections = connections
+        self.segment_size = segment_size
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.timeout = timeout
+        self.checkpoint_interval = checkpoint_interval
+        self.cache = cache
+        self.verify_after_extract = verify_after_extract
         self._hash_object = None
         self.image_exists = False
+        self.cache_hit = False
         self.url_scheme = self.full_filename = None
 
         if hash_method:
@@ -69,12 +119,43 @@ class ImageFile(object):
         else:
             self.full_filename = os.path.join(self.download_directory,
                                               os.path.basename(filename))
+            if self.cache and self.can_validate:
+                cached = self.cache.lookup(self.hash_method,
+                                           self.expected_hash)
+                if cached:
+                    self.image_exists = self.cache_hit = True
+                    self.full_filename = cached
+
+    def set_download_directory(self, path):
+        """Download to path instead, must be called before download()
+        """
+        self.download_directory = path
+        self.filename_from_url()
+
+    def remote_size(self):
+        """
+        :return: the size advertised by the server or None
+        """
+        try:
+            res = requests.head(
+                self.url,
+                proxies=self.proxies,
+                allow_redirects=True,
+                timeout=self.timeout)
+            res.raise_for_status()
+        except requests.RequestException as e:
+            log.debug('HEAD request failed: %s' % e)
+            return None
+        return int(res.headers.get('content-length', '0')) or None
 
     def hash_file(self):
         """
         If we are not downloading the file, we still need to hash it
         :return:
         """
+        if self.cache_hit:
+            # cache entries are keyed by their checksum
+            return
         with open(self.full_filename, 'rb') as fp:
             while True:
                 data = fp.read(self.buffer_size)
@@ -82,26 +163,239 @@ class ImageFile(object):
                     break
                 self._hash_object.update(data)
 
-    def download(self, callback_func):
-        byte_count = 0
+    @property
+    def proxies(self):
         if self.proxy:
-            proxies = {'http': self.proxy, 'https': self.proxy}
-        else:
-            proxies = None
+            return {'http': self.proxy, 'https': self.proxy}
+        return None
 
-        res = requests.get(self.url, stream=True, proxies=proxies)
+    def _get(self, offset=0):
+        headers = None
+        if offset:
+            headers = {'Range': 'bytes=%d-' % offset}
+        res = requests.get(
+            self.url,
+            stream=True,
+            proxies=self.proxies,
+            headers=headers,
+            timeout=self.timeout)
         res.raise_for_status()
+        return res
+
+    def _reset_hash(self):
+        if self.hash_method:
+            self._hash_object = hashlib.new(self.hash_method)
+
+    def iter_download(self, offset=0, callback_func=None, on_restart=None):
+        """Yield the response body from offset
 
-        content_length = int(res.headers.get('content-length', '0'))
+        Dropped connections are resumed with a range request, up to
+        self.retries times in a row with an exponential backoff. A connection
+        which made progress before dropping starts the count over.
 
-        with open(self.full_filename, 'wb') as download_file:
-            for chunk in res.iter_content(self.buffer_size):
-                byte_count += len(chunk)
+        :param offset: byte offset to start from
+        :param callback_func: progress callback(total, done)
+        :param on_restart: called when the server ignores the range request
+            and sends the whole body. If None, this is an error.
+        """
+        attempt = 0
+        resumed_at = None
+        while True:
+            try:
+                res = self._get(offset)
+                if offset and res.status_code != 206:
+                    if not on_restart:
+                        raise PressCriticalException(
+                            'Server does not support resuming the download')
+                    log.warning('Server does not support range requests, '
+                                'starting over')
+                    offset = 0
+                    on_restart()
+                resumed_at = offset
+                content_length = offset + int(
+                    res.headers.get('content-length', '0'))
+                for chunk in res.iter_content(self.buffer_size):
+                    offset += len(chunk)
+                    yield chunk
+                    if callback_func:
+                        callback_func(content_length, offset)
+                return
+            except RETRYABLE_EXCEPTIONS as e:
+                if resumed_at is not None and offset > resumed_at:
+                    attempt = 0
+                resumed_at = None
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                delay = retry_delay(attempt, self.retry_backoff)
+                log.warning('Download interrupted at %d bytes: %s, retrying '
+                            'in %d seconds (%d/%d)' %
+                            (offset, e, delay, attempt, self.retries))
+                time.sleep(delay)
+
+    def download_segmented(self, callback_func):
+        """Download using concurrent range requests
+
+        :return: False if the server does not support ranges and nothing was
+            downloaded, True otherwise
+        """
+        if not SegmentedDownload.supported():
+            log.info('pwrite is not available, segmented download disabled')
+            return False
+
+        content_length = SegmentedDownload.probe(self.url, self.proxies,
+                                                 self.timeout)
+        if not content_length:
+            log.info('Server does not support range requests, falling back '
+                     'to a single connection')
+            return False
+
+        SegmentedDownload(
+            self.url,
+            self.full_filename,
+            content_length,
+            connections=self.connections,
+            segment_size=self.segment_size,
+            buffer_size=self.buffer_size,
+            hash_object=self._hash_object,
+            proxies=self.proxies,
+            retries=self.retries,
+            retry_backoff=self.retry_backoff,
+            timeout=self.timeout).run(callback_func)
+        return True
+
+    def download(self, callback_func):
+        if self.connections > 1 and self.download_segmented(callback_func):
+            return
+
+        checkpoint = DownloadCheckpoint(self.full_filename, self.url,
+                                        self.checkpoint_interval)
+        offset = self.resume(checkpoint)
+
+        def restart():
+            self._reset_hash()
+            checkpoint.reset()
+            download_file.seek(0)
+            download_file.truncate()
+
+        with open(self.full_filename, offset and 'r+b' or 'wb') as \
+                download_file:
+            download_file.seek(offset)
+            download_file.truncate()
+            for chunk in self.iter_download(offset, callback_func, restart):
                 if self._hash_object is not None:
                     self._hash_object.update(chunk)
                 download_file.write(chunk)
+                if checkpoint.update(chunk):
+                    download_file.flush()
+                    os.fsync(download_file.fileno())
+                    checkpoint.save()
+        checkpoint.remove()
+
+    def resume(self, checkpoint):
+        """Pick up a partial download left behind by a previous run
+
+        Blocks recorded in the checkpoint are verified and fed to the hash
+        object, anything past the last good block is discarded.
+
+        :return: the offset to resume from
+        """
+        if not checkpoint.load() or not os.path.isfile(self.full_filename):
+            checkpoint.reset()
+            return 0
+
+        offset = 0
+        with open(self.full_filename, 'rb') as fp:
+            for digest in checkpoint.digests:
+                data = fp.read(checkpoint.block_size)
+                if len(data) != checkpoint.block_size or \
+                        checkpoint.digest(data) != digest:
+                    break
+                if self._hash_object is not None:
+                    self._hash_object.update(data)
+                offset += len(data)
+        checkpoint.truncate(offset)
+        log.info('Resuming download of %s at %d bytes' %
+                 (self.full_filename, offset))
+        return offset
+
+    @property
+    def can_stream(self):
+        """Can stream_extract() be used?
+
+        Remote images are streamed when stream is set. Local images are
+        streamed when they need to be hashed and verify_after_extract is set.
+        Cached images are trusted, they are extracted directly.
+        """
+        if self.cache_hit:
+            return False
+        if self.image_exists:
+            return self.verify_after_extract and self.can_validate
+        return self.stream
+
+    def iter_file(self, callback_func=None):
+        total = os.path.getsize(self.full_filename)
+        done = 0
+        with open(self.full_filename, 'rb') as fp:
+            while True:
+                data = fp.read(self.buffer_size)
+                if not data:
+                    break
+                done += len(data)
+                yield data
                 if callback_func:
-                    callback_func(content_length, byte_count)
+                    callback_func(total, done)
+
+    def stream_extract(self, callback_func):
+        """Hash the image and extract it to target in a single pass
+
+        Remote images are downloaded and piped straight into tar, the archive
+        itself is never written to disk. Local images are read once, feeding
+        both the hash and tar. Since the checksum is only known at
+        end-of-stream, the caller must validate() afterwards and rollback() on
+        a mismatch.
+        """
+        if self.image_exists:
+            source = self.iter_file(callback_func)
+        else:
+            source = self.iter_download(callback_func=callback_func)
+
+        extractor = None
+        header = b''
+        try:
+            for chunk in source:
+                if self._hash_object is not None:
+                    self._hash_object.update(chunk)
+                if extractor is None:
+                    # the first reads can be shorter than the magic
+                    header += chunk
+                    if len(header) < MAGIC_LENGTH:
+                        continue
+                    extractor = TarStream(
+                        detect_compression(header), chdir=self.target)
+                    chunk, header = header, b''
+                extractor.write(chunk)
+            if extractor is None:
+                if not header:
+                    raise PressCriticalException('Image is empty')
+                extractor = TarStream(
+                    detect_compression(header), chdir=self.target)
+                extractor.write(header)
+            extractor.close()
+        except TarStreamException as e:
+            raise PressCriticalException(str(e))
+        except Exception:
+            if extractor:
+                extractor.abort()
+            raise
+
+    def rollback(self):
+        """Remove everything extracted to target
+
+        Mount points are preserved, only their content is removed
+        """
+        log.warning('Removing extracted image from %s' % self.target)
+        wipe_directory(self.target)
 
     @property
     def can_validate(self):
@@ -116,6 +410,8 @@ class ImageFile(object):
 
         returns True if the checksum is matches expected_hash, otherwise False
         """
+        if self.cache_hit:
+            return True
         return self._hash_object.hexdigest() == self.expected_hash
 
     def prepare_for_extract(self):
@@ -131,10 +427,224 @@ class ImageFile(object):
         Returns an _AttributeString
         """
 
-        # This is some ghetto crap to ensure that older versions of gnu-tar don't belly ache when it encounters a bz2.
         return tar_extract(self.full_filename, chdir=self.target)
 
+    @property
+    def can_cache(self):
+        return bool(self.cache and self.can_validate and not self.cache_hit
+                    and self.url_scheme != 'file')
+
+    def store_in_cache(self):
+        """Move the downloaded, validated, file into the image cache
+        """
+        cached = self.cache.store(self.full_filename, self.hash_method,
+                                  self.expected_hash)
+        if cached:
+            self.full_filename = cached
+            self.cache_hit = True
+        else:
+            self.cleanup()
+
     def cleanup(self):
         """Deletes downloaded file in this version
         """
+        if self.cache_hit:
+            return
         os.unlink(self.full_filename)
+
+
+class BlockImageFile(ImageFile):
+    """
+    A raw or qcow2 disk image, written directly to a block device instead of
+    being extracted to a mounted file system.
+    """
+    formats = ('raw', 'qcow2')
+
+    def __init__(self,
+                 url,
+                 device,
+                 image_format='raw',
+                 writers=4,
+                 block_size=4194304,
+                 sparse=SPARSE_ZEROOUT,
+                 discard=False,
+                 **kwargs):
+        """
+        :param url: see ImageFile
+        :param device: the block device the image is written to
+        :param image_format: raw or qcow2
+        :param writers: number of threads writing to the device
+        :param block_size: size of each write, a multiple of the device
+            sector size
+        :param sparse: zeroout, skip or write, see BlockWriter
+        :param discard: discard the whole device before writing
+        :param kwargs: passed to ImageFile. download_directory defaults to
+            the system temporary directory, there is no file system to put
+            the image in.
+        """
+        if image_format not in self.formats:
+            raise PressCriticalException(
+                'Unsupported block image format: %s' % image_format)
+        self.image_format = image_format
+        self.writers = writers
+        self.block_size = block_size
+        self.sparse = sparse
+        self.discard = discard
+        if kwargs.get('download_directory') is None:
+            kwargs['download_directory'] = tempfile.gettempdir()
+        super(BlockImageFile, self).__init__(url, device, **kwargs)
+
+    @property
+    def device(self):
+        return self.target
+
+    @property
+    def can_stream(self):
+        """Raw images can be streamed to the device, qcow2 images are read
+        out of order and must be downloaded first
+        """
+        return self.image_format == 'raw' and super(BlockImageFile,
+                                                     self).can_stream
+
+    def _write(self, blocks, size=None):
+        writer = BlockWriter(
+            self.device, writers=self.writers, sparse=self.sparse)
+        if size and size > writer.device_size:
+            raise PressCriticalException(
+                'Image (%d bytes) does not fit on %s (%d bytes)' %
+                (size, self.device, writer.device_size))
+        if self.discard:
+            discard_device(self.device)
+
+        log.info('Writing %s image to %s' % (self.image_format, self.device))
+        writer.open()
+        try:
+            for offset, data in blocks:
+                writer.write(offset, data)
+        except Exception:
+            writer.abort()
+            raise
+        writer.close()
+
+    def stream_extract(self, callback_func):
+        """Hash the image while writing it to the device
+
+        As with ImageFile.stream_extract, the caller must validate() afterwards
+        and rollback() on a mismatch.
+        """
+        if self.image_exists:
+            source = self.iter_file(callback_func)
+        else:
+            source = self.iter_download(callback_func=callback_func)
+
+        def hashed():
+            for chunk in source:
+                if self._hash_object is not None:
+                    self._hash_object.update(chunk)
+                yield chunk
+
+        self._write(iter_raw(hashed(), self.block_size))
+
+    def extract(self):
+        """Write the downloaded image to the device
+        """
+        if self.image_format == 'qcow2':
+            reader = QCOW2Reader(self.full_filename)
+            try:
+                self._write(
+                    fill_gaps(
+                        coalesce(reader.clusters(), self.block_size),
+                        reader.size), reader.size)
+            finally:
+                reader.close()
+        else:
+            self._write(
+                iter_raw(self.iter_file(), self.block_size),
+                os.path.getsize(self.full_filename))
+
+    def rollback(self):
+        """Make sure a partially written, or corrupt, image is not picked up
+        as a valid partition table or file system
+        """
+        log.warning('Removing signatures written to %s' % self.device)
+        wipe_signatures(self.device)
+
+
+class DownloadCheckpoint(object):
+    """
+    Records the progress of a download next to the partial file.
+
+    The file is tracked in fixed size blocks, each with its own digest. Hash
+    objects cannot be serialized, so resuming in a new process re-reads the
+    verified blocks once to rebuild the image checksum. Retries within the
+    same process keep the live hash object and never re-read.
+    """
+    hash_method = 'sha1'
+    suffix = '.checkpoint'
+
+    def __init__(self, filename, url, block_size=67108864):
+        self.path = filename + self.suffix
+        self.url = url
+        self.block_size = block_size
+        self.digests = list()
+        self._block = hashlib.new(self.hash_method)
+        self._block_count = 0
+
+    def digest(self, data):
+        return hashlib.new(self.hash_method, data).hexdigest()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return False
+        try:
+            with open(self.path) as fp:
+                data = json.load(fp)
+        except ValueError:
+            log.warning('Ignoring corrupt checkpoint: %s' % self.path)
+            return False
+        if data.get('url') != self.url or \
+                data.get('block_size') != self.block_size:
+            log.info('Checkpoint does not match this download, ignoring')
+            return False
+        self.digests = data.get('digests', [])
+        return True
+
+    def save(self):
+        data = dict(
+            url=self.url, block_size=self.block_size, digests=self.digests)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as fp:
+            json.dump(data, fp)
+        os.rename(temp_path, self.path)
+
+    def truncate(self, offset):
+        """Forget anything recorded past offset"""
+        self.digests = self.digests[:offset // self.block_size]
+        self._block = hashlib.new(self.hash_method)
+        self._block_count = 0
+
+    def reset(self):
+        self.truncate(0)
+
+    def update(self, data):
+        """Account for data written to the file
+
+        :return: True when new blocks were completed and the checkpoint
+            should be saved
+        """
+        completed = False
+        while data:
+            needed = self.block_size - self._block_count
+            self._block.update(data[:needed])
+            self._block_count += len(data[:needed])
+            data = data[needed:]
+            if self._block_count == self.block_size:
+                self.digests.append(self._block.hexdigest())
+                self._block = hashlib.new(self.hash_method)
+                self._block_count = 0
+                completed = True
+        return completed
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
@@ -15,6 +15,10 @@ def find_root(layout):
             if logical_volume.mount_point == '/':
                 return logical_volume
 
+    for subvolume in layout.subvolumes:
+        if subvolume.mount_point == '/':
+            return subvolume
+
 
 def kexec(kernel, initrd, layout, kernel_type='bzImage', append=None):
     root_container = find_root(layout)
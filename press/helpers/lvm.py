@@ -2,8 +2,11 @@
 Original Author: Jeff Ness
 """
 
+import json
 import logging
 
+from six import string_types
+
 from press.helpers.cli import run
 
 log = logging.getLogger(__name__)
@@ -73,20 +76,28 @@ class LVM(object):
     def bytestring(bytes):
         return '%dB' % bytes
 
-    def pvcreate(self, physical_volume):
+    @staticmethod
+    def __join(physical_volumes):
+        if isinstance(physical_volumes, string_types):
+            return physical_volumes
+        return ' '.join(physical_volumes)
+
+    def pvcreate(self, physical_volumes):
         """
-        Create a physical volume using pvcreate command line tool.
+        Create one or several physical volumes using a single pvcreate.
         """
-        log.info('Creating physical volume: %s' % physical_volume)
-        command = 'pvcreate --force %s' % physical_volume
+        physical_volumes = self.__join(physical_volumes)
+        log.info('Creating physical volume: %s' % physical_volumes)
+        command = 'pvcreate --force %s' % physical_volumes
         return self.__execute(command)
 
-    def pvremove(self, physical_volume):
+    def pvremove(self, physical_volumes):
         """
-        Delete a physical volume using pvcreate command line tool.
+        Delete one or several physical volumes using a single pvremove.
         """
-        log.info('running pvremove')
-        command = 'pvremove --force --force --yes %s' % physical_volume
+        physical_volumes = self.__join(physical_volumes)
+        log.info('Removing physical volume: %s' % physical_volumes)
+        command = 'pvremove --force --force --yes %s' % physical_volumes
         return self.__execute(command)
 
     def pvdisplay(self, physical_volume=''):
@@ -144,17 +155,82 @@ class LVM(object):
             return False
         return True
 
-    def lvcreate(self, extents, vg_name, lv_name):
+    def lvcreate(self, extents, vg_name, lv_name, stripes=None,
+                 stripe_size=None, physical_volumes=None, options=''):
         """
         Create a logical volume using lvcreate command line tool.
+
+        :param stripes: stripe the volume across this many physical volumes
+        :param stripe_size: bytes
+        :param physical_volumes: allocate from these devices only
+        :param options: additional lvcreate options
         """
         log.info('Creating Volume Group: %s, Extents: %s, VG: %s' %
                  (lv_name, extents, vg_name))
-        create_command = 'lvcreate --yes --extents %s -n %s %s' % (extents,
-                                                                   lv_name,
-                                                                   vg_name)
+        if stripes:
+            options += ' --stripes %d' % stripes
+            if stripe_size:
+                options += ' --stripesize %dk' % (stripe_size // 1024)
+        create_command = 'lvcreate --yes --extents %s%s -n %s %s' % (
+            extents, options, lv_name, vg_name)
+        if physical_volumes:
+            create_command += ' %s' % self.__join(physical_volumes)
+        self.__execute(create_command)
+
+    def lvcreate_thin_pool(self, extents, vg_name, pool_name,
+                           metadata_size=None, chunk_size=None, zero=None,
+                           **kwargs):
+        """
+        Create a thin pool, see lvcreate for striping options
+
+        :param metadata_size: bytes
+        :param chunk_size: bytes
+        :param zero: zero newly provisioned blocks
+        """
+        options = ' --type thin-pool'
+        if metadata_size:
+            options += ' --poolmetadatasize %db' % metadata_size
+        if chunk_size:
+            options += ' --chunksize %dk' % (chunk_size // 1024)
+        if zero is not None:
+            options += ' --zero %s' % (zero and 'y' or 'n')
+        self.lvcreate(extents, vg_name, pool_name, options=options, **kwargs)
+
+    def lvcreate_thin(self, size, vg_name, pool_name, lv_name):
+        """
+        Create a thin volume, size is virtual and in bytes
+        """
+        log.info('Creating thin volume: %s, Size: %s, Pool: %s/%s' %
+                 (lv_name, size, vg_name, pool_name))
+        create_command = 'lvcreate --yes --virtualsize %db --thin -n %s %s/%s' \
+                         % (size, lv_name, vg_name, pool_name)
         self.__execute(create_command)
 
+    def lvcreate_cache_pool(self, extents, vg_name, pool_name, chunk_size,
+                            metadata_size, physical_volumes):
+        """
+        Create a cache pool on the given, faster, physical volumes
+
+        :param chunk_size: bytes
+        :param metadata_size: bytes
+        """
+        options = ' --type cache-pool --chunksize %dk --poolmetadatasize %db' \
+                  % (chunk_size // 1024, metadata_size)
+        self.lvcreate(extents, vg_name, pool_name,
+                      physical_volumes=physical_volumes, options=options)
+
+    def lvconvert_cache(self, vg_name, lv_name, pool_name,
+                        mode='writethrough'):
+        """
+        Attach a cache pool to a logical volume, the pool becomes hidden
+        """
+        log.info('Caching %s/%s with %s, mode: %s' %
+                 (vg_name, lv_name, pool_name, mode))
+        command = 'lvconvert --yes --type cache --cachemode %s ' \
+                  '--cachepool %s/%s %s/%s' % (mode, vg_name, pool_name,
+                                               vg_name, lv_name)
+        self.__execute(command)
+
     def lvdisplay(self, combined_label=''):
         """
         Display a logical volume using lvdisplay command line tool.
@@ -180,28 +256,61 @@ class LVM(object):
         return self.vgchange('-a y %s' % volume_group)
 
     @staticmethod
-    def get_volume_groups():
+    def report(command, fields):
         """
-        :return: A list of volume group names
+        Query LVM state with a single pvs, vgs or lvs
+
+        The json report format is used when available, older LVM versions
+        fall back to parsing separated columns. Sizes are in bytes.
+
+        :param command: pvs, vgs or lvs
+        :param fields: list of field names, pv_name, vg_size...
+        :return: a list of dicts, by field name
         """
-        command = 'vgs --noheadings --rows -o vg_name'
-        out = run(command, raise_exception=False)
-        if out.returncode:
-            return list()
-        if not out.stdout:
+        options = '--units b --nosuffix -o %s' % ','.join(fields)
+        out = run('%s --reportformat json %s' % (command, options),
+                  ignore_error=True, quiet=True)
+        if not out.returncode:
+            try:
+                report = json.loads(out.stdout)['report']
+            except (ValueError, KeyError):
+                log.debug('Could not parse %s report: %s' % (command, out))
+            else:
+                rows = list()
+                for section in report:
+                    # pvs -> pv, vgs -> vg, lvs -> lv
+                    rows.extend(section.get(command[:-1], list()))
+                return rows
+
+        out = run('%s --noheadings --separator : %s' % (command, options),
+                  raise_exception=False)
+        if out.returncode or not out.stdout:
             return list()
-        return [vg.strip() for vg in out.splitlines()]
+        return [dict(zip(fields, line.strip().split(':')))
+                for line in out.splitlines() if line.strip()]
 
-    @staticmethod
-    def get_physical_volumes():
+    @classmethod
+    def get_volume_groups(cls):
+        """
+        :return: A list of volume group names
+        """
+        return [row['vg_name'] for row in cls.report('vgs', ['vg_name'])]
+
+    @classmethod
+    def get_physical_volumes(cls):
         """
 
         :return: A list of physical volume names
         """
-        command = 'pvs --noheadings --rows -o pv_name'
-        out = run(command, raise_exception=False)
-        if out.returncode:
-            return list()
-        if not out.stdout:
-            return list()
-        return [pv.strip() for pv in out.splitlines()]
+        return [row['pv_name'] for row in cls.report('pvs', ['pv_name'])]
+
+    @classmethod
+    def get_logical_volumes(cls, vg_name=None):
+        """
+        :param vg_name: only return the volumes of this group
+        :return: A list of dicts with lv_name, vg_name, lv_size and lv_path
+        """
+        volumes = cls.report('lvs', ['lv_name', 'vg_name', 'lv_size',
+                                     'lv_path'])
+        return [volume for volume in volumes
+                if vg_name is None or volume['vg_name'] == vg_name]
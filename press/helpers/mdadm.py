@@ -4,6 +4,7 @@ simple mdadm command wrapper, it doesn't support much. Software RAID? really?
 
 import logging
 import os
+from press.helpers import mdstat
 from press.helpers.cli import run, find_in_path
 
 log = logging.getLogger(__name__)
@@ -38,20 +39,42 @@ class MDADM(object):
         return result
 
     def create(self, device, level, members, name='',
-               metadata=DEFAULT_METADATA):
+               metadata=DEFAULT_METADATA, chunk=None, assume_clean=False,
+               bitmap=None, spares=None, layout=None):
+        """
+        :param chunk: chunk size in bytes, mdadm default when None
+        :param assume_clean: skip the initial resync
+        :param bitmap: internal or none, mdadm default when None
+        :param spares: hot spare devices
+        :param layout: n2, f2... for level 10, left-symmetric... for 5 and 6
+        """
         if not name:
             name = os.path.basename(device)
 
         raid_devices = len(members)
+        spares = spares or list()
+        extra_options = ''
+        if spares:
+            extra_options += '--spare-devices=%d ' % len(spares)
+        if layout:
+            extra_options += '--layout=%s ' % layout
+        if chunk:
+            extra_options += '--chunk=%dK ' % (chunk // 1024)
+        if assume_clean:
+            extra_options += '--assume-clean '
+        if bitmap:
+            extra_options += '--bitmap=%s ' % bitmap
 
         command = '-C --level={level} {device} --metadata={metadata} ' \
                   '--raid-devices={raid_devices} --name={name} ' \
-                  '{members}'.format(level=level,
-                                     device=device,
-                                     metadata=metadata,
-                                     raid_devices=raid_devices,
-                                     name=name,
-                                     members=' '.join(members))
+                  '{extra_options}{members}'.format(level=level,
+                                                   device=device,
+                                                   metadata=metadata,
+                                                   raid_devices=raid_devices,
+                                                   name=name,
+                                                   extra_options=extra_options,
+                                                   members=' '.join(
+                                                       members + spares))
 
         log.info('Creating software RAID: %s [%s]' % (device,
                                                       ', '.join(members)))
@@ -83,38 +106,15 @@ class MDADM(object):
         return self.run_mdadm(command)
 
     @staticmethod
-    def info():
-        try:
-            with open('/proc/mdstat') as fp:
-                return fp.read()
-        except IOError:
-            return ''
-
-    def _get_mdstat_line(self, device):
-        info = self.info()
-        if not info:
-            return False
-
-        entries = self.info().split('\n\n')
-
-        for entry in entries:
-            for line in entry.split('\n'):
-                if line.find(os.path.basename(device)) == 0:
-                    return line
-
-    def is_present(self, device):
-        return bool(self._get_mdstat_line(device))
-
-    def get_members(self, device):
-        line = self._get_mdstat_line(device)
-        detail = line.split(':')[1]
-        log.debug('detail0: ' + detail + ' ' + line)
-        if detail.split()[0] == 'inactive':
-            members = detail.split()[1:]
-        else:
-            members = detail.split()[2:]
+    def is_present(device):
+        return mdstat.get_array(device) is not None
+
+    @staticmethod
+    def get_members(device):
+        array = mdstat.get_array(device)
+        members = [member.devname for member in array.members]
         log.debug('members: %s' % members)
-        return ['/dev/%s' % x.split('[')[0] for x in members]
+        return members
 
 
 if __name__ == '__main__':
@@ -122,7 +122,7 @@ if __name__ == '__main__':
     from press.helpers.parted import PartedInterface
     mdadm = MDADM()
 
-    mdadm.info()
+    print(mdstat.read_mdstat())
 
     pi = PartedInterface(device='/dev/loop0')
     pi.wipe_table()
@@ -140,7 +140,7 @@ if __name__ == '__main__':
     print(result)
     print(result.stderr)
 
-    mdadm.info()
+    print(mdstat.read_mdstat())
 
     input('Press Enter...')
 
@@ -151,4 +151,4 @@ if __name__ == '__main__':
     mdadm.zero_superblock('/dev/loop0')
     mdadm.zero_superblock('/dev/loop1')
 
-    mdadm.info()
+    print(mdstat.read_mdstat())
@@ -0,0 +1,266 @@
+"""
+A model of /proc/mdstat and /sys/block/mdX/md, used to wait for arrays to
+become ready or to go away rather than sleeping
+
+https://www.kernel.org/doc/Documentation/md.txt
+"""
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+
+from press.helpers.sysfs_info import append_sys, parse_cookie
+
+log = logging.getLogger(__name__)
+
+MDSTAT = '/proc/mdstat'
+
+# array_state values in which the array accepts I/O
+READY_STATES = ('clean', 'active', 'active-idle', 'write-pending',
+                'read-auto')
+FAILED_STATES = ('broken', )
+
+ARRAY_LINE = re.compile(
+    r'^(?P<name>md\S+) : (?P<state>active|inactive)'
+    r'(?: \((?P<mode>[^)]+)\))?(?P<rest>.*)$')
+STATUS_LINE = re.compile(
+    r'^\s+(?P<blocks>\d+) blocks.*?'
+    r'(?:\[(?P<raid_disks>\d+)/(?P<active_disks>\d+)\] \[(?P<status>[U_]+)\])?'
+    r'\s*$')
+PROGRESS_LINE = re.compile(
+    r'(?P<action>resync|recovery|reshape|check|repair)\s*=\s*'
+    r'(?:(?P<progress>[\d.]+)%.*?finish=(?P<finish>\S+)'
+    r' speed=(?P<speed>\S+)|(?P<delayed>DELAYED|PENDING))')
+MEMBER = re.compile(r'^(?P<name>[^\[]+)\[(?P<index>\d+)\](?P<flags>.*)$')
+
+
+class MDStatException(Exception):
+    pass
+
+
+class MDMember(object):
+
+    def __init__(self, name, index, flags=''):
+        """
+        :param name: kernel name, sda1
+        :param index: role in the array
+        :param flags: (F) faulty, (S) spare, (W) write mostly, (R) replacement
+        """
+        self.name = name
+        self.index = index
+        self.faulty = '(F)' in flags
+        self.spare = '(S)' in flags
+
+    @property
+    def devname(self):
+        return '/dev/%s' % self.name
+
+    def __repr__(self):
+        return '%s[%d]%s%s' % (self.name, self.index,
+                               self.faulty and '(F)' or '',
+                               self.spare and '(S)' or '')
+
+
+class MDArray(object):
+
+    def __init__(self, name, active, read_only=False, level=None,
+                 members=None):
+        self.name = name
+        self.active = active
+        self.read_only = read_only
+        self.level = level
+        self.members = members or list()
+        self.blocks = None
+        self.raid_disks = None
+        self.active_disks = None
+        self.status = None
+        self.sync_action = None
+        self.progress = None
+        self.finish = None
+        self.speed = None
+        self.array_state = None
+        self.degraded = None
+
+    @property
+    def devname(self):
+        return '/dev/%s' % self.name
+
+    @property
+    def failed_members(self):
+        return [member for member in self.members if member.faulty]
+
+    @property
+    def ready(self):
+        if not self.active:
+            return False
+        if self.array_state is None:
+            # sysfs not populated yet
+            return False
+        return self.array_state in READY_STATES
+
+    @property
+    def failed(self):
+        return self.array_state in FAILED_STATES or bool(
+            self.failed_members)
+
+    def read_sysfs(self):
+        """Update the array with the attributes in /sys/block/mdX/md"""
+        path = append_sys(os.path.join('block', self.name, 'md'))
+        if not os.path.isdir(path):
+            return
+
+        def attribute(name):
+            return parse_cookie(os.path.join(path, name)) or None
+
+        self.array_state = attribute('array_state')
+        self.sync_action = attribute('sync_action') or self.sync_action
+        degraded = attribute('degraded')
+        if degraded and degraded.isdigit():
+            self.degraded = int(degraded)
+
+    def __repr__(self):
+        out = '%s: %s %s %s' % (self.name, self.array_state or
+                                (self.active and 'active' or 'inactive'),
+                                self.level or '', self.members)
+        if self.progress is not None:
+            out += ' %s %.1f%%' % (self.sync_action, self.progress)
+        return out
+
+
+def parse_mdstat(text):
+    """
+    :param text: contents of /proc/mdstat
+    :return: OrderedDict of MDArray objects, by name
+    """
+    arrays = OrderedDict()
+    array = None
+    for line in text.splitlines():
+        match = ARRAY_LINE.match(line)
+        if match:
+            tokens = match.group('rest').split()
+            level = None
+            if tokens and '[' not in tokens[0]:
+                level = tokens.pop(0)
+            members = list()
+            for token in tokens:
+                member = MEMBER.match(token)
+                if member:
+                    members.append(MDMember(member.group('name'),
+                                            int(member.group('index')),
+                                            member.group('flags')))
+            mode = match.group('mode') or ''
+            array = MDArray(match.group('name'),
+                            active=match.group('state') == 'active',
+                            read_only='read-only' in mode,
+                            level=level,
+                            members=members)
+            arrays[array.name] = array
+            continue
+        if not line.strip():
+            array = None
+            continue
+        if array is None:
+            continue
+
+        match = STATUS_LINE.match(line)
+        if match and array.blocks is None:
+            array.blocks = int(match.group('blocks'))
+            if match.group('raid_disks'):
+                array.raid_disks = int(match.group('raid_disks'))
+                array.active_disks = int(match.group('active_disks'))
+                array.status = match.group('status')
+            continue
+
+        match = PROGRESS_LINE.search(line)
+        if match:
+            array.sync_action = match.group('action')
+            if match.group('progress'):
+                array.progress = float(match.group('progress'))
+                array.finish = match.group('finish')
+                array.speed = match.group('speed')
+    return arrays
+
+
+def read_mdstat():
+    try:
+        with open(MDSTAT) as fp:
+            return fp.read()
+    except IOError:
+        return ''
+
+
+def get_arrays():
+    """
+    :return: OrderedDict of MDArray objects, updated from sysfs
+    """
+    arrays = parse_mdstat(read_mdstat())
+    for array in arrays.values():
+        array.read_sysfs()
+    return arrays
+
+
+def get_array(device):
+    """
+    :param device: /dev/md0 or md0
+    :return: MDArray or None
+    """
+    return get_arrays().get(os.path.basename(device))
+
+
+def write_md_attribute(device, name, value):
+    """
+    :param device: /dev/md0
+    :param name: an attribute in /sys/block/mdX/md, sync_speed_max
+    """
+    path = append_sys(os.path.join('block', os.path.basename(device), 'md',
+                                   name))
+    log.debug('Writing %s to %s' % (value, path))
+    try:
+        with open(path, 'w') as fp:
+            fp.write('%s\n' % value)
+    except IOError as e:
+        raise MDStatException('Could not write %s: %s' % (path, e))
+
+
+def wait_for_array(device, timeout=30, poll_interval=0.1):
+    """Wait for a new array to accept I/O
+
+    :param device: /dev/md0
+    :param timeout: seconds
+    :raises MDStatException: if the array failed, or is not ready after
+        timeout seconds
+    :return: MDArray
+    """
+    deadline = time.time() + timeout
+    while True:
+        array = get_array(device)
+        if array:
+            if array.failed:
+                raise MDStatException('%s has failed: %s' % (device, array))
+            if array.ready and os.path.exists(device):
+                log.info('%s is ready: %s' % (device, array))
+                return array
+        if time.time() > deadline:
+            raise MDStatException('%s is not ready after %ds: %s' %
+                                  (device, timeout, array or 'not present'))
+        time.sleep(poll_interval)
+
+
+def wait_for_stop(device, timeout=30, poll_interval=0.1):
+    """Wait for a stopped array to be released by the kernel, so that its
+    members can be reused
+
+    :raises MDStatException: if the array is still present after timeout
+        seconds
+    """
+    deadline = time.time() + timeout
+    while True:
+        array = get_array(device)
+        if not array:
+            log.debug('%s is stopped' % device)
+            return
+        if time.time() > deadline:
+            raise MDStatException('%s is still present after %ds: %s' %
+                                  (device, timeout, array))
+        time.sleep(poll_interval)
@@ -13,13 +13,19 @@ class PartedInterface(object):
     constraint. pyparted is not documented and messy.
 
     Once I can use libparted directly, I will move to that.
+
+    The output of parted print is cached until the table is modified. In
+    batch mode (begin_batch), modifications are queued instead of being run,
+    and applied by commit() in a single parted invocation. While batching,
+    the table is read from an in-memory model of the queued changes.
     """
 
     def __init__(self,
                  device,
                  parted_path='parted',
                  partition_start=1048576,
-                 alignment=1048576):
+                 alignment=1048576,
+                 alignment_offset=0):
         self.parted_path = parted_path
         if not find_in_path(self.parted_path):
             raise PartedInterfaceException(
@@ -27,8 +33,13 @@ class PartedInterface(object):
         self.device = device
         self.partition_start = partition_start
         self.alignment = alignment
+        self.alignment_offset = alignment_offset
 
         self.parted = self.parted_path + ' --script ' + self.device + ' unit b '
+        self._table = None
+        self._batch = None
+        self._batch_label = None
+        self._batch_partitions = None
         #  Try to store the label, so that we'll raise a NullDiskException if we can't
         self.init_label = self.get_label()
         self.sector_size = self._get_sector_size()
@@ -50,6 +61,8 @@ class PartedInterface(object):
         parted does not use meaningful return codes. It pretty much returns 1 on
         any error and then prints an error message on to standard error stream.
         """
+        if command != 'print':
+            self.invalidate()
         result = run(
             self.parted + command, ignore_error=ignore_error, quiet=quiet)
         if result and raise_on_error:
@@ -62,11 +75,74 @@ class PartedInterface(object):
         fs_type_alias = ' {} '.format(fs_type) if fs_type else ' '
         command = 'mkpart {}{}{} {}'.format(type_or_name, fs_type_alias,
                                             start, end)
+        return self.execute(command)
+
+    def invalidate(self):
+        """Forget the cached table, called whenever the disk is modified"""
+        self._table = None
+
+    @property
+    def batching(self):
+        return self._batch is not None
+
+    def execute(self, command):
+        """Run a command modifying the table, or queue it when batching"""
+        if self.batching:
+            log.debug('Queuing: %s' % command)
+            self._batch.append(command)
+            return
         return self.run_parted(command)
 
+    def begin_batch(self):
+        """Queue modifications until commit() is called"""
+        self._batch_label = self.get_label()
+        self._batch_partitions = self.partitions
+        self._batch = list()
+
+    def _record_partition(self, number, start, end, partition_type):
+        """Add a queued partition to the batch model
+
+        The end sector given to mkpart is inclusive, and parted prints the
+        last byte of that sector.
+        """
+        sector_size = self.sector_size['logical']
+        part_info = dict(
+            number=number,
+            start=start,
+            end=(end // sector_size + 1) * sector_size - 1)
+        part_info['size'] = part_info['end'] - start + 1
+        if self._batch_label == 'msdos':
+            part_info['type'] = partition_type
+        self._batch_partitions.append(part_info)
+        self._batch_partitions.sort(key=lambda p: p['number'])
+
+    def commit(self):
+        """Apply queued modifications in a single parted invocation
+
+        The resulting table is compared to the model, so that a partition
+        placed differently than expected is caught before it is used.
+        """
+        commands = self._batch
+        expected = self._batch_partitions
+        self._batch = self._batch_label = self._batch_partitions = None
+        if not commands:
+            return
+
+        log.info('Applying %d queued commands to %s' % (len(commands),
+                                                         self.device))
+        self.run_parted(' '.join(commands))
+
+        actual = [(p['number'], p['start']) for p in self.partitions]
+        if actual != [(p['number'], p['start']) for p in expected]:
+            raise PartedException(
+                'Partition table on %s does not match the expected layout: '
+                '%s' % (self.device, actual))
+
     def get_table(self, raw=False):
-        result = self.run_parted(
-            'print', raise_on_error=False, ignore_error=True, quiet=True)
+        if self._table is None:
+            self._table = self.run_parted(
+                'print', raise_on_error=False, ignore_error=True, quiet=True)
+        result = self._table
         if result.returncode:
             if not result.stderr:
                 #  udev sometimes maps /dev/loop devices before they are linked
@@ -111,6 +187,8 @@ class PartedInterface(object):
         return self._get_info('Disk Flags')
 
     def get_label(self):
+        if self.batching:
+            return self._batch_label
         return self._get_info('Partition Table')
 
     @property
@@ -126,6 +204,9 @@ class PartedInterface(object):
 
     @property
     def partitions(self):
+        if self.batching:
+            return [dict(part) for part in self._batch_partitions]
+
         p = list()
         table = self.get_table(raw=True)
         partition_type = self.get_label()
@@ -179,6 +260,7 @@ class PartedInterface(object):
         """
         command = self.parted + ' rm ' + str(partition_number)
 
+        self.invalidate()
         result = run(command)
 
         if result.returncode != 0:
@@ -194,6 +276,12 @@ class PartedInterface(object):
             self.remove_partition(partition['number'])
 
     def set_label(self, label='gpt'):
+        if self.batching:
+            self.execute('mklabel ' + label)
+            self._batch_label = label
+            self._batch_partitions = list()
+            return
+        self.invalidate()
         result = run(self.parted + ' mklabel ' + label)
         if result.returncode != 0:
             raise PartedException('Could not create filesystem label')
@@ -207,12 +295,12 @@ class PartedInterface(object):
         # The --script command line parser does not work properly, making it necessary to do some
         # silly escaping in order to support gpt partition names with spaces
         # name: BIOS boot partition becomes \'BIOS\ boot\ partition\', like I said, it is silly
-        self.run_parted('name %d \\\'%s\\\'' % (number,
-                                                name.replace(' ', '\\ ')))
+        self.execute('name %d \\\'%s\\\'' % (number,
+                                             name.replace(' ', '\\ ')))
 
     def set_flag(self, number, flag):
         log.info('Setting %s on partition #%d' % (flag, number))
-        self.run_parted('set %d %s on' % (number, flag))
+        self.execute('set %d %s on' % (number, flag))
 
     @property
     def has_label(self):
@@ -257,8 +345,9 @@ class PartedInterface(object):
 
         if last_partition:
             log.debug('Partition end (unmodified): %d' % last_partition['end'])
-            aligned = \
-                last_partition['end'] + (self.alignment - (last_partition['end'] % self.alignment))
+            aligned = last_partition['end'] + (
+                self.alignment - (last_partition['end'] - self.alignment_offset)
+                % self.alignment)
             start = aligned
             partition_number = last_partition['number'] + 1
 
@@ -277,6 +366,9 @@ class PartedInterface(object):
             if not self.extended_partition:
                 self.make_partition('extended', start, table_size - 1,
                                     fs_type=fs_type)
+                if self.batching:
+                    self._record_partition(partition_number, start,
+                                           table_size - 1, 'extended')
                 start += self.partition_start
                 partition_number = 5
 
@@ -295,6 +387,9 @@ class PartedInterface(object):
         else:
             self.make_partition(type_or_name, start, end, fs_type=fs_type)
 
+        if self.batching:
+            self._record_partition(partition_number, start, end, type_or_name)
+
         if label == 'gpt':
             # obviously we need to determine the new partition's id.
             self.set_name(partition_number, type_or_name)
@@ -308,6 +403,7 @@ class PartedInterface(object):
         mbr_bytes = 512
         command = 'dd if=/dev/zero of=%s bs=%d count=1' % (self.device,
                                                            mbr_bytes)
+        self.invalidate()
         run(command)
 
     def remove_gpt(self):
@@ -320,6 +416,7 @@ class PartedInterface(object):
         gpt_bytes = 33792
         command = 'dd if=/dev/zero of=%s bs=%d count=1' % (self.device,
                                                            gpt_bytes)
+        self.invalidate()
         run(command)
 
 
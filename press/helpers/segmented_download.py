@@ -0,0 +1,264 @@
+"""
+Segmented HTTP downloads
+
+The file is split into fixed size byte ranges which are fetched by a pool of
+worker threads, each writing its range in place (pwrite) into a preallocated
+file. The main thread hashes completed ranges in order while the workers are
+still busy with the ranges that follow.
+"""
+import logging
+import os
+import threading
+import time
+
+import requests
+
+# noinspection PyUnresolvedReferences
+from six.moves import queue
+
+log = logging.getLogger(__name__)
+
+# Errors worth reconnecting for, anything else (404, 403...) is final
+RETRYABLE_EXCEPTIONS = (requests.exceptions.ConnectionError,
+                        requests.exceptions.ChunkedEncodingError,
+                        requests.exceptions.Timeout)
+
+
+def retry_delay(attempt, backoff):
+    return backoff * 2**(attempt - 1)
+
+
+class SegmentedDownloadException(Exception):
+    pass
+
+
+class SegmentedDownload(object):
+
+    def __init__(self,
+                 url,
+                 filename,
+                 content_length,
+                 connections=4,
+                 segment_size=67108864,
+                 buffer_size=1048576,
+                 hash_object=None,
+                 proxies=None,
+                 retries=0,
+                 retry_backoff=2,
+                 timeout=60):
+        """
+        :param url: http(s) url, the server must support range requests
+        :param filename: where to write the download
+        :param content_length: total size, as returned by probe()
+        :param connections: number of concurrent range requests
+        :param segment_size: size of each range request
+        :param buffer_size: read size used for both the stream and hashing
+        :param hash_object: a hashlib object, updated in file order
+        :param proxies: requests style proxies dictionary
+        :param retries: how many times in a row an interrupted segment is
+            resumed
+        :param retry_backoff: seconds before the first retry, then doubled
+        :param timeout: seconds to wait on a stalled connection
+        """
+        self.url = url
+        self.filename = filename
+        self.content_length = content_length
+        self.connections = connections
+        self.segment_size = segment_size
+        self.buffer_size = buffer_size
+        self.hash_object = hash_object
+        self.proxies = proxies
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.timeout = timeout
+
+        self.segments = [
+            (start, min(start + segment_size, content_length) - 1)
+            for start in range(0, content_length, segment_size)
+        ]
+        self.completed = [False] * len(self.segments)
+        self.byte_count = 0
+        self.error = None
+
+        self._condition = threading.Condition()
+        self._fd = None
+
+    @staticmethod
+    def supported():
+        return hasattr(os, 'pwrite') and hasattr(os, 'pread')
+
+    @staticmethod
+    def probe(url, proxies=None, timeout=60):
+        """
+        Check that the server advertises byte ranges and a content length
+
+        :param timeout: seconds to wait for the server, a server which does
+            not answer in time is downloaded from with a single connection
+        :return: content length or None if ranges cannot be used
+        """
+        try:
+            res = requests.head(url, proxies=proxies, allow_redirects=True,
+                                timeout=timeout)
+        except requests.RequestException as e:
+            log.debug('HEAD request failed: %s' % e)
+            return None
+
+        if res.status_code != 200:
+            log.debug('HEAD request returned %d' % res.status_code)
+            return None
+
+        if 'bytes' not in res.headers.get('accept-ranges', '').lower():
+            log.debug('Server does not accept byte ranges')
+            return None
+
+        content_length = int(res.headers.get('content-length', '0'))
+        if not content_length:
+            log.debug('Server did not provide a content length')
+            return None
+
+        return content_length
+
+    def _preallocate(self):
+        self._fd = os.open(self.filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC,
+                           0o644)
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self._fd, 0, self.content_length)
+                return
+            except OSError as e:
+                log.debug('fallocate is not supported here: %s' % e)
+        os.ftruncate(self._fd, self.content_length)
+
+    def _fetch_range(self, start, end, callback_func):
+        """
+        :return: offset following the last byte written
+        """
+        headers = {'Range': 'bytes=%d-%d' % (start, end)}
+        res = requests.get(
+            self.url,
+            stream=True,
+            proxies=self.proxies,
+            headers=headers,
+            timeout=self.timeout)
+        res.raise_for_status()
+        if res.status_code != 206:
+            raise SegmentedDownloadException(
+                'Server ignored range request for bytes %d-%d' % (start, end))
+
+        offset = start
+        try:
+            for chunk in res.iter_content(self.buffer_size):
+                if self.error:
+                    break
+                os.pwrite(self._fd, chunk, offset)
+                offset += len(chunk)
+                with self._condition:
+                    self.byte_count += len(chunk)
+                    if callback_func:
+                        callback_func(self.content_length, self.byte_count)
+        except RETRYABLE_EXCEPTIONS as e:
+            e.offset = offset
+            raise
+        return offset
+
+    def _fetch_segment(self, index, callback_func):
+        start, end = self.segments[index]
+        offset = start
+        attempt = 0
+        while True:
+            try:
+                offset = self._fetch_range(offset, end, callback_func)
+                break
+            except RETRYABLE_EXCEPTIONS as e:
+                resumed_at = offset
+                offset = getattr(e, 'offset', offset)
+                if offset > resumed_at:
+                    # the connection made progress, count failures in a row
+                    attempt = 0
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                delay = retry_delay(attempt, self.retry_backoff)
+                log.warning('Segment %d interrupted at %d: %s, retrying in '
+                            '%d seconds (%d/%d)' %
+                            (index, offset, e, delay, attempt, self.retries))
+                time.sleep(delay)
+
+        if self.error:
+            return
+
+        if offset != end + 1:
+            raise SegmentedDownloadException(
+                'Short read on bytes %d-%d, got %d bytes' %
+                (start, end, offset - start))
+
+        with self._condition:
+            self.completed[index] = True
+            self._condition.notify_all()
+
+    def _worker(self, work_queue, callback_func):
+        while not self.error:
+            try:
+                index = work_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                self._fetch_segment(index, callback_func)
+            except Exception as e:
+                log.error('Error downloading segment %d: %s' % (index, e))
+                with self._condition:
+                    self.error = e
+                    self._condition.notify_all()
+                return
+
+    def _hash_segment(self, index):
+        start, end = self.segments[index]
+        offset = start
+        while offset <= end:
+            data = os.pread(self._fd, min(self.buffer_size, end + 1 - offset),
+                            offset)
+            if not data:
+                raise SegmentedDownloadException(
+                    'Unexpected end of file at %d' % offset)
+            self.hash_object.update(data)
+            offset += len(data)
+
+    def run(self, callback_func=None):
+        log.info('Downloading %d bytes in %d segments over %d connections' %
+                 (self.content_length, len(self.segments), self.connections))
+        self._preallocate()
+
+        work_queue = queue.Queue()
+        for index in range(len(self.segments)):
+            work_queue.put(index)
+
+        workers = [
+            threading.Thread(
+                target=self._worker, args=(work_queue, callback_func))
+            for _ in range(min(self.connections, len(self.segments)))
+        ]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        try:
+            for index in range(len(self.segments)):
+                with self._condition:
+                    while not (self.completed[index] or self.error):
+                        self._condition.wait(1)
+                if self.error:
+                    break
+                if self.hash_object is not None:
+                    self._hash_segment(index)
+        except Exception as e:
+            # stop the workers before bailing out
+            with self._condition:
+                self.error = self.error or e
+            raise
+        finally:
+            for worker in workers:
+                worker.join()
+            os.close(self._fd)
+
+        if self.error:
+            raise self.error
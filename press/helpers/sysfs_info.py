@@ -2,7 +2,20 @@
 
 Really horrible class design, rewrite please. Lets say I wasn't invested.
 """
+import fcntl
+import logging
 import os
+import struct
+
+log = logging.getLogger(__name__)
+
+# linux/fs.h
+BLKSSZGET = 0x1268
+BLKPBSZGET = 0x127b
+BLKGETSIZE64 = 0x80081272
+
+GPT_SIGNATURE = b'EFI PART'
+MBR_SIGNATURE = b'\x55\xaa'
 
 
 class SYSFSInfoException(Exception):
@@ -64,6 +77,105 @@ class AlignmentInfo(SysFSInfo):
         return self.magic_set_attr('optimal_io_size')
 
 
+def read_int(path):
+    value = parse_cookie(path)
+    if value.isdigit():
+        return int(value)
+
+
+class BlockDeviceInfo(object):
+    """Geometry, topology and partition table type of a block device
+
+    Everything is gathered in a single pass, from sysfs where the attributes
+    exist and using ioctls on the device node otherwise. The partition table
+    type is detected from the signatures in the first two sectors, which is
+    all parted would tell us about an existing disk.
+
+    https://www.kernel.org/doc/Documentation/ABI/testing/sysfs-block
+    """
+
+    def __init__(self, devname, devpath=None, read_label=True):
+        """
+        :param devname: device node, /dev/sda
+        :param devpath: sysfs path relative to /sys, as udev DEVPATH
+        :param read_label: open the device to detect the partition table
+        """
+        self.devname = devname
+        self.sysfs_path = append_sys(
+            devpath or os.path.join('class/block', os.path.basename(devname)))
+        self.size = None
+        self.logical_block_size = None
+        self.physical_block_size = None
+        self.rotational = None
+        self.alignment_offset = 0
+        self.minimum_io_size = None
+        self.optimal_io_size = 0
+        self.label = None
+        self.read_sysfs()
+        if self.size is None or self.logical_block_size is None or \
+                self.physical_block_size is None:
+            self.read_ioctl()
+        self.minimum_io_size = self.minimum_io_size or self.physical_block_size
+        if read_label and self.size:
+            self.label = self.read_label()
+
+    def read_sysfs(self):
+        def attribute(path):
+            return read_int(os.path.join(self.sysfs_path, path))
+
+        size = attribute('size')
+        # sysfs reports the size in 512 byte units, whatever the sector size
+        if size is not None:
+            self.size = size * 512
+        self.logical_block_size = attribute('queue/logical_block_size')
+        self.physical_block_size = attribute('queue/physical_block_size')
+        rotational = attribute('queue/rotational')
+        if rotational is not None:
+            self.rotational = bool(rotational)
+        self.alignment_offset = attribute('alignment_offset') or 0
+        self.minimum_io_size = attribute('queue/minimum_io_size')
+        self.optimal_io_size = attribute('queue/optimal_io_size') or 0
+
+    def read_ioctl(self):
+        log.debug('Using ioctls to query %s' % self.devname)
+        fd = os.open(self.devname, os.O_RDONLY)
+        try:
+            if self.size is None:
+                self.size = struct.unpack(
+                    'Q', fcntl.ioctl(fd, BLKGETSIZE64, b'\0' * 8))[0]
+            if self.logical_block_size is None:
+                self.logical_block_size = struct.unpack(
+                    'i', fcntl.ioctl(fd, BLKSSZGET, b'\0' * 4))[0]
+            if self.physical_block_size is None:
+                self.physical_block_size = struct.unpack(
+                    'I', fcntl.ioctl(fd, BLKPBSZGET, b'\0' * 4))[0]
+        finally:
+            os.close(fd)
+
+    def read_label(self):
+        """
+        :return: gpt, msdos or None when the disk has no partition table
+        """
+        sector_size = self.logical_block_size or 512
+        try:
+            with open(self.devname, 'rb') as device:
+                data = device.read(sector_size * 2)
+        except (IOError, OSError) as e:
+            log.warning('Could not read the label of %s: %s' %
+                        (self.devname, e))
+            return None
+        if data[sector_size:sector_size + 8] == GPT_SIGNATURE:
+            return 'gpt'
+        if data[510:512] == MBR_SIGNATURE:
+            return 'msdos'
+        return None
+
+    def __repr__(self):
+        return '%s: %s bytes, %s/%s' % (self.devname, self.size,
+                                        self.logical_block_size,
+                                        self.physical_block_size)
+
+
 class NetDeviceInfo(SysFSInfo):
     """
     https://www.kernel.org/doc/Documentation/ABI/testing/sysfs-class-net
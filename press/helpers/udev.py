@@ -7,8 +7,13 @@ pyudev can be kind of silly, but I certainly don't feel like wrapping my own.
 """
 import logging
 import os
+import time
+
 import pyudev
 
+from press.exceptions import PhysicalDiskException
+from press.helpers.cli import run
+
 log = logging.getLogger(__name__)
 
 
@@ -17,12 +22,15 @@ class UDevHelper(object):
     def __init__(self):
         self.context = pyudev.Context()
 
-    def get_monitor(self):
+    @staticmethod
+    def get_monitor():
         """
-        Because filters cannot be removed
+        Because filters cannot be removed. Each monitor gets its own context,
+        libudev contexts are not thread safe and monitors may be used from
+        several threads at once.
         :return: fresh pyudev.Monitor
         """
-        return pyudev.Monitor.from_netlink(self.context)
+        return pyudev.Monitor.from_netlink(pyudev.Context())
 
     def get_partitions(self):
         return self.context.list_devices(subsystem='block', DEVTYPE='partition')
@@ -46,6 +54,19 @@ class UDevHelper(object):
             return None
         return udisk
 
+    def get_disk_devname(self, devname):
+        """
+        Resolve a partition, or a link to one, to the disk it lives on
+
+        :return: the disk's devname, devname itself if it is a disk, or None
+        """
+        device = self.get_device_by_name(os.path.realpath(devname))
+        if not device:
+            return None
+        if device.device_type == 'partition':
+            device = device.find_parent('block', 'disk')
+        return device and str(device.device_node)
+
     def discover_valid_storage_devices(self, fc_enabled=False, nvme_enabled=True, loop_only=False):
         """
         Kind of ugly, but gets the job done. It strips devices we don't
@@ -109,6 +130,75 @@ class UDevHelper(object):
                     'ID_PART_ENTRY_NUMBER') == str(partition_id):
                 return str(device['DEVNAME'])
 
+    @staticmethod
+    def find_partition_in_sysfs(disk_devname, partition_id):
+        """
+        :return: the partition device node, once the kernel knows about it
+            and the node exists, otherwise None
+        """
+        disk_name = os.path.basename(os.path.realpath(disk_devname))
+        sysfs_path = os.path.join('/sys/class/block', disk_name)
+        if not os.path.isdir(sysfs_path):
+            return None
+        for name in os.listdir(sysfs_path):
+            partition_file = os.path.join(sysfs_path, name, 'partition')
+            if not os.path.isfile(partition_file):
+                continue
+            with open(partition_file) as fp:
+                if fp.read().strip() != str(partition_id):
+                    continue
+            devname = os.path.join('/dev', name)
+            if os.path.exists(devname):
+                return devname
+        return None
+
+    def wait_for_partition(self,
+                           monitor,
+                           disk_devname,
+                           partition_id,
+                           timeout=30,
+                           poll_interval=0.5):
+        """
+        Wait for a new partition to show up
+
+        The monitor must be started before the partition table is modified.
+        sysfs is the source of truth, uevents only wake us up early. Only the
+        partitions of disk_devname are looked at, so monitors waiting on
+        different disks can run concurrently without mixing events. Polling
+        is done in short slices, so a missed event costs poll_interval at
+        most. Half way through the timeout, partx is asked to add the
+        partition to the kernel (BLKPG), in case the table was not re-read.
+
+        :param monitor: a started pyudev.Monitor
+        :param disk_devname: the disk the partition was created on
+        :param partition_id: partition number
+        :param timeout: seconds to wait before giving up
+        :param poll_interval: maximum time between two sysfs checks
+        :return: partition device node
+        """
+        start = time.time()
+        rescanned = False
+        while True:
+            devname = self.find_partition_in_sysfs(disk_devname, partition_id)
+            if devname:
+                log.debug('Found %s after %.2f seconds' %
+                          (devname, time.time() - start))
+                return devname
+
+            elapsed = time.time() - start
+            if elapsed >= timeout:
+                raise PhysicalDiskException(
+                    'Timed out waiting for partition %d on %s' %
+                    (partition_id, disk_devname))
+
+            if not rescanned and elapsed >= timeout / 2.0:
+                log.warning('Partition %d on %s has not appeared, asking '
+                            'partx to add it' % (partition_id, disk_devname))
+                run('partx -a --nr %d %s' % (partition_id, disk_devname))
+                rescanned = True
+
+            monitor.poll(timeout=min(poll_interval, timeout - elapsed))
+
     def get_network_devices(self):
         """ Returns a list of all network(ethernet/type 1] devices found on the system. """
 
@@ -123,6 +213,58 @@ class UDevHelper(object):
         result.sort(key=lambda dev: dev.sys_name)
         return result
 
+    @staticmethod
+    def find_volumes(vg_name, lv_names):
+        """
+        :return: dict of processed device mapper devices, by logical volume
+            name
+        """
+        devices = pyudev.Context().list_devices(subsystem='block')
+        found = dict()
+        for device in devices.match_property('DM_VG_NAME', vg_name):
+            lv_name = device.get('DM_LV_NAME')
+            if lv_name in lv_names and device.get('DEVNAME'):
+                found[lv_name] = device
+        return found
+
+    def wait_for_volumes(self,
+                         monitor,
+                         vg_name,
+                         lv_names,
+                         timeout=30,
+                         poll_interval=0.5):
+        """
+        Wait for several new logical volumes at once
+
+        The monitor must be started before the volumes are created. The udev
+        database is the source of truth, a device is found once udev has
+        processed it and created its links. uevents only wake us up early.
+
+        :param monitor: a started pyudev.Monitor
+        :param vg_name: the volume group of the volumes
+        :param lv_names: logical volume names
+        :param timeout: seconds to wait before giving up
+        :param poll_interval: maximum time between two udev queries
+        :return: dict of pyudev devices, by logical volume name
+        """
+        monitor.filter_by('block')
+        start = time.time()
+        while True:
+            found = self.find_volumes(vg_name, lv_names)
+            missing = set(lv_names) - set(found)
+            if not missing:
+                log.debug('Found %d volumes of %s after %.2f seconds' %
+                          (len(found), vg_name, time.time() - start))
+                return found
+
+            elapsed = time.time() - start
+            if elapsed >= timeout:
+                raise PhysicalDiskException(
+                    'Timed out waiting for %s: %s' %
+                    (vg_name, ', '.join(sorted(missing))))
+
+            monitor.poll(timeout=min(poll_interval, timeout - elapsed))
+
     @staticmethod
     def monitor_for_volume(monitor, lv_name):
         monitor.filter_by('block')
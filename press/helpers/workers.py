@@ -0,0 +1,57 @@
+"""
+Run independent operations concurrently, using threads. Layout operations
+spend their time in subprocesses (parted, mkfs...) and waiting on the kernel,
+so the GIL is not a concern.
+"""
+import logging
+import sys
+import threading
+
+import six
+# noinspection PyUnresolvedReferences
+from six.moves import queue
+
+log = logging.getLogger(__name__)
+
+
+def run_parallel(func, items, max_workers=0):
+    """Call func(item) for every item, on up to max_workers threads
+
+    Once a call has failed, no new call is started. Calls in progress are
+    waited upon, then the first exception is raised again.
+
+    :param func: callable taking a single item
+    :param items: an iterable of items
+    :param max_workers: maximum number of threads, 0 means one per item
+    :return: the results, in the order of items
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = list()
+    work_queue = queue.Queue()
+    for index, item in enumerate(items):
+        work_queue.put((index, item))
+
+    def worker():
+        while not errors:
+            try:
+                index, item = work_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception:
+                log.error('Error while processing %s' % item)
+                errors.append(sys.exc_info())
+
+    thread_count = min(max_workers or len(items), len(items))
+    threads = [threading.Thread(target=worker) for _ in range(thread_count)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        six.reraise(*errors[0])
+    return results
@@ -1,11 +1,20 @@
 import logging
 
+try:
+    from math import gcd
+except ImportError:
+    from fractions import gcd
+
 from press.exceptions import PartitionValidationError
 from size import Size, PercentString
 
 GPT = 'gpt'
 MSDOS = 'msdos'
 GPT_BACKUP_SIZE = 17408
+AUTO = 'auto'
+DEFAULT_ALIGNMENT = 1048576
+# Larger values reported by devices are bogus, or not worth the lost space
+MAXIMUM_ALIGNMENT = 67108864
 
 log = logging.getLogger(__name__)
 
@@ -18,8 +27,21 @@ class Disk(object):
                  devpath=None,
                  partition_table=None,
                  size=0,
-                 sector_size=512):
+                 sector_size=512,
+                 physical_sector_size=None,
+                 rotational=None,
+                 alignment_offset=0,
+                 minimum_io_size=None,
+                 optimal_io_size=0,
+                 label=None):
         """
+        :param sector_size: logical sector size
+        :param physical_sector_size: defaults to sector_size
+        :param rotational: None when unknown
+        :param alignment_offset: offset of the first aligned sector, in bytes
+        :param minimum_io_size: defaults to physical_sector_size
+        :param optimal_io_size: 0 when the device does not report one
+        :param label: the partition table found on the disk, gpt or msdos
         """
         self.devname = devname
         self.devlinks = devlinks or list()
@@ -27,19 +49,115 @@ class Disk(object):
         self.size = Size(size)
         self.partition_table = partition_table
         self.sector_size = sector_size
+        self.physical_sector_size = physical_sector_size or sector_size
+        self.rotational = rotational
+        self.alignment_offset = alignment_offset
+        self.minimum_io_size = minimum_io_size or self.physical_sector_size
+        self.optimal_io_size = optimal_io_size
+        self.label = label
+
+    @property
+    def io_size(self):
+        """The I/O size reported by the device: the stripe size of RAID
+        volumes, the optimal I/O size of NVMe drives or the physical sector
+        size. An optimal_io_size which is not a multiple of minimum_io_size is
+        bogus, some USB bridges report one.
+        """
+        if self.optimal_io_size and \
+                not self.optimal_io_size % self.minimum_io_size:
+            return self.optimal_io_size
+        return self.minimum_io_size
+
+    @property
+    def stripe_geometry(self):
+        """Hardware RAID volumes report their chunk as minimum_io_size and
+        their full stripe as optimal_io_size
+
+        :return: (chunk size, data disks), or None if the device is not striped
+        """
+        if self.minimum_io_size <= self.physical_sector_size or \
+                self.optimal_io_size <= self.minimum_io_size or \
+                self.optimal_io_size % self.minimum_io_size:
+            return None
+        return (self.minimum_io_size,
+                self.optimal_io_size // self.minimum_io_size)
+
+    def topology_alignment(self, minimum=DEFAULT_ALIGNMENT):
+        """The smallest multiple of minimum which is also a multiple of the
+        device I/O size
+        """
+        io_size = self.io_size
+        alignment = minimum * io_size // gcd(minimum, io_size)
+        if alignment > MAXIMUM_ALIGNMENT:
+            log.warning('%s: ignoring I/O size %d, alignment would be %d' %
+                        (self.devname, io_size, alignment))
+            return minimum
+        return alignment
+
+    @staticmethod
+    def align(offset, alignment, alignment_offset=0):
+        """Round offset up to the next aligned offset"""
+        return offset + (alignment_offset - offset) % alignment
+
+    def validate_alignment(self, partition_start, alignment,
+                           alignment_offset=0):
+        """Partitions must start on a logical sector, and should start on an
+        I/O size boundary
+
+        :raises PartitionValidationError: if partitions would not start on a
+            logical sector
+        """
+        for name, value in (('partition_start', partition_start),
+                            ('alignment', alignment)):
+            if value % self.sector_size:
+                raise PartitionValidationError(
+                    '%s of %s is not a multiple of the %d bytes sector size' %
+                    (name, self.devname, self.sector_size))
+
+        io_size = self.io_size
+        if alignment % io_size or \
+                (partition_start - self.alignment_offset) % io_size:
+            log.warning('%s: partitions will not be aligned to the %d bytes '
+                        'I/O size, with an alignment offset of %d. Consider '
+                        'using alignment: auto' %
+                        (self.devname, io_size, self.alignment_offset))
+        elif alignment_offset != self.alignment_offset:
+            log.warning('%s: partitions will not be aligned, the device '
+                        'alignment offset is %d' %
+                        (self.devname, self.alignment_offset))
 
     def new_partition_table(self,
                             table_type,
                             partition_start=1048576,
                             alignment=1048576):
         """Instantiate and link a PartitionTable object to Disk instance
+
+        :param partition_start: offset of the first partition, or auto to
+            start at the first aligned offset after 1MiB
+        :param alignment: partitions are aligned to this boundary, or auto to
+            derive it from the device topology
         """
+        alignment_offset = 0
+        if AUTO in (partition_start, alignment):
+            alignment_offset = self.alignment_offset
+        if alignment == AUTO:
+            alignment = self.topology_alignment()
+        alignment = Size(alignment).bytes
+        if partition_start == AUTO:
+            partition_start = self.align(DEFAULT_ALIGNMENT, alignment,
+                                         alignment_offset)
+        partition_start = Size(partition_start).bytes
+        self.validate_alignment(partition_start, alignment, alignment_offset)
+        log.info('%s: first partition at %d, alignment %d, offset %d' %
+                 (self.devname, partition_start, alignment, alignment_offset))
+
         self.partition_table = PartitionTable(
             table_type,
             self.size.bytes,
             partition_start=partition_start,
             alignment=alignment,
-            sector_size=self.sector_size)
+            sector_size=self.sector_size,
+            alignment_offset=alignment_offset)
 
     def __repr__(self):
         return '%s: %s' % (self.devname, self.size.humanize)
@@ -52,8 +170,12 @@ class PartitionTable(object):
                  size,
                  partition_start=1048576,
                  alignment=1048576,
-                 sector_size=512):
+                 sector_size=512,
+                 alignment_offset=0):
         """Logical representation of a partition
+
+        :param alignment_offset: partitions start alignment_offset bytes after
+            an alignment boundary
         """
 
         valid_types = [GPT, MSDOS]
@@ -64,6 +186,7 @@ class PartitionTable(object):
         self.partition_start = Size(partition_start)
         self.alignment = Size(alignment)
         self.sector_size = Size(sector_size)
+        self.alignment_offset = alignment_offset
 
         # This variable is used to store a pointer to the end of the partition
         # structure + (alignment - ( end % alignment ) )
@@ -240,6 +363,8 @@ class Partition(object):
         self.devname = None
         self.allocated = False
         self.fsck_option = fsck_option
+        # (chunk size, data disks) of the disk, set when allocated
+        self.stripe_geometry = None
 
     @property
     def is_linked(self):
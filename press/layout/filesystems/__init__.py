@@ -2,11 +2,33 @@ import uuid
 
 from press.helpers.cli import find_in_path, run
 
+# inode density of the file system, see EXT.bytes_per_inode and XFS.maxpct
+WORKLOADS = ('general', 'small_files', 'large_files', 'huge_files')
+# how file systems are mounted while the image is written, see
+# FileSystem.install_mount_options
+INSTALL_MOUNT_PROFILES = ('default', 'fast')
+
 
 class FileSystem(object):
     fs_type = ''
     parted_fs_type_alias = ''
     default_mount_options = ('defaults',)
+    # set by set_stripe_geometry
+    stripe_unit = 0
+    stripe_data_disks = 0
+    # format profile, None until configured on the file system or the layout
+    fast_format = None
+    workload = None
+    discarded = None
+    # install mount profile, None until configured
+    install_mount_profile = None
+    explicit_install_mount_options = None
+    # used while the image is written with the fast install mount profile,
+    # journaling and barriers only matter once the image is in place
+    fast_install_mount_options = ('noatime', )
+    # fstab options left out when the file system is mounted again after
+    # the image is written, the installer kernel may reject them
+    remount_excluded_options = ()
 
     def __init__(self, label=None, mount_options=None, late_uuid=False):
         self.fs_label = label
@@ -24,6 +46,67 @@ class FileSystem(object):
         raise NotImplemented(
             '%s base class should not be used.' % self.__name__)
 
+    def set_stripe_geometry(self, stripe_unit, data_disks):
+        """Format aligned to the stripe of the underlying RAID. File systems
+        which cannot use it ignore it, explicit options take precedence.
+
+        :param stripe_unit: chunk size in bytes
+        :param data_disks: number of members holding data in a stripe
+        """
+        self.stripe_unit = stripe_unit
+        self.stripe_data_disks = data_disks
+
+    def parse_format_profile(self, extra):
+        self.fast_format = extra.get('fast_format')
+        self.workload = extra.get('workload')
+        self.discarded = extra.get('discarded')
+
+    def set_format_profile(self, fast_format=False, workload=None,
+                           discarded=False):
+        """Layout wide defaults, the options of the file system take
+        precedence
+
+        :param fast_format: defer the initialization of inode tables and of
+            the journal, and skip discards when the device is discarded
+        :param workload: one of WORKLOADS, sizes the inode tables
+        :param discarded: the device has been discarded, or reads zeroes
+        """
+        if self.fast_format is None:
+            self.fast_format = fast_format
+        if self.workload is None:
+            self.workload = workload
+        if self.discarded is None:
+            self.discarded = discarded
+
+    def parse_install_mount_profile(self, extra):
+        self.install_mount_profile = extra.get('install_mount_profile')
+        self.explicit_install_mount_options = extra.get(
+            'install_mount_options')
+
+    def set_install_mount_profile(self, profile):
+        """Layout wide default, the profile of the file system takes
+        precedence
+
+        :param profile: one of INSTALL_MOUNT_PROFILES
+        """
+        if self.install_mount_profile is None:
+            self.install_mount_profile = profile
+
+    @property
+    def install_mount_options(self):
+        """Options used to mount the file system while the image is written,
+        it is mounted again with the fstab options afterwards
+        """
+        if self.explicit_install_mount_options is not None:
+            return list(self.explicit_install_mount_options)
+        if self.install_mount_profile == 'fast':
+            return list(self.fast_install_mount_options)
+        return []
+
+    @property
+    def skip_discard(self):
+        return bool(self.fast_format and self.discarded)
+
     def generate_mount_options(self):
         if hasattr(self, 'mount_options'):
             options = self.mount_options
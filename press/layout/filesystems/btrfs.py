@@ -0,0 +1,161 @@
+import logging
+import os
+import tempfile
+
+from press.helpers.cli import run
+from press.layout.filesystems import FileSystem
+from press.exceptions import (FileSystemCreateException,
+                              FileSystemFindCommandException)
+
+log = logging.getLogger(__name__)
+
+# data and metadata profiles, and the number of devices they need
+PROFILES = {
+    'single': 1,
+    'dup': 1,
+    'raid0': 2,
+    'raid1': 2,
+    'raid1c3': 3,
+    'raid1c4': 4,
+    'raid10': 4,
+    'raid5': 2,
+    'raid6': 3
+}
+
+
+class BtrfsSubvolume(object):
+    """
+    A subvolume, mounted on its own with subvol=
+    """
+
+    def __init__(self, file_system, name, mount_point=None):
+        self.file_system = file_system
+        self.name = name
+        self.mount_point = mount_point
+        self.fsck_option = 0
+
+    @property
+    def devname(self):
+        return self.file_system.device
+
+    @property
+    def mount_options(self):
+        return ['subvol=%s' % self.name]
+
+    def generate_fstab_entry(self, method='UUID'):
+        if not self.mount_point:
+            return
+        file_system = self.file_system
+        options = ','.join([file_system.generate_mount_options()] +
+                           self.mount_options)
+        # every device of the file system has the same UUID and LABEL
+        if method == 'LABEL' and file_system.fs_label:
+            source = 'LABEL=%s' % file_system.fs_label
+        else:
+            source = 'UUID=%s' % file_system.fs_uuid
+        return '# DEVNAME=%s\tSUBVOLUME=%s\n%s\t\t%s\t\t%s\t\t%s 0 %s\n\n' % (
+            self.devname, self.name, source, self.mount_point, file_system,
+            options, self.fsck_option)
+
+    def __repr__(self):
+        return 'subvolume: %s, mount point: %s' % (self.name,
+                                                   self.mount_point)
+
+
+class Btrfs(FileSystem):
+    fs_type = 'btrfs'
+    parted_fs_type_alias = 'btrfs'
+    command_name = 'mkfs.btrfs'
+    default_compression = 'zstd'
+    fast_install_mount_options = ('noatime', 'commit=60')
+
+    def __init__(self, label=None, mount_options=None, **extra):
+        """
+        :param extra: data_profile, metadata_profile, compression, devices,
+            the names of partitions added to the file system, and
+            subvolumes, a list of dicts with name and mount_point
+        """
+        compression = extra.get('compression', self.default_compression)
+        self.compression = compression != 'none' and compression or None
+        if not mount_options:
+            mount_options = ['noatime', 'space_cache=v2']
+            if self.compression:
+                mount_options.append('compress=%s' % self.compression)
+        super(Btrfs, self).__init__(label, mount_options)
+        self.data_profile = extra.get('data_profile')
+        self.metadata_profile = extra.get('metadata_profile')
+        # partitions are linked once the layout is generated
+        self.device_names = extra.get('devices', list())
+        self.devices = list()
+        self.subvolumes = [
+            BtrfsSubvolume(self, subvolume['name'],
+                           subvolume.get('mount_point'))
+            for subvolume in extra.get('subvolumes', list())
+        ]
+        self.parse_format_profile(extra)
+        self.parse_install_mount_profile(extra)
+        # set by create
+        self.device = None
+
+        self.command_path = self.locate_command(self.command_name)
+
+        if not self.command_path:
+            raise FileSystemFindCommandException(
+                'Cannot locate %s in PATH' % self.command_name)
+
+        self.full_command = \
+            '{command_path} -f -U {uuid}{label_options}{profile_options}' + \
+            '{discard_options} {devices}'
+
+    @property
+    def install_mount_options(self):
+        """Extract the image compressed"""
+        options = super(Btrfs, self).install_mount_options
+        if self.compression and not [option for option in options
+                                     if option.startswith('compress')]:
+            options.append('compress=%s' % self.compression)
+        return options
+
+    def get_profile_options(self):
+        options = ''
+        if self.data_profile:
+            options += ' -d %s' % self.data_profile
+        if self.metadata_profile:
+            options += ' -m %s' % self.metadata_profile
+        return options
+
+    def create(self, device):
+        self.device = device
+        devices = [device] + [partition.devname for partition in self.devices]
+        command = self.full_command.format(**dict(
+            command_path=self.command_path,
+            uuid=self.fs_uuid,
+            label_options=self.fs_label and ' -L %s' % self.fs_label or '',
+            profile_options=self.get_profile_options(),
+            discard_options=self.skip_discard and ' -K' or '',
+            devices=' '.join(devices)))
+        log.info('Creating filesystem: %s' % command)
+        result = run(command)
+        if result.returncode:
+            raise FileSystemCreateException(self.fs_label, command, result)
+        if self.subvolumes:
+            self.create_subvolumes()
+
+    def create_subvolumes(self):
+        path = tempfile.mkdtemp(prefix='press-btrfs-')
+        run('mount -t btrfs %s %s' % (self.device, path),
+            raise_exception=True)
+        try:
+            for subvolume in self.subvolumes:
+                subvolume_path = os.path.join(path, subvolume.name)
+                log.info('Creating subvolume %s' % subvolume)
+                run('btrfs subvolume create %s' % subvolume_path,
+                    raise_exception=True)
+                if subvolume.mount_point == '/':
+                    # mounted when no subvolume is given, root=UUID= then
+                    # boots without rootflags=subvol=
+                    run('btrfs subvolume set-default %s' % subvolume_path,
+                        raise_exception=True)
+        finally:
+            run('umount %s' % path)
+            os.rmdir(path)
@@ -85,6 +85,18 @@ class EXT(FileSystem):
     _default_stride_size = 0
     _default_stripe_width = 0
     _default_features = set()
+    # mke2fs uses 4KiB blocks for anything but tiny file systems
+    block_size = 4096
+    # -i by workload, mke2fs.conf when None
+    bytes_per_inode = {
+        'general': None,
+        'small_files': 4096,
+        'large_files': 1048576,
+        'huge_files': 4194304
+    }
+    # data= cannot change on remount, the file system is mounted again
+    fast_install_mount_options = ('data=writeback', 'nobarrier', 'commit=60',
+                                  'noatime')
 
     def __init__(self, label=None, mount_options=None, **extra):
 
@@ -95,6 +107,8 @@ class EXT(FileSystem):
         self.stride_size = extra.get('stride_size', self._default_stride_size)
         self.stripe_width = extra.get('stripe_width',
                                       self._default_stripe_width)
+        self.parse_format_profile(extra)
+        self.parse_install_mount_profile(extra)
 
         if not hasattr(self, 'features'):
             self.features = set(extra.get('features', self._default_features))
@@ -108,14 +122,11 @@ class EXT(FileSystem):
 
         self.full_command = \
             '{command_path} -F -U{uuid} -m{superuser_reserve}' + \
-            '{feature_options}{extended_options}{label_options} {device}'
+            '{feature_options}{inode_options}{extended_options}' + \
+            '{label_options} {device}'
 
-        # algorithm for calculating stripe-width: stride * N where N are
-        # member disks that are not used as parity disks or hot spares
         self.extended_options = ''
-        if self.stripe_width and self.stride_size:
-            self.extended_options = ' -E stride=%s,stripe_width=%s' % (
-                self.stride_size, self.stripe_width)
+        self.inode_options = ''
 
         self.label_options = ''
         if self.fs_label:
@@ -131,11 +142,41 @@ class EXT(FileSystem):
     def _enable_or_disable_features(self):
         raise NotImplementedError()
 
+    def get_extended_options(self):
+        # algorithm for calculating stripe-width: stride * N where N are
+        # member disks that are not used as parity disks or hot spares
+        stride_size, stripe_width = self.stride_size, self.stripe_width
+        if not (stride_size and stripe_width) and \
+                self.stripe_unit >= self.block_size:
+            stride_size = self.stripe_unit // self.block_size
+            stripe_width = stride_size * self.stripe_data_disks
+        options = list()
+        if stride_size and stripe_width:
+            options.append('stride=%s,stripe_width=%s' % (stride_size,
+                                                          stripe_width))
+        if self.fast_format:
+            # the kernel zeroes inode tables in the background after mount
+            options.append('lazy_itable_init=1,lazy_journal_init=1')
+        if self.skip_discard:
+            options.append('nodiscard')
+        if options:
+            return ' -E %s' % ','.join(options)
+        return ''
+
+    def get_inode_options(self):
+        bytes_per_inode = self.bytes_per_inode.get(self.workload)
+        if bytes_per_inode:
+            return ' -i %d' % bytes_per_inode
+        return ''
+
     def create(self, device):
+        self.extended_options = self.get_extended_options()
+        self.inode_options = self.get_inode_options()
         command = self.full_command.format(**dict(
             command_path=self.command_path,
             superuser_reserve=self.superuser_reserve,
             feature_options=self.feature_options,
+            inode_options=self.inode_options,
             extended_options=self.extended_options,
             label_options=self.label_options,
             device=device,
@@ -150,6 +191,8 @@ class EXT(FileSystem):
 class EXT2(EXT):
     fs_type = 'ext2'
     command_name = 'mkfs.ext2'
+    # no journal
+    fast_install_mount_options = ('noatime', )
 
 
 class EXT3(EXT):
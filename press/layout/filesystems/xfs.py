@@ -9,6 +9,7 @@ from press.exceptions import (FileSystemCreateException,
 
 log = logging.getLogger(__name__)
 supported_switches = {
+    'data_options': '-d',
     'inode_options': '-i',
     'naming_options': '-n',
     'global_metadata_options': '-m'
@@ -81,11 +82,24 @@ class XFS(FileSystem):
     command_name = 'mkfs.xfs'
 
     xfs_required_mount_options = ['inode64', 'nobarrier']
+    # -i maxpct by workload, the share of the file system inodes may use,
+    # mkfs.xfs default when None
+    inode_maxpct = {
+        'general': None,
+        'small_files': 50,
+        'large_files': 5,
+        'huge_files': 1
+    }
+    # nobarrier is rejected by kernels since 4.19
+    fast_install_mount_options = ('logbufs=8', 'logbsize=256k', 'noatime')
+    remount_excluded_options = ('barrier', 'nobarrier')
 
     def __init__(self, label=None, mount_options=None, **extra):
         super(XFS, self).__init__(label, mount_options)
         self.extra = extra
         self.disable_crc_feature = extra.get("disable_crc_feature")
+        self.parse_format_profile(extra)
+        self.parse_install_mount_profile(extra)
 
         for option in self.xfs_required_mount_options:
             if option not in self.mount_options:
@@ -100,8 +114,9 @@ class XFS(FileSystem):
                 )
 
         self.full_command = \
-            '{command_path} -m uuid={uuid}  -f ' + \
-            '{inode_options}{naming_options}{global_metadata_options}' + \
+            '{command_path} -m uuid={uuid}  -f {discard_options}' + \
+            '{data_options}{inode_options}{naming_options}' + \
+            '{global_metadata_options}' + \
             '{label_options}{device}'
 
         self.label_options = ''
@@ -109,6 +124,9 @@ class XFS(FileSystem):
             self.label_options = ' -L {} '.format(self.fs_label)
 
         self.parse_options()
+        self.set_option_strings()
+
+    def set_option_strings(self):
         for option_name, switch in supported_switches.items():
             setattr(self, option_name, '')
             opts = self.get_option(switch)
@@ -165,7 +183,8 @@ class XFS(FileSystem):
         """
         # Chunk all of our supplied options into groups keyed by switch name
         return {switch: list(option) for switch, option in
-                groupby(self.addl_options, key=lambda x: x.switch)} \
+                groupby(sorted(self.addl_options, key=lambda x: x.switch),
+                        key=lambda x: x.switch)} \
             if self.addl_options else {}
 
     def get_option(self, key):
@@ -176,10 +195,44 @@ class XFS(FileSystem):
         options = self.get_options()
         return options.get(key)
 
+    def add_stripe_options(self):
+        """
+        Add su and sw data options from the stripe geometry, unless the
+        stripe was given explicitly
+        """
+        if not self.stripe_unit or self.stripe_data_disks < 2:
+            return
+        for option in self.get_option('-d') or []:
+            if getattr(option, 'key', None) in ('su', 'sw', 'sunit',
+                                                'swidth'):
+                return
+        self.addl_options.update(
+            (XFSMultiParam('-d', key='su', value=self.stripe_unit),
+             XFSMultiParam('-d', key='sw', value=self.stripe_data_disks)))
+        self.set_option_strings()
+
+    def add_workload_options(self):
+        """
+        Limit the space inodes may use according to the workload, unless
+        maxpct was given explicitly
+        """
+        maxpct = self.inode_maxpct.get(self.workload)
+        if not maxpct:
+            return
+        for option in self.get_option('-i') or []:
+            if getattr(option, 'key', None) == 'maxpct':
+                return
+        self.addl_options.add(XFSMultiParam('-i', key='maxpct', value=maxpct))
+        self.set_option_strings()
+
     def create(self, device):
+        self.add_stripe_options()
+        self.add_workload_options()
         command = self.full_command.format(**dict(
             command_path=self.command_path,
             uuid=self.fs_uuid,
+            discard_options=self.skip_discard and '-K ' or '',
+            data_options=self.data_options,
             label_options=self.label_options,
             inode_options=self.inode_options,
             naming_options=self.naming_options,
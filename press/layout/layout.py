@@ -1,16 +1,20 @@
 import os
 import logging
-import time
 from collections import OrderedDict
 
 from press import helpers
-from press.helpers.cli import run
+from press.helpers.cli import CLIException, run
+from press.helpers.disklabel import DiskLabel
 from press.helpers.parted import PartedInterface, NullDiskException, PartedException
+from press.helpers.sysfs_info import BlockDeviceInfo
 from press.helpers.lvm import LVM
 from press.helpers.mdadm import MDADM
+from press.helpers.mdstat import MDStatException, wait_for_array
 from press.helpers.udev import UDevHelper
+from press.helpers.workers import run_parallel
 from press.layout.disk import Disk
 from press.layout.lvm import VolumeGroup
+from press.layout.scheduler import Scheduler
 from press.exceptions import (PhysicalDiskException, LayoutValidationError,
                               GeneralValidationException)
 
@@ -26,7 +30,16 @@ class Layout(object):
                  loop_only=False,
                  use_nvm_express=True,
                  parted_path='/sbin/parted',
-                 clear_dm=False):
+                 clear_dm=False,
+                 reserved_devices=None,
+                 udev_timeout=30,
+                 batch_parted=False,
+                 partition_engine='parted',
+                 parallel_disks=False,
+                 max_workers=0,
+                 concurrent_apply=False,
+                 discovery='sysfs',
+                 discovery_workers=1):
         """
         Docs, maybe later
 
@@ -35,6 +48,22 @@ class Layout(object):
         :param use_nvm_express:
         :param parted_path:
         :param clear_dm: Should apply clear the device mapper
+        :param reserved_devices: disks, partitions, or links to them, which
+            press must never touch. The disks they reside on are excluded.
+        :param udev_timeout: seconds to wait for a new device to appear
+        :param batch_parted: write each partition table with a single parted
+            invocation
+        :param partition_engine: parted, or native to write partition tables
+            without parted (see press.helpers.disklabel)
+        :param parallel_disks: partition and format disks concurrently
+        :param max_workers: maximum number of disks processed at once, 0
+            means all of them
+        :param concurrent_apply: apply the layout as a graph of operations,
+            running up to max_workers of them at once, see compile_operations
+        :param discovery: sysfs to inspect disks using sysfs and ioctls, or
+            parted
+        :param discovery_workers: number of disks inspected at once, 0 means
+            all of them
 
         :ivar self.committed: False on __init__, True after calling apply()
         """
@@ -43,7 +72,17 @@ class Layout(object):
         self.fc_enabled = use_fibre_channel
         self.parted_path = parted_path
         self.clear_dm =clear_dm
+        self.udev_timeout = udev_timeout
+        self.batch_parted = batch_parted
+        self.partition_engine = partition_engine
+        self.parallel_disks = parallel_disks
+        self.max_workers = max_workers
+        self.concurrent_apply = concurrent_apply
+        self.discovery = discovery
+        self.discovery_workers = discovery_workers
         self.udev = UDevHelper()
+        self.reserved_disks = self.resolve_reserved_disks(reserved_devices
+                                                          or [])
         self.udisks = self.udev.discover_valid_storage_devices(
             fc_enabled=self.fc_enabled, loop_only=loop_only, nvme_enabled=use_nvm_express)
 
@@ -63,26 +102,77 @@ class Layout(object):
 
         self.software_raid_objects = []
 
+    def resolve_reserved_disks(self, reserved_devices):
+        reserved = list()
+        for device in reserved_devices:
+            disk = self.udev.get_disk_devname(device)
+            if not disk:
+                raise PhysicalDiskException(
+                    'Reserved device %s does not exist' % device)
+            log.info('%s is reserved, excluding %s' % (device, disk))
+            reserved.append(disk)
+        return reserved
+
     def populate_disks(self):
-        for udisk in self.udisks:
-            device = udisk.get('DEVNAME')
-            try:
-                parted = PartedInterface(device, self.parted_path)
-            except NullDiskException as e:
-                log.debug('NullDiskException for %s: %s' % (device, e))
-                continue
-            except PartedException as e:
-                log.debug('PartedException for %s: %s' % (device, e))
-                continue
+        udisks = [udisk for udisk in self.udisks
+                  if udisk.get('DEVNAME') not in self.reserved_disks]
+        if self.discovery == 'parted':
+            discover = self.discover_with_parted
+        else:
+            discover = self.discover_with_sysfs
+        for disk in run_parallel(discover, udisks, self.discovery_workers):
+            if disk:
+                self.disks[disk.devname] = disk
 
-            size = parted.get_size()
-            disk = Disk(
-                devname=device,
-                devlinks=udisk.get('DEVLINKS'),
-                devpath=udisk.get('DEVPATH'),
-                size=size,
-                sector_size=parted.sector_size.get('logical', 512))
-            self.disks[device] = disk
+    @staticmethod
+    def discover_with_sysfs(udisk):
+        device = udisk.get('DEVNAME')
+        try:
+            info = BlockDeviceInfo(device, udisk.get('DEVPATH'))
+        except (IOError, OSError) as e:
+            log.debug('Could not inspect %s: %s' % (device, e))
+            return
+        if not info.size:
+            # unused loop devices and empty card readers
+            log.debug('%s has no media' % device)
+            return
+        log.debug('Discovered %s' % info)
+        return Disk(
+            devname=device,
+            devlinks=udisk.get('DEVLINKS'),
+            devpath=udisk.get('DEVPATH'),
+            size=info.size,
+            sector_size=info.logical_block_size,
+            physical_sector_size=info.physical_block_size,
+            rotational=info.rotational,
+            alignment_offset=info.alignment_offset,
+            minimum_io_size=info.minimum_io_size,
+            optimal_io_size=info.optimal_io_size,
+            label=info.label)
+
+    def discover_with_parted(self, udisk):
+        device = udisk.get('DEVNAME')
+        try:
+            parted = PartedInterface(device, self.parted_path)
+        except NullDiskException as e:
+            log.debug('NullDiskException for %s: %s' % (device, e))
+            return
+        except PartedException as e:
+            log.debug('PartedException for %s: %s' % (device, e))
+            return
+
+        alignment_info = parted.kernel_alignment_info
+        label = parted.init_label
+        return Disk(
+            devname=device,
+            devlinks=udisk.get('DEVLINKS'),
+            devpath=udisk.get('DEVPATH'),
+            size=parted.get_size(),
+            sector_size=parted.sector_size.get('logical', 512),
+            physical_sector_size=parted.sector_size.get('physical'),
+            alignment_offset=alignment_info.alignment_offset or 0,
+            optimal_io_size=alignment_info.optimal_io_size or 0,
+            label=label if label in ('gpt', 'msdos') else None)
 
     def find_device_by_ref(self, ref):
         """
@@ -121,7 +211,8 @@ class Layout(object):
             device=disk.devname,
             parted_path=self.parted_path,
             partition_start=disk.partition_table.partition_start.bytes,
-            alignment=disk.partition_table.alignment.bytes)
+            alignment=disk.partition_table.alignment.bytes,
+            alignment_offset=disk.partition_table.alignment_offset)
 
     @property
     def allocated(self):
@@ -167,6 +258,20 @@ class Layout(object):
 
         for partition in partition_table.partitions:
             disk.partition_table.add_partition(partition)
+            partition.stripe_geometry = disk.stripe_geometry
+            self.align_file_system(partition, partition.stripe_geometry)
+
+    @staticmethod
+    def align_file_system(obj, stripe_geometry):
+        """
+        :param obj: a partition, array or logical volume
+        :param stripe_geometry: (chunk size, data disks) or None
+        """
+        if not obj.file_system or not stripe_geometry:
+            return
+        log.info('%s will be aligned to %d x %d bytes stripes' %
+                 (obj.file_system, stripe_geometry[1], stripe_geometry[0]))
+        obj.file_system.set_stripe_geometry(*stripe_geometry)
 
     def find_partition_devname(self, disk, partition_id):
         # make this part of UDevHelper?
@@ -185,6 +290,8 @@ class Layout(object):
                               model_vg.pe_size)
         for lv in model_vg.logical_volumes:
             real_vg.add_logical_volume(lv)
+            self.align_file_system(
+                lv, lv.stripe_geometry or real_vg.stripe_geometry)
         self.volume_groups.append(real_vg)
 
     def add_software_raid(self, raid_object):
@@ -198,114 +305,259 @@ class Layout(object):
 
         raid_object.allocated = True
         raid_object.calculate_size()
+        self.align_file_system(raid_object, raid_object.stripe_geometry)
         log.info('Adding RAID Volume %s, size: %s' % (raid_object.devname,
                                                       raid_object.size))
         self.software_raid_objects.append(raid_object)
 
     def apply_standard_partitions(self):
         log.info('Configuring standard partitions')
+        if self.parallel_disks:
+            log.info('Applying %d disks in parallel' % len(self.allocated))
+            run_parallel(self.apply_disk, self.allocated, self.max_workers)
+            return
         for disk in self.allocated:
-            parted = self._get_parted_interface_for_allocated_device(disk)
-
-            #########################################################################################
-            # Read into existing table and remove any active physical volumes
-            # TODO: This needs a newer version of udev that is not currently available in Yolo
-            # Critical Error, /lib64/libudev.so.0: undefined symbol: udev_enumerate_add_match_paren
-            #########################################################################################
-            # udev_partitions = self.udev.find_partitions(disk.devname)
-            # for _udev_part in udev_partitions:
-            #     _udev_devname = _udev_part['DEVNAME']
-            #     if self.lvm.pv_exists(_udev_devname):
-            #         self.lvm.pvremove(_udev_devname)
-            #     # Also, zero the super block
-            #     self.mdadm.zero_superblock(_udev_devname)
-            #     self.mdadm.zero_4k(_udev_devname)
-            #########################################################################################
-
-            parted.remove_gpt()
+            self.apply_disk(disk)
 
-            partition_table = disk.partition_table
-            parted.set_label(partition_table.type)
-            for partition in partition_table.partitions:
-                fs_type = '' if not partition.file_system else \
-                    partition.file_system.parted_fs_type_alias
-                monitor = self.udev.get_monitor()
-                monitor.start()
-                log.debug(str(type(monitor)))
-                partition_id = parted.create_partition(
-                    partition.name,
-                    partition.size.bytes,
-                    flags=partition.flags,
-                    fs_type=fs_type)
-                # Dirty race condition hack, need to re-write udev monitor to make it more stable
-                time.sleep(2)
-                # end hack
-                log.debug('Monitoring for devname')
-                partition.devname = self.udev.monitor_partition_by_devname(
-                    monitor, partition_id, action='add')
-                log.debug('Found %s' % partition.devname)
-                partition.partition_id = partition_id
-
-                if not partition.devname:
-                    log.error('%s %s %s' % (partition.devname, disk,
-                                            partition_id))
-                    raise PhysicalDiskException(
-                        'Could not relate partition id to devname')
-
-                if partition.file_system:
-                    partition.file_system.create(partition.devname)
+    def apply_disk(self, disk):
+        """Partition disk and create its file systems
+
+        Disks are independent from one another at this stage, this may run
+        concurrently for several disks.
+        """
+        self.partition_disk(disk)
+        self.format_partitions(disk)
+
+    def _apply_parted(self, disk):
+        parted = self._get_parted_interface_for_allocated_device(disk)
+
+        #########################################################################################
+        # Read into existing table and remove any active physical volumes
+        # TODO: This needs a newer version of udev that is not currently available in Yolo
+        # Critical Error, /lib64/libudev.so.0: undefined symbol: udev_enumerate_add_match_paren
+        #########################################################################################
+        # udev_partitions = self.udev.find_partitions(disk.devname)
+        # for _udev_part in udev_partitions:
+        #     _udev_devname = _udev_part['DEVNAME']
+        #     if self.lvm.pv_exists(_udev_devname):
+        #         self.lvm.pvremove(_udev_devname)
+        #     # Also, zero the super block
+        #     self.mdadm.zero_superblock(_udev_devname)
+        #     self.mdadm.zero_4k(_udev_devname)
+        #########################################################################################
+
+        parted.remove_gpt()
+
+        partition_table = disk.partition_table
+        if self.batch_parted:
+            parted.begin_batch()
+        parted.set_label(partition_table.type)
+        for partition in partition_table.partitions:
+            fs_type = '' if not partition.file_system else \
+                partition.file_system.parted_fs_type_alias
+            partition.partition_id = parted.create_partition(
+                partition.name,
+                partition.size.bytes,
+                flags=partition.flags,
+                fs_type=fs_type)
+        if self.batch_parted:
+            parted.commit()
+
+    @staticmethod
+    def _apply_disk_label(disk):
+        partition_table = disk.partition_table
+        disk_label = DiskLabel(
+            disk.devname,
+            partition_table.type,
+            size=disk.size.bytes,
+            sector_size=disk.sector_size,
+            partition_start=partition_table.partition_start.bytes,
+            alignment=partition_table.alignment.bytes,
+            alignment_offset=partition_table.alignment_offset)
+        for partition in partition_table.partitions:
+            fs_type = '' if not partition.file_system else \
+                partition.file_system.parted_fs_type_alias
+            partition.partition_id = disk_label.add_partition(
+                partition.name,
+                partition.size.bytes,
+                flags=partition.flags,
+                fs_type=fs_type)
+        disk_label.write()
+        disk_label.reread()
+
+    def partition_disk(self, disk):
+        """Write the partition table of disk and resolve partition devnames
+
+        All partitions are created before waiting on any of them. With the
+        native engine, or batch_parted, the table is written at once.
+        """
+        monitor = self.udev.get_monitor()
+        monitor.filter_by('block', device_type='partition')
+        monitor.start()
+
+        if self.partition_engine == 'native':
+            self._apply_disk_label(disk)
+        else:
+            self._apply_parted(disk)
+
+        for partition in disk.partition_table.partitions:
+            log.debug('Waiting for partition %d' % partition.partition_id)
+            partition.devname = self.udev.wait_for_partition(
+                monitor, disk.devname, partition.partition_id,
+                timeout=self.udev_timeout)
+            log.debug('Found %s' % partition.devname)
+
+    def format_partitions(self, disk):
+        for partition in disk.partition_table.partitions:
+            if partition.file_system and \
+                    not self.spans_devices(partition.file_system):
+                self.create_file_system(partition)
+
+    @staticmethod
+    def spans_devices(file_system):
+        """File systems on several partitions, possibly of several disks, are
+        created once every disk is partitioned
+        """
+        return bool(getattr(file_system, 'devices', None))
+
+    @property
+    def multi_device_partitions(self):
+        return [partition for partition in self.partitions
+                if self.spans_devices(partition.file_system)]
+
+    def format_multi_device_partitions(self):
+        for partition in self.multi_device_partitions:
+            self.create_file_system(partition)
+
+    def create_software_raid(self, raid):
+        log.info('Building software RAID : {}'.format(raid))
+        raid.create()
+        wait_for_array(raid.devname, timeout=self.udev_timeout)
+        raid.throttle_resync()
+
+    def restore_resync_speed(self):
+        """Let arrays resync at full speed, once the installation is done"""
+        for raid in self.software_raid_objects:
+            try:
+                raid.restore_resync_speed()
+            except MDStatException as e:
+                log.warning(e)
+
+    @staticmethod
+    def create_file_system(obj):
+        """
+        :param obj: a partition, array or logical volume with a file system
+        """
+        obj.file_system.create(obj.devname)
 
     def apply_software_raid(self):
         for raid in self.software_raid_objects:
-            log.info('Building software RAID : {}'.format(raid))
-            raid.create()
-            # Not sure if this is necessary, but it seems to help
-            # TODO: poll /proc/mdstat to determine when the array is ready
-            time.sleep(5)
+            self.create_software_raid(raid)
             if raid.file_system:
-                raid.file_system.create(raid.devname)
+                self.create_file_system(raid)
 
     def destroy_volume_groups(self):
+        existing = self.lvm.get_volume_groups()
         for volume_group in self.volume_groups:
-            if self.lvm.vg_exists(volume_group.name):
+            if volume_group.name in existing:
                 log.info('Removing existing volume: %s' % volume_group.name)
                 self.lvm.vgremove(volume_group.name)
 
     def destroy_physical_volumes(self):
+        existing = self.lvm.get_physical_volumes()
+        devnames = list()
         for volume_group in self.volume_groups:
             for pv in volume_group.physical_volumes:
                 if not pv.reference:
                     continue
-                if self.lvm.pv_exists(pv.reference.devname):
+                if pv.reference.devname in existing:
                     log.info('Removing existing physical volume: %s' %
                              pv.reference.devname)
-                    self.lvm.pvremove(pv.reference.devname)
+                    devnames.append(pv.reference.devname)
+        if devnames:
+            self.lvm.pvremove(devnames)
+
+    def create_physical_volumes(self, volume_group):
+        devnames = list()
+        for pv in volume_group.physical_volumes:
+            if not pv.reference.devname:
+                raise LayoutValidationError(
+                    'devname is not populated, and it should be')
+            devnames.append(pv.reference.devname)
+        self.lvm.pvcreate(devnames)
+
+    def create_volume_group(self, volume_group):
+        devnames = [pv.reference.devname for pv in
+                    volume_group.physical_volumes]
+        self.lvm.vgcreate(volume_group.name, devnames,
+                          volume_group.pe_size.bytes)
+
+    def create_logical_volumes(self, volume_group):
+        """Create every logical volume of a group back to back, then wait for
+        udev to process all of them
+        """
+        if not volume_group.logical_volumes:
+            return
+        monitor = self.udev.get_monitor()
+        monitor.start()
+        # pools before the thin volumes they hold
+        for lv in sorted(volume_group.logical_volumes,
+                         key=lambda volume: not volume.is_thin_pool):
+            self.create_logical_volume(volume_group, lv)
+        # thin pools are not usable devices
+        volumes = [lv for lv in volume_group.logical_volumes
+                   if not lv.is_thin_pool]
+        log.debug('Monitoring for devnames')
+        devices = self.udev.wait_for_volumes(
+            monitor, volume_group.name, [lv.name for lv in volumes],
+            timeout=self.udev_timeout)
+        for lv in volumes:
+            device = devices[lv.name]
+            lv.devname = device['DEVNAME']
+            log.debug('Found %s' % lv.devname)
+            lv.devlinks = device.get('DEVLINKS', '').split()
+
+    def create_logical_volume(self, volume_group, lv):
+        if lv.pool:
+            self.lvm.lvcreate_thin(lv.size.bytes, volume_group.name,
+                                   lv.pool.name, lv.name)
+            return
+        options = dict(
+            stripes=lv.stripes,
+            stripe_size=lv.stripe_size,
+            physical_volumes=[pv.reference.devname
+                              for pv in lv.physical_volumes or []])
+        if lv.is_thin_pool:
+            self.lvm.lvcreate_thin_pool(
+                lv.extents, volume_group.name, lv.name,
+                metadata_size=lv.metadata_size.bytes,
+                chunk_size=lv.chunk_size, zero=lv.zero, **options)
+        else:
+            self.lvm.lvcreate(lv.extents, volume_group.name, lv.name,
+                              **options)
+        if lv.cache:
+            self.create_cache(volume_group, lv)
+
+    def create_cache(self, volume_group, lv):
+        cache = lv.cache
+        self.lvm.lvcreate_cache_pool(
+            cache.extents, volume_group.name, cache.name,
+            chunk_size=cache.chunk_size,
+            metadata_size=cache.metadata_size.bytes,
+            physical_volumes=[pv.reference.devname
+                              for pv in cache.physical_volumes])
+        self.lvm.lvconvert_cache(volume_group.name, lv.name, cache.name,
+                                 cache.mode)
 
     def apply_lvm(self):
         for volume_group in self.volume_groups:
-            devnames = list()
-            monitor = self.udev.get_monitor()
-            monitor.start()
-
-            for pv in volume_group.physical_volumes:
-                if not pv.reference.devname:
-                    raise LayoutValidationError(
-                        'devname is not populated, and it should be')
-                devnames.append(pv.reference.devname)
-                self.lvm.pvcreate(pv.reference.devname)
-            self.lvm.vgcreate(volume_group.name, devnames,
-                              volume_group.pe_size.bytes)
+            self.create_physical_volumes(volume_group)
+            self.create_volume_group(volume_group)
+            self.create_logical_volumes(volume_group)
 
             for lv in volume_group.logical_volumes:
-                self.lvm.lvcreate(lv.extents, volume_group.name, lv.name)
-                log.debug(lv.name)
-                log.debug('Monitoring for devname')
-                device = self.udev.monitor_for_volume(monitor, lv.name)
-                lv.devname = device['DEVNAME']
-                log.debug('Found %s' % lv.devname)
-                lv.devlinks = device.get('DEVLINKS', '').split()
                 if lv.file_system:
-                    lv.file_system.create(lv.devname)
+                    self.create_file_system(lv)
 
     def clean_software_raid(self):
         """
@@ -315,8 +567,9 @@ class Layout(object):
         log.info(
             '[paranoia] Removing existing mdraid and associated physical volumes'
         )
+        existing = self.lvm.get_physical_volumes()
         for array in self.software_raid_objects:
-            if array.pv_name and self.lvm.pv_exists(array.devname):
+            if array.pv_name and array.devname in existing:
                 self.lvm.pvremove(array.devname)
             array.clean()
 
@@ -324,10 +577,7 @@ class Layout(object):
         log.info('Clearing the device mapper')
         run('dmsetup remove_all')
 
-    def apply(self):
-        """Lots of logging here
-        """
-
+    def remove_existing_volumes(self):
         # TODO: now that we have some clean up operations, determine if we still need to do this
 
         if self.clear_dm:
@@ -336,12 +586,89 @@ class Layout(object):
         self.destroy_volume_groups()
         self.clean_software_raid()
 
-        self.apply_standard_partitions()
-
+    def remove_residual_volumes(self):
         # Now that we've built a partition table, destroy any resident data
         self.destroy_volume_groups()
         self.destroy_physical_volumes()
 
+    def compile_operations(self, scheduler):
+        """Describe apply() as a graph of operations
+
+        Each disk is partitioned on its own, then each file system is created
+        as soon as its device exists. Arrays and physical volumes wait for
+        every disk, existing volumes found on the new partitions have to be
+        removed first. Logical volumes of a group are created back to back,
+        lvcreate locks the volume group anyway, then formatted concurrently.
+        """
+        cleanup = scheduler.add('remove existing volumes',
+                                self.remove_existing_volumes)
+
+        def add_mkfs(obj, after, name):
+            if obj.file_system:
+                scheduler.add('mkfs %s' % name, self.create_file_system,
+                              (obj, ), [after])
+
+        partitioned = list()
+        for disk in self.allocated:
+            operation = scheduler.add('partition %s' % disk.devname,
+                                      self.partition_disk, (disk, ), [cleanup])
+            partitioned.append(operation)
+            for partition in disk.partition_table.partitions:
+                if not self.spans_devices(partition.file_system):
+                    add_mkfs(partition, operation,
+                             '%s (%s)' % (partition.name, disk.devname))
+
+        residual = scheduler.add('remove residual volumes',
+                                 self.remove_residual_volumes, after=partitioned)
+
+        for partition in self.multi_device_partitions:
+            add_mkfs(partition, residual, partition.name)
+
+        arrays = dict()
+        for raid in self.software_raid_objects:
+            operation = scheduler.add('create %s' % raid.devname,
+                                      self.create_software_raid, (raid, ),
+                                      [residual])
+            arrays[id(raid)] = operation
+            add_mkfs(raid, operation, raid.devname)
+
+        for volume_group in self.volume_groups:
+            after = [residual]
+            for pv in volume_group.physical_volumes:
+                if id(pv.reference) in arrays:
+                    after.append(arrays[id(pv.reference)])
+            pvs = scheduler.add('pvcreate %s' % volume_group.name,
+                                self.create_physical_volumes,
+                                (volume_group, ), after)
+            vg = scheduler.add('vgcreate %s' % volume_group.name,
+                               self.create_volume_group, (volume_group, ),
+                               [pvs])
+            lvs = scheduler.add('lvcreate %s' % volume_group.name,
+                                self.create_logical_volumes, (volume_group, ),
+                                [vg])
+            for lv in volume_group.logical_volumes:
+                add_mkfs(lv, lvs, '%s/%s' % (volume_group.name, lv.name))
+
+    def apply(self):
+        """Lots of logging here
+        """
+        if self.concurrent_apply:
+            scheduler = Scheduler(self.max_workers)
+            self.compile_operations(scheduler)
+            log.info('Applying layout, %d operations' %
+                     len(scheduler.operations))
+            scheduler.run()
+            self.committed = True
+            return
+
+        self.remove_existing_volumes()
+
+        self.apply_standard_partitions()
+
+        self.remove_residual_volumes()
+
+        self.format_multi_device_partitions()
+
         # Now re-apply from scratch
         self.apply_software_raid()
         self.apply_lvm()
@@ -367,10 +694,17 @@ class Layout(object):
             helpers.package.get_press_version())
         fstab = ''
 
+        def mounted(obj):
+            # file systems mounted only through their subvolumes
+            return obj.mount_point or not getattr(obj.file_system,
+                                                  'subvolumes', None)
+
         for disk in self.allocated:
             partition_table = disk.partition_table
 
             for partition in partition_table.partitions:
+                if not mounted(partition):
+                    continue
                 entry = partition.generate_fstab_entry(method)
                 if entry:
                     fstab += entry
@@ -379,15 +713,24 @@ class Layout(object):
             # forcing '/dev/mapper' DEVNAME format for LVM
             method = 'DEVNAME'
             for lv in vg.logical_volumes:
+                if not mounted(lv):
+                    continue
                 entry = lv.generate_fstab_entry(method)
                 if entry:
                     fstab += entry
 
         for swraid in self.software_raid_objects:
+            if not mounted(swraid):
+                continue
             entry = swraid.generate_fstab_entry(method)
             if entry:
                 fstab += entry
 
+        for subvolume in self.subvolumes:
+            entry = subvolume.generate_fstab_entry(method)
+            if entry:
+                fstab += entry
+
         return header + '\n\n' + fstab
 
     @property
@@ -406,6 +749,14 @@ class Layout(object):
             li += volume_group.logical_volumes
         return li
 
+    @property
+    def subvolumes(self):
+        li = list()
+        for obj in self.partitions + self.software_raid_objects + \
+                self.logical_volumes:
+            li += getattr(obj.file_system, 'subvolumes', [])
+        return li
+
     @property
     def devname_index(self):
         index = dict()
@@ -426,6 +777,9 @@ class Layout(object):
         for volume in self.logical_volumes:
             if volume.mount_point and volume.mount_point != 'swap':
                 index[volume.mount_point] = volume
+        for subvolume in self.subvolumes:
+            if subvolume.mount_point:
+                index[subvolume.mount_point] = subvolume
         return index
 
 
@@ -444,33 +798,66 @@ class MountHandler(object):
         idx = mp_list.index('/')
         if idx == -1:
             raise GeneralValidationException('root mount point is missing')
-        root_device = mount_point_index.get('/').devname
-        if not root_device:
+        root = mount_point_index.get('/')
+        if not root.devname:
             raise GeneralValidationException(
                 'root partition is not linked to a physical device')
 
         self.mount_points[mp_list.pop(idx)] = dict(
-            mount_point='/', level=1, mounted=False, device=root_device)
+            mount_point='/', level=1, mounted=False, device=root.devname,
+            options=self.get_mount_options(root),
+            final_options=self.get_final_mount_options(root),
+            required_options=getattr(root, 'mount_options', []))
         mp_list.sort(key=lambda s: s.count('/'))
         for mp in mp_list:
-            device = mount_point_index.get(mp).devname
-            if not device:
+            obj = mount_point_index.get(mp)
+            if not obj.devname:
                 raise GeneralValidationException(
                     '%s is missing physical device' % mp)
             self.mount_points[mp] = dict(
                 mount_point=mp,
                 level=mp.count('/'),
                 mounted=False,
-                device=device)
+                device=obj.devname,
+                options=self.get_mount_options(obj),
+                final_options=self.get_final_mount_options(obj),
+                required_options=getattr(obj, 'mount_options', []))
+
+    @staticmethod
+    def get_mount_options(obj):
+        """
+        :param obj: a partition, logical volume or subvolume
+        :return: options used while the image is written
+        """
+        if not obj.file_system:
+            return []
+        return obj.file_system.install_mount_options + \
+            getattr(obj, 'mount_options', [])
+
+    @staticmethod
+    def get_final_mount_options(obj):
+        """
+        :return: the options written to fstab, which the installer kernel
+            accepts
+        """
+        if not obj.file_system:
+            return []
+        excluded = obj.file_system.remount_excluded_options
+        options = [option for option in
+                   obj.file_system.generate_mount_options().split(',')
+                   if option not in excluded]
+        return options + getattr(obj, 'mount_options', [])
 
     def join(self, path):
         return os.path.join(self.target, path.lstrip('/'))
 
-    def mount(self, path, device='none', bind=False, mount_type=''):
+    def mount(self, path, device='none', bind=False, mount_type='',
+              options=None):
         full_path = self.join(path)
-        command = 'mount %s%s%s %s' % (
+        command = 'mount %s%s%s%s %s' % (
             bind and '--bind ' or '',
-            mount_type and '-t %s ' % mount_type or '', device, full_path)
+            mount_type and '-t %s ' % mount_type or '',
+            options and '-o %s ' % ','.join(options) or '', device, full_path)
         run(command, raise_exception=True)
         self.mount_points[path]['mounted'] = True
         log.info('Mounted %s' % full_path)
@@ -498,7 +885,7 @@ class MountHandler(object):
         full_path = self.join(path)
         command = 'umount %s' % full_path
         run(command, raise_exception=True)
-        self.mount_points[path]['mounted'] = True
+        self.mount_points[path]['mounted'] = False
         log.info('Unmounted %s' % full_path)
 
     @property
@@ -522,9 +909,51 @@ class MountHandler(object):
         for level in self.levels:
             for mp in self.get_level(level):
                 self.create_directory(self.join(mp['mount_point']))
-                self.mount(mp['mount_point'], mp['device'])
+                self.mount(mp['mount_point'], mp['device'],
+                           options=mp['options'])
                 self.mount_points[mp['mount_point']]['mounted'] = True
 
+    @property
+    def physical_mount_points(self):
+        return [mp for mp in self.mount_points.values()
+                if 'final_options' in mp]
+
+    def remount_physical(self):
+        """Mount partitions and volumes again with their fstab options, once
+        the image is written with the install options. Options like data=
+        cannot change on remount, so file systems are unmounted first, along
+        with the file systems mounted below them.
+        """
+        physical = self.physical_mount_points
+        changed = [mp['mount_point'] for mp in physical
+                   if set(mp['options']) - set(mp['final_options'])]
+        if not changed:
+            return
+
+        def below(mount_point, parent):
+            return mount_point == parent or parent == '/' or \
+                mount_point.startswith(parent.rstrip('/') + '/')
+
+        remount = [mp for mp in physical
+                   if any(below(mp['mount_point'], parent)
+                          for parent in changed)]
+        log.info('Mounting %s with their final options' %
+                 ', '.join(mp['mount_point'] for mp in remount))
+        # children first, like teardown
+        for mp in reversed(sorted(remount, key=lambda d: d['level'])):
+            if mp['mounted']:
+                self.umount(mp['mount_point'])
+        for mp in sorted(remount, key=lambda d: d['level']):
+            try:
+                self.mount(mp['mount_point'], mp['device'],
+                           options=mp['final_options'])
+            except CLIException as e:
+                log.warning('Could not mount %s with %s: %s, using the '
+                            'defaults' % (mp['mount_point'],
+                                          ','.join(mp['final_options']), e))
+                self.mount(mp['mount_point'], mp['device'],
+                           options=mp['required_options'])
+
     def mount_pseudo(self):
         log.info('Mounting pseudo file systems')
         self.mount_proc()
@@ -6,6 +6,19 @@ from size import Size, PercentString
 
 log = logging.getLogger(__name__)
 
+# lvcreate sizes pool metadata at 64 bytes per chunk, within these bounds
+THIN_POOL_DEFAULT_CHUNK_SIZE = 65536
+THIN_POOL_MINIMUM_METADATA = 2097152
+THIN_POOL_MAXIMUM_METADATA = 17179869184
+
+CACHE_MODES = ('writethrough', 'writeback')
+# lvm keeps the number of cache chunks under a million, doubling the chunk
+# size from 64KiB, the metadata is 4MiB plus about 88 bytes per chunk
+CACHE_POOL_MINIMUM_CHUNK_SIZE = 32768
+CACHE_POOL_DEFAULT_CHUNK_SIZE = 65536
+CACHE_POOL_MAXIMUM_CHUNKS = 1000000
+CACHE_POOL_MINIMUM_METADATA = 8388608
+
 
 class PhysicalVolume(object):
     """
@@ -35,15 +48,32 @@ class VolumeGroup(object):
         self.extents = self.pv_raw_size.bytes / self.pe_size.bytes
         self.size = Size(self.pe_size.bytes * self.extents)
 
+    @property
+    def stripe_geometry(self):
+        """The stripe shared by every physical volume, software or hardware
+        RAID, or None
+        """
+        geometries = set(getattr(pv.reference, 'stripe_geometry', None)
+                         for pv in self.physical_volumes)
+        if len(geometries) == 1:
+            return geometries.pop()
+
     @property
     def current_usage(self):
         used = Size(0)
         if not self.logical_volumes:
             return used
         for volume in self.logical_volumes:
-            used += volume.size
+            used += volume.allocated_size
         return used
 
+    def get_thin_pool(self, name):
+        for volume in self.logical_volumes:
+            if volume.is_thin_pool and volume.name == name:
+                return volume
+        raise LVMValidationError(
+            "Thin pool '{}' must be defined before its volumes".format(name))
+
     @property
     def current_pe(self):
         return self.current_usage.bytes / self.pe_size.bytes
@@ -65,30 +95,116 @@ class VolumeGroup(object):
         log.info('Validating volume {}'.format(volume.name))
         if not isinstance(volume, LogicalVolume):
             return ValueError('Expected LogicalVolume instance')
-        if self.free_space < volume.size:
-            adjustment = Size(volume.size.bytes - self.free_space.bytes)
+        if self.free_space < volume.allocated_size:
+            adjustment = Size(volume.allocated_size.bytes -
+                              self.free_space.bytes)
             raise LVMValidationError(
                 "There is not enough space for volume "
                 "'{}' (avail: {}, requested: {}).  "
                 "Please adjust the size approximately by: {}".format(
-                    volume.name, self.free_space.bytes, volume.size.bytes,
-                    adjustment))
+                    volume.name, self.free_space.bytes,
+                    volume.allocated_size.bytes, adjustment))
+
+    def add_cache_pool(self, volume):
+        """Size the cache pool of a volume, before the volume itself, so that
+        percentages of free space leave room for the pool. The percentages of
+        a cache pool are relative to its physical volumes, and the volume
+        itself allocates from the other physical volumes of the group.
+        """
+        cache = volume.cache
+        if volume.physical_volumes:
+            if [pv for pv in volume.physical_volumes
+                    if pv in cache.physical_volumes]:
+                raise LVMValidationError(
+                    "Volume '{}' shares physical volumes with its cache "
+                    "pool".format(volume.name))
+        else:
+            volume.physical_volumes = [pv for pv in self.physical_volumes
+                                       if pv not in cache.physical_volumes]
+            if not volume.physical_volumes:
+                raise LVMValidationError(
+                    "Volume '{}' has no physical volumes left once its cache "
+                    "pool is allocated".format(volume.name))
+        pe = self.pe_size.bytes
+        available = sum(pv.reference.size.bytes // pe * pe
+                        for pv in cache.physical_volumes)
+        if cache.percent_string:
+            cache.size = Size(available * cache.percent_string.value)
+        cache.reserve_metadata(self.pe_size)
+        # the pool and its metadata share the cache physical volumes
+        overrun = cache.size.bytes + cache.metadata_size.bytes - available
+        if overrun > 0 and overrun < cache.size.bytes:
+            log.info('Shrinking cache pool %s by %d bytes for its metadata' %
+                     (cache.name, overrun))
+            cache.size = Size(cache.size.bytes - overrun)
+        if self.free_space < cache.allocated_size:
+            raise LVMValidationError(
+                "There is not enough space for the cache pool of '{}' "
+                "(avail: {}, requested: {})".format(
+                    volume.name, self.free_space.bytes,
+                    cache.allocated_size.bytes))
+        cache.extents = int(cache.size.bytes // pe)
+        log.info('Adding cache pool <%s>: %d bytes, %d byte chunks, %s' %
+                 (cache.name, cache.size.bytes, cache.chunk_size, cache.mode))
+
+    def add_thin_volume(self, volume):
+        """Thin volumes do not allocate extents, their size is virtual and
+        percentages are relative to the size of their pool
+        """
+        volume.pool = self.get_thin_pool(volume.pool_name)
+        if volume.percent_string:
+            volume.size = Size(volume.pool.size.bytes *
+                               volume.percent_string.value)
+        extents = int(volume.size.bytes // self.pe_size.bytes)
+        volume.size = Size(extents * self.pe_size.bytes)
+        volume.extents = extents
+        log.info('Adding thin volume <%s>: %d bytes in %s' %
+                 (volume.name, volume.size.bytes, volume.pool.name))
+        self.logical_volumes.append(volume)
 
     def add_logical_volume(self, volume):
+        if volume.pool_name:
+            return self.add_thin_volume(volume)
+        free_space = self.free_space
+        if volume.cache:
+            self.add_cache_pool(volume)
+            free_space -= volume.cache.allocated_size
+            # the origin cannot spill onto the cache physical volumes
+            pe = self.pe_size.bytes
+            free_space = min(free_space, Size(sum(
+                pv.reference.size.bytes // pe * pe
+                for pv in volume.physical_volumes)))
+        if volume.stripes and volume.stripes > len(
+                volume.physical_volumes or self.physical_volumes):
+            raise LVMValidationError(
+                "Volume '{}' has more stripes than physical volumes".format(
+                    volume.name))
         if volume.percent_string:
-            volume.size = self.convert_percent_to_size(
-                volume.percent_string.value, volume.percent_string.free)
+            if volume.percent_string.free:
+                volume.size = Size(free_space.bytes *
+                                   volume.percent_string.value)
+            else:
+                volume.size = self.get_percentage_of_usable_space(
+                    volume.percent_string.value)
+        if volume.is_thin_pool:
+            volume.reserve_metadata(self.free_space, self.pe_size)
         self._validate_volume(volume)
         extents = int(volume.size.bytes / self.pe_size.bytes)
         unused = volume.size % self.pe_size
         log.info('Adding logical volume <%s>: %d / %d LE, unusable: %s' %
                  (volume.name, volume.size.bytes, extents, unused))
-        allocated_pe = self.current_pe + extents
+        # thin pool metadata, cache pool and cache pool metadata
+        reserved = (volume.allocated_size - volume.size).bytes / \
+            self.pe_size.bytes
+        allocated_pe = self.current_pe + extents + reserved
         log.debug('allocated: %d , total: %d' % (allocated_pe, self.extents))
-        if allocated_pe == self.extents:
+        if allocated_pe >= int(self.extents):
             # Shrink extents by 1 to avoid overrun
             log.info('Shrinking volume by 1 extent')
             extents -= 1
+        if volume.stripes:
+            # each stripe gets the same number of extents
+            extents -= extents % volume.stripes
         volume.extents = extents
         self.logical_volumes.append(volume)
 
@@ -131,7 +247,21 @@ class LogicalVolume(object):
                  size_or_percent,
                  file_system=None,
                  mount_point=None,
-                 fsck_option=0):
+                 fsck_option=0,
+                 stripes=None,
+                 stripe_size=None,
+                 physical_volumes=None,
+                 pool_name=None,
+                 cache=None):
+        """
+        :param stripes: number of physical volumes to stripe the volume across
+        :param stripe_size: bytes, lvcreate default when None
+        :param physical_volumes: PhysicalVolume objects to allocate from, any
+            physical volume of the group when None
+        :param pool_name: create a thin volume in this thin pool, size is
+            then virtual
+        :param cache: a CachePool, on faster physical volumes
+        """
         self.name = name
         if isinstance(size_or_percent, PercentString):
             self.size = None
@@ -144,12 +274,37 @@ class LogicalVolume(object):
         self.mount_point = mount_point
         self.fsck_option = fsck_option
 
+        self.stripes = stripes
+        self.stripe_size = stripe_size
+        self.physical_volumes = physical_volumes
+        self.pool_name = pool_name
+        self.pool = None
+        self.cache = cache
+        if cache:
+            cache.name = cache.name or '%s_cache' % name
+
         # extents are calculated and stored by the VolumeGroup.add_logical_volume() method
         self.extents = None
 
         self.devname = None
         self.devlinks = None
 
+    is_thin_pool = False
+
+    @property
+    def allocated_size(self):
+        """Space taken from the volume group"""
+        if self.pool_name:
+            return Size(0)
+        if self.cache:
+            return self.size + self.cache.allocated_size
+        return self.size
+
+    @property
+    def stripe_geometry(self):
+        if self.stripes and self.stripes > 1:
+            return self.stripe_size or 65536, self.stripes
+
     @property
     def devlink(self):
         if not self.devlinks:
@@ -200,3 +355,122 @@ class LogicalVolume(object):
             self.devlinks and self.devlinks[-1] or 'unlinked', self.name,
             self.size or self.percent_string, self.file_system,
             self.mount_point, self.fsck_option)
+
+
+class ThinPool(LogicalVolume):
+    """
+    A pool thin volumes allocate from. The pool itself is not a usable
+    device. Its metadata, and the spare copy lvm keeps for repairs, are
+    allocated next to it.
+    """
+    is_thin_pool = True
+
+    def __init__(self,
+                 name,
+                 size_or_percent,
+                 chunk_size=None,
+                 metadata_size=None,
+                 zero=None,
+                 **kwargs):
+        """
+        :param chunk_size: bytes, lvcreate default when None
+        :param metadata_size: bytes, sized like lvcreate when None
+        :param zero: zero newly provisioned blocks, lvm default when None
+        """
+        super(ThinPool, self).__init__(name, size_or_percent, **kwargs)
+        self.chunk_size = chunk_size
+        self.metadata_size = metadata_size and Size(metadata_size)
+        self.zero = zero
+
+    def reserve_metadata(self, free_space, pe_size):
+        """Size the metadata, and shrink the pool when it and its metadata
+        would not fit in free_space
+        """
+        if not self.metadata_size:
+            chunk_size = self.chunk_size or THIN_POOL_DEFAULT_CHUNK_SIZE
+            metadata = self.size.bytes // chunk_size * 64
+            metadata = min(max(metadata, THIN_POOL_MINIMUM_METADATA),
+                           THIN_POOL_MAXIMUM_METADATA)
+            self.metadata_size = Size(metadata)
+        # whole extents
+        pe = pe_size.bytes
+        self.metadata_size = Size(-(-self.metadata_size.bytes // pe) * pe)
+        overrun = self.size.bytes + self.metadata_allocation.bytes - \
+            free_space.bytes
+        if overrun > 0 and overrun < self.size.bytes:
+            log.info('Shrinking thin pool %s by %d bytes for its metadata' %
+                     (self.name, overrun))
+            self.size = Size(self.size.bytes - overrun)
+
+    @property
+    def metadata_allocation(self):
+        # metadata and the pool metadata spare
+        if not self.metadata_size:
+            return Size(0)
+        return Size(self.metadata_size.bytes * 2)
+
+    @property
+    def allocated_size(self):
+        return self.size + self.metadata_allocation
+
+
+class CachePool(object):
+    """
+    A dm-cache pool, allocated on fast physical volumes and attached to a
+    logical volume on slower ones. Like thin pools, its metadata and the spare
+    copy lvm keeps for repairs are allocated next to it.
+    """
+
+    def __init__(self,
+                 size_or_percent,
+                 physical_volumes,
+                 mode='writethrough',
+                 chunk_size=None,
+                 metadata_size=None,
+                 name=None):
+        """
+        :param physical_volumes: PhysicalVolume objects holding the cache
+        :param mode: writethrough or writeback
+        :param chunk_size: bytes, sized like lvcreate when None
+        :param metadata_size: bytes, sized like lvcreate when None
+        :param name: <volume>_cache when None
+        """
+        if mode not in CACHE_MODES:
+            raise LVMValidationError('Unsupported cache mode: %s' % mode)
+        if isinstance(size_or_percent, PercentString):
+            self.size = None
+            self.percent_string = size_or_percent
+        else:
+            self.size = Size(size_or_percent)
+            self.percent_string = None
+        self.physical_volumes = physical_volumes
+        self.mode = mode
+        self.chunk_size = chunk_size
+        self.metadata_size = metadata_size and Size(metadata_size)
+        self.name = name
+        self.extents = None
+
+    def reserve_metadata(self, pe_size):
+        if not self.chunk_size:
+            chunk_size = CACHE_POOL_DEFAULT_CHUNK_SIZE
+            while self.size.bytes // chunk_size > CACHE_POOL_MAXIMUM_CHUNKS:
+                chunk_size *= 2
+            self.chunk_size = chunk_size
+        if not self.metadata_size:
+            metadata = 4194304 + self.size.bytes // self.chunk_size * 88
+            self.metadata_size = Size(
+                max(metadata, CACHE_POOL_MINIMUM_METADATA))
+        # whole extents
+        pe = pe_size.bytes
+        self.metadata_size = Size(-(-self.metadata_size.bytes // pe) * pe)
+
+    @property
+    def allocated_size(self):
+        # data, metadata and the pool metadata spare
+        if not self.metadata_size:
+            return self.size
+        return self.size + Size(self.metadata_size.bytes * 2)
+
+    def __repr__(self):
+        return 'cache: %s, size: %s, mode: %s' % (
+            self.name, self.size or self.percent_string, self.mode)
@@ -1,10 +1,59 @@
 import logging
 from press.exceptions import PressCriticalException
 from press.helpers.mdadm import MDADM
+from press.helpers.mdstat import wait_for_stop, write_md_attribute
 from size import Size
 
 log = logging.getLogger(__name__)
 
+# mdadm defaults to 512KiB chunks
+DEFAULT_CHUNK_SIZE = 524288
+# level: minimum number of members
+SUPPORTED_LEVELS = {0: 2, 1: 2, 4: 3, 5: 3, 6: 4, 10: 2}
+RAID10_LAYOUTS = ('n', 'f', 'o')
+MiB = 1048576
+# mdadm reserves up to 128MiB of headroom before the data of 1.2 metadata
+MAXIMUM_DATA_OFFSET = 128 * MiB
+
+
+def parse_level(level):
+    """
+    :param level: 5, '5' or 'raid5'
+    :return: int
+    """
+    try:
+        level = int(str(level).lower().replace('raid', ''))
+    except ValueError:
+        raise ValueError('Invalid RAID level: %s' % level)
+    if level not in SUPPORTED_LEVELS:
+        raise ValueError('Unsupported RAID level: %s' % level)
+    return level
+
+
+def raid10_copies(layout):
+    """
+    :param layout: n2, f2, o3...
+    :return: number of copies of each chunk
+    """
+    if not layout:
+        return 2
+    if layout[0] not in RAID10_LAYOUTS or not layout[1:].isdigit() or \
+            int(layout[1:]) < 2:
+        raise ValueError('Invalid RAID10 layout: %s' % layout)
+    return int(layout[1:])
+
+
+def metadata_reserve(member_size):
+    """A conservative estimate of the space taken by 1.2 metadata on a
+    member: mdadm shrinks the headroom of small members, so that it stays
+    under 0.1% of the member
+    """
+    data_offset = MAXIMUM_DATA_OFFSET
+    while data_offset > MiB and data_offset * 1024 > member_size:
+        data_offset //= 2
+    # superblock and bitmap
+    return data_offset + MiB
+
 
 class SoftwareRAID(object):
     raid_type = ''
@@ -22,20 +71,36 @@ class MDRaid(SoftwareRAID):
                  file_system=None,
                  mount_point=None,
                  fsck_option=0,
-                 pv_name=None):
+                 pv_name=None,
+                 chunk_size=None,
+                 assume_clean=False,
+                 bitmap=None,
+                 resync_speed_limit=None,
+                 layout=None):
         """
         Logical representation of a mdadm controlled RAID
         :param devname: /dev/mdX
-        :param level: 0, 1
+        :param level: 0, 1, 4, 5, 6 or 10
         :param members: Partition objects that represent member disks
         :param spare_members: (optional) Partition objects that represent spare disks
         :param file_system: (optional) A file system object, if that is your intent
         :param mount_point: (optional) where to mount, needs file system
         :param pv_name: (optional) Am I a pv? if so, file_system and mount_point are ignored
+        :param chunk_size: (optional) chunk size in bytes of striped levels,
+            mdadm chooses when None
+        :param assume_clean: (optional) skip the initial resync, only safe on
+            blank disks
+        :param bitmap: (optional) internal or none, mdadm chooses when None
+        :param resync_speed_limit: (optional) KiB/s, throttle the resync until
+            restore_resync_speed() is called
+        :param layout: (optional) data layout passed to mdadm, n2, f2 or o2
+            style for level 10, left-symmetric style for levels 5 and 6
         """
 
         self.devname = devname
-        self.level = level
+        self.level = parse_level(level)
+        self.layout = layout
+        self.copies = self.level == 10 and raid10_copies(layout) or 1
         self.members = members
         self.spare_members = spare_members or []
         self.file_system = file_system
@@ -45,6 +110,34 @@ class MDRaid(SoftwareRAID):
         self.allocated = False
         self.mdadm = MDADM()
         self.fsck_option = fsck_option
+        self.chunk_size = chunk_size
+        self.assume_clean = assume_clean
+        self.bitmap = bitmap
+        self.resync_speed_limit = resync_speed_limit
+        self.resync_throttled = False
+
+    @property
+    def data_disks(self):
+        """Number of members holding data in a stripe"""
+        members = len(self.members)
+        if self.level in (4, 5):
+            return members - 1
+        if self.level == 6:
+            return members - 2
+        if self.level == 10:
+            return members // self.copies
+        if self.level == 0:
+            return members
+        return 0
+
+    @property
+    def stripe_geometry(self):
+        """
+        :return: (chunk size, data disks), None for levels without stripes
+        """
+        if self.data_disks < 1 or self.level == 1:
+            return None
+        return self.chunk_size or DEFAULT_CHUNK_SIZE, self.data_disks
 
     @staticmethod
     def _get_partition_devnames(members):
@@ -58,20 +151,45 @@ class MDRaid(SoftwareRAID):
 
         return disks
 
+    def validate(self):
+        minimum = SUPPORTED_LEVELS[self.level]
+        if len(self.members) < minimum:
+            raise PressCriticalException(
+                '%s: RAID %d requires at least %d members' %
+                (self.devname, self.level, minimum))
+        if self.copies > len(self.members):
+            raise PressCriticalException(
+                '%s: %d copies require as many members' %
+                (self.devname, self.copies))
+
     def calculate_size(self):
-        for member in self.members:
+        """Usable size of the array, based on the smallest member for
+        redundant levels
+        """
+        for member in self.members + self.spare_members:
             if not member.allocated:
                 raise PressCriticalException(
                     'Member is not allocated, cannot calculate size')
+        self.validate()
 
-        if self.level == 0:
-            accumulated_size = Size(0)
-            for member in self.members:
-                accumulated_size += member.size
-            self.size = accumulated_size
+        sizes = [member.size.bytes - metadata_reserve(member.size.bytes)
+                 for member in self.members]
+        if self.stripe_geometry:
+            # members are used in whole chunks
+            chunk_size = self.stripe_geometry[0]
+            sizes = [size - size % chunk_size for size in sizes]
 
-        if self.level == 1:
-            self.size = self.members[0].size
+        if self.level == 0:
+            size = sum(sizes)
+        elif self.level == 1:
+            size = min(sizes)
+        elif self.level == 10:
+            size = min(sizes) * len(sizes) // self.copies
+            if self.stripe_geometry:
+                size -= size % self.stripe_geometry[0]
+        else:
+            size = min(sizes) * self.data_disks
+        self.size = Size(size)
 
     def create(self):
         """
@@ -85,9 +203,31 @@ class MDRaid(SoftwareRAID):
             self.devname,
             self.level,
             member_partitions,
-            spare_partitions,
+            spares=spare_partitions,
+            layout=self.layout,
+            chunk=self.stripe_geometry and self.chunk_size,
+            assume_clean=self.assume_clean,
+            bitmap=self.bitmap,
         )
 
+    def throttle_resync(self):
+        """Limit the speed of the initial resync, so that it does not compete
+        with the installation for the members"""
+        if not self.resync_speed_limit or self.assume_clean:
+            return
+        log.info('Limiting resync of %s to %d KiB/s' %
+                 (self.devname, self.resync_speed_limit))
+        write_md_attribute(self.devname, 'sync_speed_max',
+                           self.resync_speed_limit)
+        self.resync_throttled = True
+
+    def restore_resync_speed(self):
+        if not self.resync_throttled:
+            return
+        log.info('Restoring resync speed of %s' % self.devname)
+        write_md_attribute(self.devname, 'sync_speed_max', 'system')
+        self.resync_throttled = False
+
     def stop(self):
         self.mdadm.stop(self.devname)
 
@@ -114,8 +254,7 @@ class MDRaid(SoftwareRAID):
             # for member in active_members:
             #     self.mdadm.fail_remove_member(self.devname, member)
             self.remove()
-            import time
-            time.sleep(2)
+            wait_for_stop(self.devname)
             for member in active_members:
                 self.mdadm.zero_superblock(member)
                 self.mdadm.zero_4k(member)
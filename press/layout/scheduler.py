@@ -0,0 +1,143 @@
+"""
+Dependency graph execution for layout operations
+
+A layout is compiled into operations (partition a disk, create an array, a
+volume group, a file system...) each depending on the operations it needs.
+Operations run as soon as their dependencies are met, up to max_workers at a
+time, so that slow steps like mkfs on large devices overlap.
+"""
+import logging
+import sys
+import threading
+import time
+
+import six
+
+log = logging.getLogger(__name__)
+
+
+class SchedulerException(Exception):
+    pass
+
+
+class Operation(object):
+
+    def __init__(self, name, func, args=(), dependencies=None):
+        """
+        :param name: used in logs
+        :param func: callable
+        :param args: arguments passed to func
+        :param dependencies: operations which must complete first
+        """
+        self.name = name
+        self.func = func
+        self.args = args
+        self.dependencies = list(dependencies or [])
+        self.started = None
+        self.finished = None
+
+    @property
+    def duration(self):
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def run(self):
+        self.started = time.time()
+        try:
+            return self.func(*self.args)
+        finally:
+            self.finished = time.time()
+
+    def __repr__(self):
+        return self.name
+
+
+class Scheduler(object):
+
+    def __init__(self, max_workers=0):
+        """
+        :param max_workers: maximum number of concurrent operations, 0 means
+            no limit
+        """
+        self.max_workers = max_workers
+        self.operations = list()
+
+    def add(self, name, func, args=(), after=None):
+        """Add an operation to the graph
+
+        Dependencies must already be part of the graph, which keeps it acyclic
+
+        :param after: a list of operations this operation depends on
+        :return: Operation
+        """
+        for dependency in after or []:
+            if dependency not in self.operations:
+                raise SchedulerException('%s depends on unknown operation %s'
+                                         % (name, dependency))
+        operation = Operation(name, func, args, after)
+        self.operations.append(operation)
+        return operation
+
+    def run(self):
+        """Run every operation, respecting dependencies
+
+        After a failure no new operation is started. Operations in progress
+        are waited upon, then the first exception is raised again.
+        """
+        pending = list(self.operations)
+        running = set()
+        done = set()
+        errors = list()
+        condition = threading.Condition()
+        start = time.time()
+
+        def execute(operation):
+            try:
+                operation.run()
+                log.info('%s: completed in %.2fs' % (operation,
+                                                     operation.duration))
+            except Exception:
+                log.error('%s: failed after %.2fs' % (operation,
+                                                      operation.duration))
+                errors.append(sys.exc_info())
+            with condition:
+                running.discard(operation)
+                done.add(operation)
+                condition.notify_all()
+
+        with condition:
+            while running or (pending and not errors):
+                if not errors:
+                    for operation in list(pending):
+                        if self.max_workers and \
+                                len(running) >= self.max_workers:
+                            break
+                        if not all(dependency in done
+                                   for dependency in operation.dependencies):
+                            continue
+                        log.debug('Starting %s' % operation)
+                        pending.remove(operation)
+                        running.add(operation)
+                        thread = threading.Thread(
+                            target=execute, args=(operation,))
+                        thread.daemon = True
+                        thread.start()
+                if not running:
+                    break
+                condition.wait()
+
+        self.log_timings(time.time() - start)
+        if errors:
+            six.reraise(*errors[0])
+        if pending:
+            raise SchedulerException('Could not schedule: %s' % pending)
+
+    def log_timings(self, elapsed):
+        completed = [op for op in self.operations if op.duration is not None]
+        total = sum(op.duration for op in completed)
+        log.info('%d operations completed in %.2fs, %.2fs of work' %
+                 (len(completed), elapsed, total))
+        for operation in sorted(
+                completed, key=lambda op: op.duration, reverse=True):
+            log.debug('%8.2fs %s' % (operation.duration, operation))
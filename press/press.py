@@ -1,14 +1,15 @@
 from __future__ import absolute_import
 
 import logging
+import threading
 
 from functools import wraps
-from size import Size
 
 # Press imports
 from press.exceptions import PressOrchestrationError, ImageValidationException
 from press.generators.layout import layout_from_config
-from press.generators.image import imagefile_generator
+from press.generators.image import (imagefile_generator, image_cache_generator,
+                                    is_block_image)
 from press.helpers import deployment
 from press.helpers.kexec import kexec
 from press.layout.layout import MountHandler
@@ -18,6 +19,8 @@ from press.hooks.hooks import run_hooks
 
 log = logging.getLogger('press')
 
+_default_prefetch_directory = '/dev/shm/press'
+
 
 def run_if_layout(f):
 
@@ -43,6 +46,13 @@ def run_if_imagefile(f):
     return wrapper
 
 
+def download_progress(total, done):
+    if not total:
+        log.debug('Downloading: %d bytes' % done)
+        return
+    log.debug('Downloading: %.1f%%' % (float(done) / float(total) * 100))
+
+
 class PressOrchestrator(object):
     """"""
 
@@ -89,6 +99,9 @@ class PressOrchestrator(object):
 
         self.layout = None
         self.imagefile = None
+        self.image_cache = None
+        self.prefetch_thread = None
+        self.prefetch_error = None
 
         self.image_target = self.press_configuration.get('target')
         self.post_configuration_target = VendorRegistry.targets.get(
@@ -116,15 +129,33 @@ class PressOrchestrator(object):
             self.layout = layout_from_config(
                 self.press_configuration['layout'],
                 parted_path=self.parted_path,
-                partition_start=Size(self.partition_start).bytes,
-                alignment=Size(self.alignment).bytes,
-                pe_size=self.lvm_pe_size)
+                partition_start=self.partition_start,
+                alignment=self.alignment,
+                pe_size=self.lvm_pe_size,
+                reserved_devices=self.reserved_devices)
+
+    @property
+    def reserved_devices(self):
+        reserved = list()
+        cache_device = self.press_configuration.get('image', {}).get(
+            'cache', {}).get('device')
+        if cache_device:
+            reserved.append(cache_device)
+        return reserved
 
     def init_imgfile(self):
         if 'image' in self.press_configuration:
+            if self.has_layout and is_block_image(
+                    self.press_configuration['image']):
+                raise PressOrchestrationError(
+                    'A block image cannot be combined with a layout')
+            cache_config = self.press_configuration['image'].get('cache')
+            if cache_config:
+                self.image_cache = image_cache_generator(cache_config)
+                self.image_cache.open()
             self.imagefile = imagefile_generator(
                 self.press_configuration['image'], self.deployment_root,
-                self.http_proxy)
+                self.http_proxy, self.image_cache, self.reserved_devices)
 
     def init_target(self):
         if 'target' in self.press_configuration.get('target'):
@@ -145,15 +176,26 @@ class PressOrchestrator(object):
         self.mount_handler = MountHandler(self.deployment_root, self.layout)
         self.mount_handler.mount_physical()
 
+    @run_if_layout
+    def remount_file_systems(self):
+        if self.mount_handler:
+            self.mount_handler.remount_physical()
+
     @run_if_layout
     def mount_pseudo_file_systems(self):
         if self.mount_handler:
             self.mount_handler.mount_pseudo()
 
-    @run_if_layout
+    def restore_resync_speed(self):
+        if self.has_layout:
+            self.layout.restore_resync_speed()
+
     def teardown(self):
+        self.restore_resync_speed()
         if self.mount_handler and self.perform_teardown:
             self.mount_handler.teardown()
+        if self.image_cache:
+            self.image_cache.close()
 
     @run_if_layout
     def write_fstab(self):
@@ -165,20 +207,95 @@ class PressOrchestrator(object):
     def has_imagefile(self):
         return bool(self.imagefile)
 
+    @property
+    def has_block_image(self):
+        return self.has_imagefile and is_block_image(
+            self.press_configuration['image'])
+
     @run_if_imagefile
     def fetch_image(self):
+        if self.imagefile.cache_hit:
+            log.info('Using cached image: %s' % self.imagefile.full_filename)
+            return
+
         if self.imagefile.image_exists:
             if self.imagefile.can_validate:
                 log.info('Image is present on file system. Hashing image')
                 self.imagefile.hash_file()
             return
 
-        def our_callback(total, done):
-            log.debug('Downloading: %.1f%%' %
-                      (float(done) / float(total) * 100))
-
         log.info('Starting Download...')
-        self.imagefile.download(our_callback)
+        self.imagefile.download(download_progress)
+        log.info('done')
+
+    @property
+    def can_prefetch(self):
+        """Prefetch remote images while the layout is being applied
+
+        Streamed images are extracted as they download, they are never
+        prefetched. Block images have no layout to overlap with.
+        """
+        return bool(self.has_layout and self.has_imagefile and
+                    self.press_configuration['image'].get('prefetch') and
+                    not self.imagefile.image_exists and
+                    not self.imagefile.can_stream)
+
+    def _prefetch(self):
+        try:
+            self.fetch_image()
+        except Exception as e:
+            log.error('Error prefetching image: %s' % e)
+            self.prefetch_error = e
+
+    @run_if_imagefile
+    def start_prefetch(self):
+        """
+        Download the image to a RAM backed directory (tmpfs) in the
+        background. The deployment root is not mounted yet, so the image has
+        to fit in prefetch_directory, otherwise it is downloaded once the file
+        systems are mounted.
+        """
+        directory = self.press_configuration['image'].get(
+            'prefetch_directory', _default_prefetch_directory)
+        deployment.recursive_makedir(directory)
+        size = self.imagefile.remote_size()
+        available = deployment.free_space(directory)
+        if not size or size > available:
+            log.warning('Cannot prefetch image into %s, image size: %s, '
+                        'available: %d bytes' % (directory, size, available))
+            return
+
+        self.imagefile.set_download_directory(directory)
+        run_hooks('pre-image-acquire', self.press_configuration)
+        log.info('Prefetching image to %s' % directory)
+        self.prefetch_thread = threading.Thread(target=self._prefetch)
+        self.prefetch_thread.daemon = True
+        self.prefetch_thread.start()
+
+    def wait_for_prefetch(self):
+        """The image is validated and extracted once it is complete, the
+        download only overlaps with applying the layout
+        """
+        log.info('Waiting for image prefetch to complete')
+        self.prefetch_thread.join()
+        if self.prefetch_error:
+            raise self.prefetch_error
+        log.info('Image prefetch complete')
+
+    @run_if_imagefile
+    def stream_image(self):
+        """
+        Hash and extract in a single pass, downloading remote images as we go.
+        The checksum is only known once the stream has ended, a mismatch
+        removes the extracted data.
+        """
+        log.info('Hashing and extracting image to %s' % self.deployment_root)
+        try:
+            self.imagefile.stream_extract(download_progress)
+        except Exception:
+            log.error('Error while extracting image')
+            self.imagefile.rollback()
+            raise
         log.info('done')
 
     @run_if_imagefile
@@ -190,18 +307,49 @@ class PressOrchestrator(object):
                     'Error validating image checksum')
             log.info('done')
 
+    @run_if_imagefile
+    def validate_streamed_image(self):
+        if self.imagefile.can_validate:
+            log.info('Validating image...')
+            if not self.imagefile.validate():
+                self.imagefile.rollback()
+                raise ImageValidationException(
+                    'Error validating image checksum, extracted image has '
+                    'been removed')
+            log.info('done')
+
     @run_if_imagefile
     def extract_image(self):
         log.info('Extracting image')
         self.imagefile.extract()
-        if not self.press_configuration['image'].get('keep'):
+        if self.imagefile.can_cache:
+            self.imagefile.store_in_cache()
+        elif not self.press_configuration['image'].get('keep'):
             self.imagefile.cleanup()
 
     @run_if_imagefile
-    def run_image_ops(self):
+    def run_streamed_image_ops(self):
 
         run_hooks('pre-image-acquire', self.press_configuration)
-        self.fetch_image()
+        run_hooks('pre-image-extract', self.press_configuration)
+        self.stream_image()
+        run_hooks('post-image-acquire', self.press_configuration)
+
+        run_hooks('pre-image-validate', self.press_configuration)
+        self.validate_streamed_image()
+        run_hooks('post-image-validate', self.press_configuration)
+        run_hooks('post-image-extract', self.press_configuration)
+
+    @run_if_imagefile
+    def run_image_ops(self):
+        if self.imagefile.can_stream:
+            return self.run_streamed_image_ops()
+
+        if self.prefetch_thread:
+            self.wait_for_prefetch()
+        else:
+            run_hooks('pre-image-acquire', self.press_configuration)
+            self.fetch_image()
         run_hooks('post-image-acquire', self.press_configuration)
 
         run_hooks('pre-image-validate', self.press_configuration)
@@ -254,8 +402,27 @@ class PressOrchestrator(object):
     def remove_staging_dir(self):
         deployment.recursive_remove(self.full_staging_dir)
 
+    def run_block_image(self):
+        """
+        The image holds the partition table and file systems, it is written
+        as is. There is no layout to apply and nothing mounted to configure.
+        """
+        log.info(
+            'Writing image at %s to %s' % (self.imagefile.url,
+                                           self.imagefile.device),
+            extra={'press_event': 'downloading'})
+        run_hooks("pre-image-ops", self.press_configuration)
+        self.run_image_ops()
+        log.info('Finished', extra={'press_event': 'complete'})
+
     def run(self):
         log.info('Installation is starting', extra={'press_event': 'deploying'})
+        if self.has_block_image:
+            return self.run_block_image()
+
+        if self.can_prefetch:
+            self.start_prefetch()
+
         run_hooks("pre-apply-layout", self.press_configuration)
         self.apply_layout()
 
@@ -267,6 +434,7 @@ class PressOrchestrator(object):
                 extra={'press_event': 'downloading'})
             run_hooks("pre-image-ops", self.press_configuration)
             self.run_image_ops()
+            self.remount_file_systems()
             log.info('Configuring image', extra={'press_event': 'configuring'})
             run_hooks("pre-post-config", self.press_configuration)
         else:
@@ -281,4 +449,5 @@ class PressOrchestrator(object):
         kexec_config = self.press_configuration.get('kexec')
         if kexec_config:
             self.perform_teardown = False
+            self.restore_resync_speed()
             kexec(layout=self.layout, **kexec_config)
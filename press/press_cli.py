@@ -75,11 +75,13 @@ def parse_args(arguments):
     apply_parser.add_argument(
         '--partition-start',
         default='1MiB',
-        help='Where the first partition should start. Default 1MiB')
+        help='Where the first partition should start, or auto to start at '
+             'the first aligned offset. Default 1MiB')
     apply_parser.add_argument(
         '--alignment',
         default='1MiB',
-        help='Alignment partitions to this boundary. Default 1MiB')
+        help='Alignment partitions to this boundary, or auto to derive it '
+             'from the disk topology. Default 1MiB')
     apply_parser.add_argument(
         '--lvm-pe-size',
         default='4MiB',
@@ -18,6 +18,9 @@ class DebianTarget(LinuxTarget):
 
     mdadm_conf = '/etc/mdadm/mdadm.conf'
     interfaces_path = '/etc/network/interfaces'
+    initramfs_modules = '/etc/initramfs-tools/modules'
+    # cache_check and thin_check, run by lvm before activating the volumes
+    persistent_data_package = 'thin-provisioning-tools'
 
     __apt_command = 'DEBIAN_FRONTEND=noninteractive apt-get -y'
 
@@ -166,11 +169,23 @@ class DebianTarget(LinuxTarget):
             self.install_package('mdadm')
             LinuxTarget.write_mdadm_configuration(self)
 
+    def write_device_mapper_configuration(self):
+        modules = self.get_device_mapper_modules()
+        if not modules:
+            return
+        self.install_package(self.persistent_data_package)
+        log.info('Adding %s to the initramfs' % ' '.join(modules))
+        deployment.write(
+            self.join_root(self.initramfs_modules),
+            '\n'.join(modules) + '\n', append=True)
+        self.chroot('update-initramfs -u -k all')
+
     def run(self):
         super(DebianTarget, self).run()
         self.localization()
         self.generate_locales()
         self.write_mdadm_configuration()
+        self.write_device_mapper_configuration()
         self.write_interfaces()
         self.update_host_keys()
         self.remove_resolvconf()
@@ -14,6 +14,10 @@ class LinuxTarget(Target):
 
     mdadm_conf = '/etc/mdadm.conf'
 
+    # device mapper targets lvm needs at boot for cached and thin volumes
+    dm_cache_modules = ('dm-cache', 'dm-cache-smq')
+    dm_thin_modules = ('dm-thin-pool', )
+
     ssh_protocol_2_key_types = ('rsa', 'ecdsa', 'ed25519', 'dsa')
     locale_command = "/usr/sbin/locale-gen"
 
@@ -241,6 +245,21 @@ class LinuxTarget(Target):
         deployment.write(
             self.join_root(self.mdadm_conf), mdraid_data + '\n', append=True)
 
+    def get_device_mapper_modules(self):
+        """
+        :return: the kernel modules the initramfs needs to activate the cached
+            and thin logical volumes of the layout
+        """
+        modules = list()
+        if not self.layout:
+            return modules
+        volumes = self.layout.logical_volumes
+        if any(lv.cache for lv in volumes):
+            modules.extend(self.dm_cache_modules)
+        if any(lv.is_thin_pool for lv in volumes):
+            modules.extend(self.dm_thin_modules)
+        return modules
+
     # noinspection PyMethodMayBeStatic
     def get_product_name(self):
         res = cli.run('dmidecode -s system-product-name', raise_exception=True)
@@ -47,6 +47,7 @@ class EL6Target(EnterpriseLinuxTarget, Grub):
                     'Error installing required packages for grub')
 
     def rebuild_initramfs(self):
+        self.write_device_mapper_configuration()
         _required_packages = ['dracut', 'dracut-kernel']
         if not self.packages_exist(_required_packages):
             if not self.install_package(_required_packages):
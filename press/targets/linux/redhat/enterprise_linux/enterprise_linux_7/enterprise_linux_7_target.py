@@ -57,6 +57,7 @@ class EL7Target(EnterpriseLinuxTarget, Grub2):
             self.revert_yum(self.proxy)
 
     def rebuild_initramfs(self):
+        self.write_device_mapper_configuration()
         if not self.package_exists('dracut-config-generic'):
             self.baseline_yum(self.proxy)
             self.install_package('dracut-config-generic')
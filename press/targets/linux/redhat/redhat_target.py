@@ -16,6 +16,9 @@ class RedhatTarget(LinuxTarget):
     yum_config_file = '/etc/yum.conf'
     yum_config_backup = '/etc/yum.conf_bak'
     release_file = '/etc/redhat-release'
+    # cache_check and thin_check, run by lvm before activating the volumes
+    persistent_data_package = 'device-mapper-persistent-data'
+    dracut_device_mapper_conf = '/etc/dracut.conf.d/press-device-mapper.conf'
 
     def __init__(self, press_configuration, layout, root, chroot_staging_dir):
         super(RedhatTarget, self).__init__(press_configuration, layout, root,
@@ -209,6 +212,24 @@ class RedhatTarget(LinuxTarget):
         if 'Red Hat' in os_id:
             self.remove_repo(rhel_repo_name)
 
+    def write_device_mapper_configuration(self):
+        """
+        The dracut lvm module only activates cached and thin volumes when
+        their kernel modules and metadata checks are part of the image
+        """
+        modules = self.get_device_mapper_modules()
+        if not modules:
+            return
+        if not self.package_exists(self.persistent_data_package):
+            self.baseline_yum(self.proxy)
+            self.install_package(self.persistent_data_package)
+            self.revert_yum(self.proxy)
+        log.info('Adding %s to the initramfs' % ' '.join(modules))
+        deployment.write(
+            self.join_root(self.dracut_device_mapper_conf),
+            'add_dracutmodules+=" lvm "\nadd_drivers+=" %s "\n' %
+            ' '.join(modules))
+
     def service_control(self, service, action):
         log.info('Running: service {} {}'.format(service, action))
         command = 'service {} {}'.format(service, action)
@@ -0,0 +1,24 @@
+import requests
+
+
+class FakeResponse(object):
+    """A streamed requests response, dropping the connection after fail_at
+    bytes when set
+    """
+
+    def __init__(self, body, status_code=200, headers=None, fail_at=None):
+        self.body = body
+        self.status_code = status_code
+        self.headers = headers or {'content-length': str(len(body))}
+        self.fail_at = fail_at
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError('%d' % self.status_code)
+
+    def iter_content(self, size):
+        end = len(self.body) if self.fail_at is None else self.fail_at
+        for offset in range(0, end, size):
+            yield self.body[offset:min(offset + size, end)]
+        if self.fail_at is not None:
+            raise requests.exceptions.ConnectionError('connection reset')
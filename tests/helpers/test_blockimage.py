@@ -0,0 +1,104 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+from press.helpers import blockimage
+
+CLUSTER_BITS = 16
+CLUSTER_SIZE = 1 << CLUSTER_BITS
+
+
+def build_qcow2(path, size, clusters):
+    """
+    Write a minimal qcow2 (v3) image. clusters maps a guest cluster index to
+    its data, 'zero' for a zero cluster, or ('compressed', data).
+    """
+    l1_offset = CLUSTER_SIZE
+    l2_offset = CLUSTER_SIZE * 2
+    data = bytearray(CLUSTER_SIZE * 3)
+    l2_table = [0] * (CLUSTER_SIZE // 8)
+
+    for index, content in sorted(clusters.items()):
+        host_offset = len(data)
+        if content == 'zero':
+            l2_table[index] = blockimage.QCOW2_ZERO
+        elif isinstance(content, tuple):
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -12)
+            compressed = compressor.compress(content[1]) + compressor.flush()
+            sectors = (host_offset + len(compressed) - 1) // 512 - \
+                host_offset // 512
+            l2_table[index] = (blockimage.QCOW2_COMPRESSED |
+                               sectors << (62 - (CLUSTER_BITS - 8)) |
+                               host_offset)
+            data += compressed + b'\0' * (512 - len(compressed) % 512)
+        else:
+            l2_table[index] = host_offset
+            data += content
+
+    header = struct.pack('>4sIQIIQIIQQIIQQQQII', blockimage.QCOW2_MAGIC, 3, 0,
+                         0, CLUSTER_BITS, size, 0, 1, l1_offset, 0, 0, 0, 0, 0,
+                         0, 0, 4, 104)
+    data[:len(header)] = header
+    data[l1_offset:l1_offset + 8] = struct.pack('>Q', l2_offset)
+    data[l2_offset:l2_offset + CLUSTER_SIZE] = struct.pack(
+        '>%dQ' % len(l2_table), *l2_table)
+    with open(path, 'wb') as fp:
+        fp.write(data)
+
+
+class TestBlockImage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.device = os.path.join(self.tmp, 'device')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, blocks, sparse=blockimage.SPARSE_ZEROOUT):
+        with open(self.device, 'wb') as fp:
+            fp.write(b'\xff' * CLUSTER_SIZE * 8)
+        writer = blockimage.BlockWriter(
+            self.device, writers=2, sparse=sparse, zero_granularity=4096)
+        writer.open()
+        for offset, data in blocks:
+            writer.write(offset, data)
+        writer.close()
+        with open(self.device, 'rb') as fp:
+            return fp.read()
+
+    def test_raw_sparse_write(self):
+        image = b'a' * 4096 + b'\0' * 8192 + b'b' * 100
+        result = self.write(blockimage.iter_raw([image], 8192))
+
+        assert result[:len(image)] == image
+        assert result[len(image):] == b'\xff' * (len(result) - len(image))
+
+        result = self.write(
+            blockimage.iter_raw([image], 8192), sparse=blockimage.SPARSE_SKIP)
+        assert result[4096:12288] == b'\xff' * 8192
+
+    def test_qcow2(self):
+        path = os.path.join(self.tmp, 'image.qcow2')
+        size = CLUSTER_SIZE * 5 + 1000
+        build_qcow2(
+            path, size, {
+                0: b'x' * CLUSTER_SIZE,
+                1: ('compressed', b'y' * CLUSTER_SIZE),
+                2: 'zero',
+                5: b'z' * CLUSTER_SIZE,
+            })
+        reader = blockimage.QCOW2Reader(path)
+        assert reader.size == size
+        blocks = blockimage.fill_gaps(
+            blockimage.coalesce(reader.clusters(), CLUSTER_SIZE * 4), size)
+        result = self.write(blocks)
+        reader.close()
+
+        expected = (b'x' * CLUSTER_SIZE + b'y' * CLUSTER_SIZE +
+                    b'\0' * CLUSTER_SIZE * 3 + b'z' * 1000)
+        assert result[:size] == expected
+        assert result[size:] == b'\xff' * (len(result) - size)
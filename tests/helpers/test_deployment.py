@@ -0,0 +1,115 @@
+import gzip
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import mock
+import pytest
+
+from press.helpers import deployment
+
+
+class TestDetectCompression(unittest.TestCase):
+
+    def test_detect_compression(self):
+        assert deployment.detect_compression(b'\x1f\x8b\x08\x00') == 'gzip'
+        assert deployment.detect_compression(b'BZh91AY') == 'bzip2'
+        assert deployment.detect_compression(b'\xfd7zXZ\x00\x00') == 'xz'
+        assert deployment.detect_compression(b'\x28\xb5\x2f\xfd\x00') == \
+            'zstd'
+        assert deployment.detect_compression(b'\x04\x22\x4d\x18\x64') == \
+            'lz4'
+        assert deployment.detect_compression(b'etc/\x00\x00\x00') is None
+        assert deployment.detect_compression(b'') is None
+
+    @mock.patch('press.helpers.deployment.cli.find_in_path')
+    def test_decompress_command_prefers_threaded(self, find_in_path):
+        find_in_path.return_value = '/usr/bin/pigz'
+        assert deployment.decompress_command('gzip') == 'pigz -dc'
+
+        find_in_path.side_effect = lambda name: name == 'gzip' or None
+        assert deployment.decompress_command('gzip') == 'gzip -dc'
+
+        find_in_path.side_effect = lambda name: None
+        with pytest.raises(deployment.TarStreamException):
+            deployment.decompress_command('zstd')
+
+
+class TestTarStream(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.target = os.path.join(self.tmp, 'target')
+        os.mkdir(self.target)
+
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w') as tar:
+            info = tarfile.TarInfo('hello')
+            info.size = 5
+            tar.addfile(info, io.BytesIO(b'world'))
+        self.archive = gzip.compress(data.getvalue())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    @pytest.mark.skipif(not shutil.which('gzip'), reason='requires gzip')
+    def test_stream_extract(self):
+        extractor = deployment.TarStream(
+            deployment.detect_compression(self.archive), chdir=self.target)
+        for idx in range(0, len(self.archive), 16):
+            extractor.write(self.archive[idx:idx + 16])
+        assert extractor.close() == 0
+
+        with open(os.path.join(self.target, 'hello')) as fp:
+            assert fp.read() == 'world'
+
+    @mock.patch('press.helpers.deployment.decompress_command',
+                return_value='pigz -dc')
+    @mock.patch('press.helpers.deployment.subprocess.Popen')
+    def test_decompressor_killed(self, popen, _):
+        decompressor, tar = mock.Mock(), mock.Mock()
+        # SIGKILL, tar sees a clean end of stream
+        decompressor.wait.return_value = -9
+        tar.wait.return_value = 0
+        popen.side_effect = [decompressor, tar]
+        extractor = deployment.TarStream('gzip', chdir=self.target)
+        extractor.write(self.archive)
+        with pytest.raises(deployment.TarStreamException):
+            extractor.close()
+        assert extractor.returncode == -9
+
+    @mock.patch('press.helpers.deployment.decompress_command',
+                return_value='pigz -dc')
+    @mock.patch('press.helpers.deployment.subprocess.Popen')
+    def test_popen_failure(self, popen, _):
+        decompressor = mock.Mock()
+        decompressor.poll.return_value = None
+        popen.side_effect = [decompressor, OSError(2, 'No such file')]
+        archive = os.path.join(self.tmp, 'image.tar.gz')
+        with open(archive, 'wb') as fp:
+            fp.write(self.archive)
+
+        with mock.patch('press.helpers.deployment.open', mock.mock_open(),
+                        create=True) as mock_open:
+            with pytest.raises(OSError):
+                deployment.TarStream('gzip', chdir=self.target,
+                                     archive_path=archive)
+        decompressor.stdout.close.assert_called_once_with()
+        decompressor.kill.assert_called_once_with()
+        decompressor.wait.assert_called_once_with()
+        mock_open.return_value.close.assert_called_once_with()
+
+    def test_wipe_directory(self):
+        os.makedirs(os.path.join(self.target, 'a/b'))
+        with open(os.path.join(self.target, 'a/b/c'), 'w') as fp:
+            fp.write('c')
+        os.symlink('a', os.path.join(self.target, 'link'))
+
+        deployment.wipe_directory(self.target)
+
+        assert os.path.isdir(self.target)
+        assert os.listdir(self.target) == []
+
@@ -0,0 +1,96 @@
+import os
+import struct
+import tempfile
+import unittest
+import uuid
+
+import pytest
+
+from press.helpers import disklabel
+
+MiB = 1048576
+SIZE = 64 * MiB
+
+
+class TestDiskLabel(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.ftruncate(fd, SIZE)
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def read(self, offset, length):
+        with open(self.path, 'rb') as fp:
+            fp.seek(offset)
+            return fp.read(length)
+
+    def read_gpt_header(self, lba):
+        header = self.read(lba * 512, 92)
+        fields = list(struct.unpack('<8sIIIIQQQQ16sQIII', header))
+        crc = fields[3]
+        fields[3] = 0
+        assert disklabel.crc32(struct.pack('<8sIIIIQQQQ16sQIII',
+                                           *fields)) == crc
+        return fields
+
+    def test_gpt(self):
+        label = disklabel.DiskLabel(self.path, 'gpt')
+        assert label.add_partition('BIOS boot partition', MiB,
+                                   ['bios_grub']) == 1
+        assert label.add_partition('root', 10 * MiB, ['lvm']) == 2
+        label.write()
+
+        assert self.read(510, 2) == disklabel.MBR_SIGNATURE
+        primary = self.read_gpt_header(1)
+        last_lba = SIZE // 512 - 1
+        assert primary[0] == disklabel.GPT_SIGNATURE
+        assert primary[5:7] == [1, last_lba]
+
+        backup = self.read_gpt_header(last_lba)
+        assert backup[5:7] == [last_lba, 1]
+        assert backup[10] == last_lba - 32
+
+        entries = self.read(2 * 512, 128 * 128)
+        assert disklabel.crc32(entries) == primary[13]
+        assert self.read(backup[10] * 512, 128 * 128) == entries
+
+        type_guid, _, first, last = struct.unpack('<16s16sQQ',
+                                                  entries[128:176])
+        assert uuid.UUID(bytes_le=type_guid) == disklabel.GPT_TYPE_LVM
+        # placed like parted, one alignment unit after partition 1
+        assert (first, last) == (6144, 6144 + 10 * MiB // 512)
+
+    def test_msdos_logical(self):
+        label = disklabel.DiskLabel(self.path, 'msdos')
+        label.add_partition('primary', 10 * MiB, ['boot'])
+        assert label.add_partition('logical', 10 * MiB) == 5
+        assert label.add_partition('logical', 10 * MiB, ['lvm']) == 6
+        label.write()
+
+        mbr = self.read(0, 512)
+        boot, part_type, first = struct.unpack('<B3xB3xI', mbr[446:458])
+        assert (boot, part_type, first) == (0x80, 0x83, 2048)
+        part_type, extended_lba = struct.unpack('<4xB3xI', mbr[462:474])
+        assert part_type == disklabel.MBR_TYPE_EXTENDED
+
+        # follow the chain of extended boot records
+        ebr_lba = extended_lba
+        starts = []
+        while True:
+            ebr = self.read(ebr_lba * 512, 512)
+            assert ebr[510:] == disklabel.MBR_SIGNATURE
+            relative, = struct.unpack('<I', ebr[454:458])
+            starts.append(ebr_lba + relative)
+            next_ebr, = struct.unpack('<I', ebr[470:474])
+            if not next_ebr:
+                break
+            ebr_lba = extended_lba + next_ebr
+        assert starts == [p.first_lba for p in label.logical_partitions]
+
+    def test_too_large(self):
+        label = disklabel.DiskLabel(self.path, 'gpt')
+        with pytest.raises(disklabel.DiskLabelException):
+            label.add_partition('root', SIZE)
@@ -0,0 +1,93 @@
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from press.helpers.image_cache import ImageCache
+
+CHECKSUM = 'da39a3ee5e6b4b0d3255bfef95601890afd80709'
+
+
+class TestImageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = ImageCache(os.path.join(self.tmp, 'cache'), max_size=300)
+        self.cache.open()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def image(self, name, size):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as fp:
+            fp.write(b'\0' * size)
+        return path
+
+    def entry(self, name, size, mtime):
+        path = os.path.join(self.cache.path, name)
+        with open(path, 'wb') as fp:
+            fp.write(b'\0' * size)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_lookup(self):
+        assert self.cache.lookup('SHA1', CHECKSUM) is None
+        path = self.entry('sha1-%s' % CHECKSUM, 10, 1000)
+        assert self.cache.lookup('SHA1', CHECKSUM.upper()) == path
+        # a hit counts as a use
+        assert os.path.getmtime(path) > 1000
+
+    def test_entries(self):
+        old = self.entry('sha1-old', 10, 1000)
+        new = self.entry('sha1-new', 20, 3000)
+        used = self.entry('sha1-used', 30, 2000)
+        self.entry('sha1-copying' + ImageCache.temp_suffix, 40, 500)
+        assert [path for _, _, path in self.cache.entries] == [old, used, new]
+        assert self.cache.usage == 60
+
+    def test_evict(self):
+        old = self.entry('sha1-old', 100, 1000)
+        used = self.entry('sha1-used', 100, 2000)
+        new = self.entry('sha1-new', 100, 3000)
+        self.cache.evict(150)
+        assert not os.path.exists(old)
+        assert not os.path.exists(used)
+        assert os.path.exists(new)
+
+    def test_store(self):
+        old = self.entry('sha1-old', 200, 1000)
+        image = self.image('image.tar.gz', 150)
+        path = self.cache.store(image, 'sha1', CHECKSUM)
+        assert path == self.cache.entry_path('sha1', CHECKSUM)
+        assert os.path.getsize(path) == 150
+        assert not os.path.exists(image)
+        # evicted to stay within max_size
+        assert not os.path.exists(old)
+
+        # larger than the whole cache
+        image = self.image('large.tar.gz', 301)
+        assert self.cache.store(image, 'sha1', 'ffff') is None
+        assert os.path.exists(image)
+
+    def test_store_across_file_systems(self):
+        image = self.image('image.tar.gz', 150)
+        rename = os.rename
+
+        def cross_device(source, destination):
+            if source == image:
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            rename(source, destination)
+
+        with mock.patch('press.helpers.image_cache.os.rename',
+                        side_effect=cross_device) as mock_rename:
+            path = self.cache.store(image, 'sha1', CHECKSUM)
+        # copied next to the entry first, then renamed into place
+        assert mock_rename.call_args[0] == (path + ImageCache.temp_suffix,
+                                            path)
+        assert os.path.getsize(path) == 150
+        assert not os.path.exists(image)
+        assert not os.path.exists(path + ImageCache.temp_suffix)
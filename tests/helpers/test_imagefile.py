@@ -0,0 +1,293 @@
+import gzip
+import hashlib
+import io
+import lzma
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import mock
+import pytest
+import requests
+
+from press.exceptions import GeneratorError, ImageValidationException
+from press.generators.image import imagefile_generator
+from press.helpers.deployment import TarStream
+from press.helpers.imagefile import DownloadCheckpoint, ImageFile
+from press.press import PressOrchestrator
+from tests.helpers.fake_http import FakeResponse
+
+URL = 'http://images.example.com/image.tar.gz'
+BLOCK = 1024
+BODY = os.urandom(BLOCK * 3 + 100)
+
+
+def ranged(body, fail_at=None):
+    """requests.get honouring Range headers, failing at the given offsets"""
+    fail_at = list(fail_at or [])
+
+    def get(url, headers=None, **kwargs):
+        start = 0
+        if headers:
+            start = int(headers['Range'][len('bytes='):].rstrip('-'))
+        fail = fail_at.pop(0) if fail_at else None
+        return FakeResponse(body[start:],
+                            status_code=start and 206 or 200,
+                            fail_at=None if fail is None else fail - start)
+    return get
+
+
+class TestDownloadCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp, 'image.tar.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_save_load(self):
+        checkpoint = DownloadCheckpoint(self.filename, URL, BLOCK)
+        assert not checkpoint.load()
+        assert not checkpoint.update(BODY[:BLOCK - 1])
+        assert checkpoint.update(BODY[BLOCK - 1:BLOCK * 2 + 10])
+        assert checkpoint.digests == [
+            hashlib.sha1(BODY[:BLOCK]).hexdigest(),
+            hashlib.sha1(BODY[BLOCK:BLOCK * 2]).hexdigest()
+        ]
+        checkpoint.save()
+
+        loaded = DownloadCheckpoint(self.filename, URL, BLOCK)
+        assert loaded.load()
+        assert loaded.digests == checkpoint.digests
+        # another image, or block size, starts over
+        assert not DownloadCheckpoint(self.filename, URL + '.1', BLOCK).load()
+        assert not DownloadCheckpoint(self.filename, URL, BLOCK * 2).load()
+
+        checkpoint.remove()
+        assert not os.path.exists(checkpoint.path)
+
+    def test_corrupt(self):
+        checkpoint = DownloadCheckpoint(self.filename, URL, BLOCK)
+        with open(checkpoint.path, 'w') as fp:
+            fp.write('{"url": "http://images.exa')
+        assert not checkpoint.load()
+        assert checkpoint.digests == []
+
+
+@mock.patch('press.helpers.imagefile.time.sleep')
+class TestDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.expected_hash = hashlib.sha256(BODY).hexdigest()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def image_file(self, **kwargs):
+        return ImageFile(
+            URL,
+            self.tmp,
+            hash_method='sha256',
+            expected_hash=self.expected_hash,
+            buffer_size=256,
+            checkpoint_interval=BLOCK,
+            **kwargs)
+
+    def partial(self, image_file, size, corrupt_block=None):
+        """Leave a partial download and its checkpoint behind"""
+        data = bytearray(BODY[:size])
+        checkpoint = DownloadCheckpoint(image_file.full_filename, URL, BLOCK)
+        checkpoint.update(bytes(data))
+        checkpoint.save()
+        if corrupt_block is not None:
+            data[corrupt_block * BLOCK] ^= 0xff
+        with open(image_file.full_filename, 'wb') as fp:
+            fp.write(data)
+        return checkpoint
+
+    def downloaded(self, image_file):
+        with open(image_file.full_filename, 'rb') as fp:
+            return fp.read()
+
+    def test_resume(self, _):
+        image_file = self.image_file()
+        checkpoint = self.partial(image_file, BLOCK * 3 + 50,
+                                  corrupt_block=1)
+        checkpoint.load()
+        # the corrupt block and everything after it is downloaded again
+        assert image_file.resume(checkpoint) == BLOCK
+        assert checkpoint.digests == [hashlib.sha1(BODY[:BLOCK]).hexdigest()]
+
+        image_file = self.image_file()
+        with mock.patch('press.helpers.imagefile.requests.get',
+                        side_effect=ranged(BODY)) as get:
+            image_file.download(None)
+        assert get.call_args[1]['headers'] == {'Range': 'bytes=%d-' % BLOCK}
+        assert self.downloaded(image_file) == BODY
+        assert image_file.validate()
+        assert not os.path.exists(checkpoint.path)
+
+    def test_range_ignored(self, _):
+        image_file = self.image_file()
+        self.partial(image_file, BLOCK * 2)
+
+        def get(url, headers=None, **kwargs):
+            return FakeResponse(BODY)
+
+        with mock.patch('press.helpers.imagefile.requests.get',
+                        side_effect=get) as get:
+            image_file.download(None)
+        assert get.call_args[1]['headers'] == {
+            'Range': 'bytes=%d-' % (BLOCK * 2)
+        }
+        # the partial file and the hash start over
+        assert self.downloaded(image_file) == BODY
+        assert image_file.validate()
+
+    def test_retry_backoff(self, sleep):
+        image_file = self.image_file(retries=2, retry_backoff=2)
+        with mock.patch('press.helpers.imagefile.requests.get',
+                        side_effect=ranged(BODY, [500, 500, 2000])):
+            image_file.download(None)
+        # progress since the previous failure starts the count over
+        assert [call[0][0] for call in sleep.call_args_list] == [2, 4, 2]
+        assert self.downloaded(image_file) == BODY
+        assert image_file.validate()
+
+        sleep.reset_mock()
+        image_file = self.image_file(retries=2, retry_backoff=2)
+        with mock.patch('press.helpers.imagefile.requests.get',
+                        side_effect=ranged(BODY, [500, 500, 500])):
+            with pytest.raises(requests.exceptions.ConnectionError):
+                image_file.download(None)
+        assert [call[0][0] for call in sleep.call_args_list] == [2, 4]
+
+
+class LocalImageTestCase(unittest.TestCase):
+    """A small gzipped tar image in a temp directory"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.target = os.path.join(self.tmp, 'target')
+        os.mkdir(self.target)
+
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w') as tar:
+            for name, content in (('etc/hostname', b'press\n'),
+                                  ('README', b'hello')):
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+        self.tar = data.getvalue()
+        self.archive = gzip.compress(self.tar)
+        self.image = os.path.join(self.tmp, 'image.tar.gz')
+        with open(self.image, 'wb') as fp:
+            fp.write(self.archive)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+
+class TestVerifyPolicy(LocalImageTestCase):
+
+    def image_file(self, **kwargs):
+        config = dict(
+            url='file://' + self.image,
+            checksum=dict(
+                method='sha256',
+                hash=hashlib.sha256(self.archive).hexdigest()),
+            chunk_size=16)
+        config.update(kwargs)
+        return imagefile_generator(config, self.target)
+
+    def test_iter_file(self):
+        progress = list()
+        image_file = self.image_file()
+        data = b''.join(
+            image_file.iter_file(lambda total, done: progress.append(done)))
+        assert data == self.archive
+        assert progress[-1] == len(self.archive)
+        assert len(progress) == -(-len(self.archive) // 16)
+
+    def test_policies(self):
+        # hashed on its own, then extracted
+        assert not self.image_file().can_stream
+        assert not self.image_file(
+            verify_policy='before_extract').can_stream
+        assert self.image_file(verify_policy='after_extract').can_stream
+        # nothing to hash
+        assert not self.image_file(verify_policy='after_extract',
+                                   checksum=None).can_stream
+        with pytest.raises(GeneratorError):
+            self.image_file(verify_policy='never')
+
+    @pytest.mark.skipif(not shutil.which('gzip'), reason='requires gzip')
+    def test_hash_while_extracting(self):
+        image_file = self.image_file(verify_policy='after_extract')
+        with mock.patch.object(image_file, 'iter_file',
+                               wraps=image_file.iter_file) as iter_file:
+            image_file.stream_extract(None)
+        # read once, for both tar and the hash
+        assert iter_file.call_count == 1
+        assert image_file.validate()
+        with open(os.path.join(self.target, 'etc/hostname')) as fp:
+            assert fp.read() == 'press\n'
+
+
+class TestStreamExtract(LocalImageTestCase):
+
+    def orchestrator(self, expected_hash):
+        orchestrator = PressOrchestrator.__new__(PressOrchestrator)
+        orchestrator.imagefile = ImageFile(
+            'file://' + self.image,
+            self.target,
+            hash_method='sha256',
+            expected_hash=expected_hash,
+            buffer_size=64,
+            verify_after_extract=True)
+        assert orchestrator.imagefile.can_stream
+        orchestrator.imagefile.stream_extract(None)
+        with open(os.path.join(self.target, 'etc/hostname')) as fp:
+            assert fp.read() == 'press\n'
+        return orchestrator
+
+    @pytest.mark.skipif(not shutil.which('gzip'), reason='requires gzip')
+    def test_valid(self):
+        orchestrator = self.orchestrator(
+            hashlib.sha256(self.archive).hexdigest())
+        orchestrator.validate_streamed_image()
+        assert sorted(os.listdir(self.target)) == ['README', 'etc']
+
+    @pytest.mark.skipif(not shutil.which('gzip'), reason='requires gzip')
+    def test_mismatch(self):
+        orchestrator = self.orchestrator(hashlib.sha256(b'').hexdigest())
+        with pytest.raises(ImageValidationException):
+            orchestrator.validate_streamed_image()
+        # the extracted image is removed, the mount point is kept
+        assert os.path.isdir(self.target)
+        assert os.listdir(self.target) == []
+
+    @pytest.mark.skipif(not shutil.which('xz'), reason='requires xz')
+    def test_short_reads(self):
+        # the 6 byte xz magic arrives one byte at a time
+        archive = lzma.compress(self.tar)
+        with open(self.image, 'wb') as fp:
+            fp.write(archive)
+        image_file = ImageFile(
+            'file://' + self.image,
+            self.target,
+            hash_method='sha256',
+            expected_hash=hashlib.sha256(archive).hexdigest(),
+            buffer_size=1,
+            verify_after_extract=True)
+        with mock.patch('press.helpers.imagefile.TarStream',
+                        wraps=TarStream) as tar_stream:
+            image_file.stream_extract(None)
+        assert tar_stream.call_args[0][0] == 'xz'
+        assert image_file.validate()
+        with open(os.path.join(self.target, 'etc/hostname')) as fp:
+            assert fp.read() == 'press\n'
@@ -0,0 +1,48 @@
+import unittest
+
+import mock
+
+from press.helpers.cli import AttributeString
+from press.helpers.lvm import LVM
+
+JSON_REPORT = '''  {
+      "report": [
+          {
+              "vg": [
+                  {"vg_name":"vglocal", "vg_size":"10733223936"},
+                  {"vg_name":"vgdata", "vg_size":"21470642176"}
+              ]
+          }
+      ]
+  }
+'''
+
+
+def output(stdout, returncode=0):
+    result = AttributeString(stdout)
+    result.returncode = returncode
+    return result
+
+
+@mock.patch('press.helpers.lvm.run')
+class TestLVMReport(unittest.TestCase):
+
+    def test_json(self, run):
+        run.return_value = output(JSON_REPORT)
+        assert LVM.report('vgs', ['vg_name', 'vg_size']) == [
+            {'vg_name': 'vglocal', 'vg_size': '10733223936'},
+            {'vg_name': 'vgdata', 'vg_size': '21470642176'}]
+        assert '--reportformat json' in run.call_args[0][0]
+        assert run.call_count == 1
+
+    def test_fallback(self, run):
+        run.side_effect = [
+            output('', returncode=3),
+            output('  vglocal:10733223936\n  vgdata:21470642176\n')]
+        assert LVM.get_volume_groups() == ['vglocal', 'vgdata']
+        assert '--noheadings --separator :' in run.call_args[0][0]
+
+    def test_batch(self, run):
+        run.return_value = output('')
+        LVM().pvcreate(['/dev/sda2', '/dev/sdb2'])
+        assert run.call_args[0][0] == 'pvcreate --force /dev/sda2 /dev/sdb2'
@@ -0,0 +1,24 @@
+import unittest
+
+import mock
+
+from press.helpers import mdadm
+
+
+@mock.patch('press.helpers.mdadm.find_in_path', return_value=True)
+@mock.patch('press.helpers.mdadm.run', return_value=0)
+class TestMDADM(unittest.TestCase):
+
+    def test_create(self, run, _):
+        mdadm.MDADM().create('/dev/md0', 1, ['/dev/sda1', '/dev/sdb1'],
+                             assume_clean=True, bitmap='internal')
+        command = run.call_args[0][0]
+        assert command == (
+            'mdadm -C --level=1 /dev/md0 --metadata=1.2 --raid-devices=2 '
+            '--name=md0 --assume-clean --bitmap=internal '
+            '/dev/sda1 /dev/sdb1')
+
+    def test_create_chunk(self, run, _):
+        mdadm.MDADM().create('/dev/md0', 5, ['/dev/sda1', '/dev/sdb1',
+                                             '/dev/sdc1'], chunk=65536)
+        assert '--chunk=64K /dev/sda1' in run.call_args[0][0]
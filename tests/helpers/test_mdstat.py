@@ -0,0 +1,71 @@
+import unittest
+
+import mock
+import pytest
+
+from press.helpers import mdstat
+
+MDSTAT = '''Personalities : [raid1] [raid6] [raid5] [raid4] [raid0]
+md2 : active raid5 sde1[3] sdd1[1] sdc1[0]
+      2093056 blocks super 1.2 level 5, 512k chunk, algorithm 2 [3/2] [UU_]
+      [==>..................]  recovery = 12.6% (132480/1046528) \
+finish=0.3min speed=44160K/sec
+
+md1 : active (auto-read-only) raid1 sdb2[1] sda2[0]
+      1048512 blocks super 1.2 [2/2] [UU]
+        resync=PENDING
+
+md0 : active raid0 sdb1[1] sda1[0](F)
+      2095104 blocks super 1.2 512k chunks
+
+md127 : inactive sdf[0](S)
+      1048576 blocks super 1.2
+
+unused devices: <none>
+'''
+
+
+class TestMDStat(unittest.TestCase):
+
+    def test_parse(self):
+        arrays = mdstat.parse_mdstat(MDSTAT)
+        assert list(arrays) == ['md2', 'md1', 'md0', 'md127']
+
+        md2 = arrays['md2']
+        assert md2.level == 'raid5'
+        assert [m.name for m in md2.members] == ['sde1', 'sdd1', 'sdc1']
+        assert (md2.raid_disks, md2.active_disks, md2.status) == (3, 2,
+                                                                  'UU_')
+        assert (md2.sync_action, md2.progress) == ('recovery', 12.6)
+
+        assert arrays['md1'].read_only
+        assert arrays['md1'].sync_action == 'resync'
+        assert arrays['md1'].progress is None
+
+        assert arrays['md0'].blocks == 2095104
+        assert arrays['md0'].failed
+
+        md127 = arrays['md127']
+        assert not md127.active and md127.level is None
+        assert md127.members[0].spare
+
+    @mock.patch('press.helpers.mdstat.os.path.exists', return_value=True)
+    @mock.patch('press.helpers.mdstat.get_array')
+    def test_wait_for_array(self, get_array, _):
+        creating = mdstat.MDArray('md1', active=True)
+        ready = mdstat.MDArray('md1', active=True)
+        ready.array_state = 'clean'
+        get_array.side_effect = [None, creating, ready]
+        assert mdstat.wait_for_array('/dev/md1', poll_interval=0) is ready
+
+        broken = mdstat.MDArray('md1', active=True)
+        broken.array_state = 'broken'
+        get_array.side_effect = None
+        get_array.return_value = broken
+        with pytest.raises(mdstat.MDStatException):
+            mdstat.wait_for_array('/dev/md1', poll_interval=0)
+
+    @mock.patch('press.helpers.mdstat.get_array', return_value=None)
+    def test_wait_for_array_timeout(self, _):
+        with pytest.raises(mdstat.MDStatException):
+            mdstat.wait_for_array('/dev/md1', timeout=0, poll_interval=0)
@@ -0,0 +1,90 @@
+import unittest
+
+import mock
+import pytest
+
+from press.helpers.cli import AttributeString
+from press.helpers import parted
+
+HEADER = '''Model: ATA QEMU HARDDISK (scsi)
+Disk /dev/sda: 10737418240B
+Sector size (logical/physical): 512B/512B
+Partition Table: %s
+Disk Flags:
+
+Number  Start  End  Size  File system  Name  Flags
+'''
+
+
+def table(label, partitions=()):
+    lines = [HEADER % label]
+    for number, start, end in partitions:
+        lines.append(' %d  %dB  %dB  %dB  name\n' % (number, start, end,
+                                                   end - start + 1))
+    result = AttributeString(''.join(lines))
+    result.returncode = 0
+    return result
+
+
+class TestPartedInterface(unittest.TestCase):
+
+    def setUp(self):
+        patches = [
+            mock.patch('press.helpers.parted.find_in_path'),
+            mock.patch('press.helpers.parted.UDevHelper'),
+            mock.patch('press.helpers.parted.AlignmentInfo'),
+            mock.patch('press.helpers.parted.run'),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.table = table('unknown')
+        self.run = parted.run
+        self.run.side_effect = self.parted
+
+    def parted(self, command, **kwargs):
+        if command.endswith(' print'):
+            return self.table
+        result = AttributeString('')
+        result.returncode = 0
+        return result
+
+    def test_table_is_cached(self):
+        interface = parted.PartedInterface('/dev/sda')
+        interface.get_size()
+        interface.get_label()
+        interface.last_partition
+        assert self.run.call_count == 1
+
+        interface.set_flag(1, 'boot')
+        interface.get_label()
+        assert self.run.call_count == 3
+
+    def test_batch(self):
+        interface = parted.PartedInterface('/dev/sda')
+        interface.begin_batch()
+        interface.set_label('gpt')
+        assert interface.create_partition('boot', 1048576,
+                                          flags=['boot']) == 1
+        assert interface.create_partition('root', 1048576) == 2
+        assert self.run.call_count == 1
+
+        self.table = table('gpt', [(1, 1048576, 2097663),
+                                   (2, 3145728, 4194815)])
+        interface.commit()
+        commands = self.run.call_args_list[1][0][0]
+        assert 'mklabel gpt mkpart unused 1048576 2097152 name 1' in commands
+        assert 'set 1 boot on mkpart unused 3145728 4194304' in commands
+        assert self.run.call_count == 3
+
+    def test_batch_mismatch(self):
+        interface = parted.PartedInterface('/dev/sda')
+        interface.begin_batch()
+        interface.set_label('gpt')
+        interface.create_partition('boot', 1048576)
+        interface.create_partition('root', 1048576)
+
+        self.table = table('gpt', [(1, 1048576, 2097663),
+                                   (2, 2097664, 3146239)])
+        with pytest.raises(parted.PartedException):
+            interface.commit()
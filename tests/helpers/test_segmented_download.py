@@ -0,0 +1,156 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+import pytest
+import requests
+
+from press.helpers.imagefile import ImageFile
+from press.helpers.segmented_download import (SegmentedDownload,
+                                              SegmentedDownloadException)
+from tests.helpers.fake_http import FakeResponse
+
+URL = 'http://images.example.com/image.tar.gz'
+BODY = os.urandom(10000)
+
+
+class FakeServer(object):
+    """Serves BODY, the first segment is answered last so that segments
+    complete out of order
+    """
+
+    def __init__(self, body=BODY, ranges=True, short=False, fail=None):
+        self.body = body
+        self.ranges = ranges
+        self.short = short
+        self.fail = fail
+        self.requested = list()
+        self._lock = threading.Lock()
+
+    def head(self, url, **kwargs):
+        headers = {'content-length': str(len(self.body))}
+        if self.ranges:
+            headers['accept-ranges'] = 'bytes'
+        return FakeResponse(b'', headers=headers)
+
+    def get(self, url, headers=None, **kwargs):
+        if not headers:
+            return FakeResponse(self.body)
+        start, end = [
+            int(offset)
+            for offset in headers['Range'][len('bytes='):].split('-')
+        ]
+        with self._lock:
+            self.requested.append(start)
+        if start == self.fail:
+            return FakeResponse(b'', status_code=404)
+        if start == 0:
+            time.sleep(0.1)
+        data = self.body[start:end + 1]
+        if self.short and start == 0:
+            data = data[:-1]
+        return FakeResponse(data, status_code=206)
+
+
+class TestSegmentedDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp, 'image.tar.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def download(self, server, **kwargs):
+        patches = [
+            mock.patch('press.helpers.segmented_download.requests.get',
+                       side_effect=server.get),
+            mock.patch('press.helpers.segmented_download.requests.head',
+                       side_effect=server.head),
+        ]
+        for patch in patches:
+            self.addCleanup(patch.stop)
+            patch.start()
+        hash_object = hashlib.sha256()
+        SegmentedDownload(URL, self.filename, len(server.body),
+                          connections=4, segment_size=1024,
+                          buffer_size=100, hash_object=hash_object,
+                          **kwargs).run()
+        return hash_object
+
+    def test_probe(self):
+        server = FakeServer()
+        with mock.patch('press.helpers.segmented_download.requests.head',
+                        side_effect=server.head):
+            assert SegmentedDownload.probe(URL) == len(BODY)
+            server.ranges = False
+            assert SegmentedDownload.probe(URL) is None
+        with mock.patch('press.helpers.segmented_download.requests.head',
+                        side_effect=requests.exceptions.ConnectionError):
+            assert SegmentedDownload.probe(URL) is None
+
+    @pytest.mark.skipif(not SegmentedDownload.supported(),
+                        reason='requires pwrite')
+    def test_run(self):
+        server = FakeServer()
+        hash_object = self.download(server)
+        assert sorted(server.requested) == list(range(0, len(BODY), 1024))
+        with open(self.filename, 'rb') as fp:
+            assert fp.read() == BODY
+        # hashed in file order, whatever order the segments completed in
+        assert hash_object.hexdigest() == hashlib.sha256(BODY).hexdigest()
+
+    @pytest.mark.skipif(not SegmentedDownload.supported(),
+                        reason='requires pwrite')
+    def test_short_read(self):
+        with pytest.raises(SegmentedDownloadException):
+            self.download(FakeServer(short=True))
+
+    @pytest.mark.skipif(not SegmentedDownload.supported(),
+                        reason='requires pwrite')
+    def test_worker_error(self):
+        with pytest.raises(requests.exceptions.HTTPError):
+            self.download(FakeServer(fail=4096))
+
+    def test_fallback(self):
+        server = FakeServer(ranges=False)
+        image_file = ImageFile(URL, self.tmp, hash_method='sha256',
+                               expected_hash=hashlib.sha256(BODY).hexdigest(),
+                               connections=4)
+        with mock.patch('press.helpers.segmented_download.requests.head',
+                        side_effect=server.head), \
+                mock.patch('press.helpers.imagefile.requests.get',
+                           side_effect=server.get), \
+                mock.patch('press.helpers.segmented_download.SegmentedDownload'
+                           '.run') as run:
+            image_file.download(None)
+        assert not run.called
+        with open(image_file.full_filename, 'rb') as fp:
+            assert fp.read() == BODY
+        assert image_file.validate()
+
+    def test_probe_timeout(self):
+        server = FakeServer()
+        image_file = ImageFile(URL, self.tmp, hash_method='sha256',
+                               expected_hash=hashlib.sha256(BODY).hexdigest(),
+                               connections=4, timeout=5)
+        with mock.patch('press.helpers.segmented_download.requests.head',
+                        side_effect=requests.exceptions.ReadTimeout) as head, \
+                mock.patch('press.helpers.imagefile.requests.get',
+                           side_effect=server.get), \
+                mock.patch('press.helpers.segmented_download.SegmentedDownload'
+                           '.run') as run, \
+                mock.patch('press.helpers.segmented_download.SegmentedDownload'
+                           '.supported', return_value=True):
+            image_file.download(None)
+        assert head.call_args[1]['timeout'] == 5
+        # a single stream instead
+        assert not run.called
+        with open(image_file.full_filename, 'rb') as fp:
+            assert fp.read() == BODY
+        assert image_file.validate()
@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from press.helpers import sysfs_info
+
+
+class TestBlockDeviceInfo(unittest.TestCase):
+
+    def setUp(self):
+        self.sysfs = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.sysfs)
+        fd, self.device = tempfile.mkstemp()
+        os.ftruncate(fd, 1048576)
+        os.close(fd)
+        self.addCleanup(os.unlink, self.device)
+        self.write_attributes({
+            'size': 2048,
+            'alignment_offset': 0,
+            'queue/logical_block_size': 512,
+            'queue/physical_block_size': 4096,
+            'queue/rotational': 0,
+            'queue/minimum_io_size': 65536,
+            'queue/optimal_io_size': 131072
+        })
+
+    def write_attributes(self, attributes):
+        os.mkdir(os.path.join(self.sysfs, 'queue'))
+        for path, value in attributes.items():
+            with open(os.path.join(self.sysfs, path), 'w') as fp:
+                fp.write('%d\n' % value)
+
+    def info(self):
+        with mock.patch('press.helpers.sysfs_info.append_sys',
+                        return_value=self.sysfs):
+            return sysfs_info.BlockDeviceInfo(self.device)
+
+    def write_device(self, offset, data):
+        with open(self.device, 'r+b') as fp:
+            fp.seek(offset)
+            fp.write(data)
+
+    def test_sysfs(self):
+        info = self.info()
+        assert info.size == 1048576
+        assert (info.logical_block_size, info.physical_block_size) == (512,
+                                                                       4096)
+        assert info.rotational is False
+        assert (info.minimum_io_size, info.optimal_io_size) == (65536,
+                                                                131072)
+        assert info.label is None
+
+    def test_label(self):
+        self.write_device(510, sysfs_info.MBR_SIGNATURE)
+        assert self.info().label == 'msdos'
+        self.write_device(512, sysfs_info.GPT_SIGNATURE)
+        assert self.info().label == 'gpt'
@@ -0,0 +1,51 @@
+import unittest
+
+import mock
+import pytest
+
+from press.exceptions import PhysicalDiskException
+from press.helpers.udev import UDevHelper
+
+
+@mock.patch('press.helpers.udev.run')
+@mock.patch('press.helpers.udev.time.time')
+@mock.patch('press.helpers.udev.UDevHelper.find_partition_in_sysfs')
+class TestWaitForPartition(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = 0.0
+        self.monitor = mock.Mock()
+        self.monitor.poll.side_effect = self.poll
+
+    def poll(self, timeout):
+        # nothing happens until the poll times out
+        self.clock += timeout
+
+    def wait(self, find_partition_in_sysfs, time, **kwargs):
+        time.side_effect = lambda: self.clock
+        return UDevHelper.__new__(UDevHelper).wait_for_partition(
+            self.monitor, '/dev/sda', 2, poll_interval=0.5, **kwargs)
+
+    def test_sysfs(self, find_partition_in_sysfs, time, run):
+        find_partition_in_sysfs.side_effect = [None, None, '/dev/sda2']
+        assert self.wait(find_partition_in_sysfs, time) == '/dev/sda2'
+        find_partition_in_sysfs.assert_called_with('/dev/sda', 2)
+        assert [call[1]['timeout'] for call in
+                self.monitor.poll.call_args_list] == [0.5, 0.5]
+        assert not run.called
+
+    def test_partx(self, find_partition_in_sysfs, time, run):
+        find_partition_in_sysfs.side_effect = \
+            lambda disk, partition_id: run.called and '/dev/sda2' or None
+        assert self.wait(find_partition_in_sysfs, time,
+                         timeout=4) == '/dev/sda2'
+        # half way through the timeout
+        run.assert_called_once_with('partx -a --nr 2 /dev/sda')
+        assert self.clock == 2.5
+
+    def test_timeout(self, find_partition_in_sysfs, time, run):
+        find_partition_in_sysfs.return_value = None
+        with pytest.raises(PhysicalDiskException):
+            self.wait(find_partition_in_sysfs, time, timeout=2)
+        assert run.call_count == 1
+        assert self.clock == 2
@@ -0,0 +1,32 @@
+import threading
+import unittest
+
+import pytest
+
+from press.helpers.workers import run_parallel
+
+
+class TestRunParallel(unittest.TestCase):
+
+    def test_results_in_order(self):
+        threads = set()
+
+        def double(value):
+            threads.add(threading.current_thread().name)
+            return value * 2
+
+        assert run_parallel(double, range(10), max_workers=3) == \
+            [value * 2 for value in range(10)]
+        assert len(threads) <= 3
+
+    def test_error_is_raised(self):
+        started = list()
+
+        def fail(value):
+            started.append(value)
+            if value == 0:
+                raise ValueError('disk %d' % value)
+
+        with pytest.raises(ValueError):
+            run_parallel(fail, range(100), max_workers=1)
+        assert started == [0]
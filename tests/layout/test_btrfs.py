@@ -0,0 +1,50 @@
+import unittest
+
+import mock
+
+from press.layout.filesystems.btrfs import Btrfs
+
+
+@mock.patch('press.layout.filesystems.FileSystem.locate_command',
+            return_value='/sbin/mkfs.btrfs')
+@mock.patch('press.layout.filesystems.btrfs.os.rmdir')
+@mock.patch('press.layout.filesystems.btrfs.tempfile.mkdtemp',
+            return_value='/tmp/press-btrfs-x')
+@mock.patch('press.layout.filesystems.btrfs.run')
+class TestBtrfs(unittest.TestCase):
+
+    def test_create(self, run, *_):
+        run.return_value.returncode = 0
+        file_system = Btrfs(label='root', data_profile='raid1',
+                            metadata_profile='raid1',
+                            subvolumes=[dict(name='@', mount_point='/'),
+                                        dict(name='@home',
+                                             mount_point='/home')])
+        file_system.devices = [mock.Mock(devname='/dev/sdb2')]
+        file_system.create('/dev/sda2')
+
+        commands = [call[0][0] for call in run.call_args_list]
+        assert commands[0] == (
+            '/sbin/mkfs.btrfs -f -U %s -L root -d raid1 -m raid1 '
+            '/dev/sda2 /dev/sdb2' % file_system.fs_uuid)
+        assert commands[1:] == [
+            'mount -t btrfs /dev/sda2 /tmp/press-btrfs-x',
+            'btrfs subvolume create /tmp/press-btrfs-x/@',
+            'btrfs subvolume set-default /tmp/press-btrfs-x/@',
+            'btrfs subvolume create /tmp/press-btrfs-x/@home',
+            'umount /tmp/press-btrfs-x'
+        ]
+
+        home = file_system.subvolumes[1]
+        assert home.devname == '/dev/sda2'
+        entry = home.generate_fstab_entry().splitlines()[1].split()
+        assert entry == ['UUID=%s' % file_system.fs_uuid, '/home', 'btrfs',
+                         'noatime,space_cache=v2,compress=zstd,subvol=@home',
+                         '0', '0']
+        assert file_system.install_mount_options == ['compress=zstd']
+
+    def test_no_compression(self, *_):
+        file_system = Btrfs(compression='none')
+        assert file_system.generate_mount_options() == \
+            'noatime,space_cache=v2'
+        assert file_system.install_mount_options == []
@@ -0,0 +1,37 @@
+import unittest
+
+import pytest
+
+from press.exceptions import PartitionValidationError
+from press.layout.disk import Disk
+
+MiB = 1048576
+GiB = 1024 * MiB
+
+
+class TestDiskAlignment(unittest.TestCase):
+
+    def test_raid_stripe(self):
+        # three data disks with a 256KiB chunk
+        disk = Disk('/dev/sda', size=10 * GiB, physical_sector_size=4096,
+                    minimum_io_size=256 * 1024, optimal_io_size=768 * 1024)
+        disk.new_partition_table('gpt', 'auto', 'auto')
+        assert disk.partition_table.partition_start.bytes == 3 * MiB
+        assert disk.partition_table.alignment.bytes == 3 * MiB
+
+    def test_bogus_optimal_io_size(self):
+        disk = Disk('/dev/sda', size=10 * GiB, physical_sector_size=4096,
+                    optimal_io_size=33553920)
+        assert disk.topology_alignment() == MiB
+
+    def test_alignment_offset(self):
+        disk = Disk('/dev/sda', size=10 * GiB, physical_sector_size=4096,
+                    alignment_offset=3584)
+        disk.new_partition_table('msdos', 'auto', 'auto')
+        assert disk.partition_table.partition_start.bytes == MiB + 3584
+        assert disk.partition_table.alignment_offset == 3584
+
+    def test_logical_sector(self):
+        disk = Disk('/dev/sda', size=10 * GiB, sector_size=4096)
+        with pytest.raises(PartitionValidationError):
+            disk.new_partition_table('gpt', MiB, MiB + 512)
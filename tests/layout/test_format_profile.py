@@ -0,0 +1,50 @@
+import unittest
+
+import mock
+
+from press.layout.filesystems.extended import EXT4
+from press.layout.filesystems.xfs import XFS
+
+
+@mock.patch('press.layout.filesystems.FileSystem.locate_command',
+            return_value='/sbin/mkfs')
+class TestFormatProfile(unittest.TestCase):
+
+    @staticmethod
+    def command(file_system, run):
+        run.return_value.returncode = 0
+        file_system.create('/dev/sdb1')
+        return run.call_args[0][0]
+
+    @mock.patch('press.layout.filesystems.extended.run')
+    def test_ext4(self, run, _):
+        file_system = EXT4(workload='large_files')
+        file_system.set_format_profile(fast_format=True, discarded=True)
+        file_system.set_stripe_geometry(262144, 4)
+        command = self.command(file_system, run)
+        assert ' -i 1048576' in command
+        assert ' -E stride=64,stripe_width=256,lazy_itable_init=1,' \
+               'lazy_journal_init=1,nodiscard' in command
+
+        # the file system options take precedence
+        file_system = EXT4(fast_format=True, discarded=False)
+        file_system.set_format_profile(fast_format=False, discarded=True)
+        command = self.command(file_system, run)
+        assert 'lazy_journal_init=1' in command
+        assert 'nodiscard' not in command
+        assert ' -i ' not in command
+
+    @mock.patch('press.layout.filesystems.xfs.run')
+    def test_xfs(self, run, _):
+        file_system = XFS(fast_format=True, workload='huge_files')
+        file_system.set_format_profile(discarded=True)
+        command = self.command(file_system, run)
+        assert ' -K ' in command
+        assert '-i maxpct=1' in command
+
+        file_system = XFS(
+            features={'inode_options': [{'maxpct': 10}]}, workload='huge_files')
+        file_system.set_format_profile()
+        command = self.command(file_system, run)
+        assert ' -K ' not in command
+        assert '-i maxpct=10' in command
@@ -0,0 +1,117 @@
+import unittest
+
+import mock
+import pytest
+
+from size import PercentString
+
+from press.exceptions import LVMValidationError
+from press.helpers.lvm import LVM
+from press.layout.layout import Layout
+from press.layout.lvm import (CachePool, LogicalVolume, PhysicalVolume,
+                              ThinPool, VolumeGroup)
+
+GiB = 1073741824
+PE = 4194304
+
+
+def volume_group(count=4, size=100 * GiB):
+    pvs = [PhysicalVolume(mock.Mock(size=mock.Mock(bytes=size)))
+           for _ in range(count)]
+    return VolumeGroup('vg', pvs, PE)
+
+
+class TestVolumeGroup(unittest.TestCase):
+
+    def test_striped(self):
+        vg = volume_group()
+        lv = LogicalVolume('data', PercentString('100%FREE'), stripes=4,
+                           stripe_size=262144)
+        vg.add_logical_volume(lv)
+        assert lv.extents % 4 == 0
+        assert lv.extents <= vg.extents
+        assert lv.stripe_geometry == (262144, 4)
+
+        with pytest.raises(LVMValidationError):
+            volume_group().add_logical_volume(
+                LogicalVolume('data', 10 * GiB, stripes=5))
+
+    def test_thin_pool(self):
+        vg = volume_group()
+        pool = ThinPool('pool', PercentString('100%FREE'))
+        vg.add_logical_volume(pool)
+        # metadata and its spare fit next to the pool
+        assert pool.metadata_size.bytes == 400 * GiB // 1024
+        assert (pool.extents * PE + pool.metadata_allocation.bytes) <= \
+            vg.size.bytes
+
+        home = LogicalVolume('home', PercentString('50%'), pool_name='pool')
+        scratch = LogicalVolume('scratch', 1024 * GiB, pool_name='pool')
+        vg.add_logical_volumes([home, scratch])
+        assert home.pool is pool
+        assert home.size.bytes == pool.size.bytes // 2 // PE * PE
+        assert vg.free_space.bytes < PE
+
+    def test_thin_volume_without_pool(self):
+        with pytest.raises(LVMValidationError):
+            volume_group().add_logical_volume(
+                LogicalVolume('home', 10 * GiB, pool_name='pool'))
+
+    def test_cache_pool(self):
+        vg = volume_group()
+        ssd = vg.physical_volumes[:1]
+        cache = CachePool(PercentString('100%FREE'), ssd, mode='writeback')
+        lv = LogicalVolume('data', PercentString('100%FREE'),
+                           physical_volumes=vg.physical_volumes[1:],
+                           cache=cache)
+        vg.add_logical_volume(lv)
+        assert cache.name == 'data_cache'
+        # 100GiB in at most a million chunks
+        assert cache.chunk_size == 131072
+        assert cache.metadata_size.bytes == 76 * 1048576
+        assert cache.size.bytes == 100 * GiB - cache.metadata_size.bytes
+        assert (lv.extents + cache.extents) * PE + \
+            2 * cache.metadata_size.bytes <= vg.size.bytes
+
+        with pytest.raises(LVMValidationError):
+            CachePool(GiB, ssd, mode='writearound')
+
+    def test_cache_pool_physical_volumes(self):
+        vg = volume_group()
+        ssd = vg.physical_volumes[:1]
+        lv = LogicalVolume('data', 10 * GiB,
+                           cache=CachePool(GiB, ssd))
+        vg.add_logical_volume(lv)
+        assert lv.physical_volumes == vg.physical_volumes[1:]
+
+        with pytest.raises(LVMValidationError):
+            volume_group().add_logical_volume(
+                LogicalVolume('data', 10 * GiB,
+                              physical_volumes=vg.physical_volumes[:2],
+                              cache=CachePool(GiB, ssd)))
+
+
+@mock.patch('press.helpers.lvm.run')
+class TestCreateLogicalVolume(unittest.TestCase):
+
+    def test_cached_origin(self, run):
+        run.return_value.returncode = 0
+        pvs = [PhysicalVolume(mock.Mock(devname=devname,
+                                        size=mock.Mock(bytes=100 * GiB)))
+               for devname in ('/dev/sda2', '/dev/sdb1', '/dev/nvme0n1p1')]
+        vg = VolumeGroup('vg', pvs, PE)
+        lv = LogicalVolume('data', PercentString('100%FREE'),
+                           cache=CachePool(PercentString('50%'), pvs[2:]))
+        vg.add_logical_volume(lv)
+        # sized on the two hard drives only
+        assert lv.extents * PE <= 200 * GiB
+
+        layout = Layout.__new__(Layout)
+        layout.lvm = LVM()
+        layout.create_logical_volume(vg, lv)
+        commands = [call[0][0] for call in run.call_args_list]
+        assert commands[0].startswith('lvcreate --yes --extents %d -n data '
+                                      % lv.extents)
+        assert commands[0].endswith(' vg /dev/sda2 /dev/sdb1')
+        assert commands[1].endswith(' vg /dev/nvme0n1p1')
+        assert commands[2].startswith('lvconvert --yes --type cache')
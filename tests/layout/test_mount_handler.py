@@ -0,0 +1,80 @@
+import unittest
+
+import mock
+
+from press.helpers.cli import CLIException
+from press.layout.filesystems.extended import EXT4
+from press.layout.filesystems.xfs import XFS
+from press.layout.layout import MountHandler
+
+
+@mock.patch('press.layout.filesystems.FileSystem.locate_command',
+            return_value='/sbin/mkfs')
+@mock.patch('press.layout.layout.MountHandler.create_directory')
+@mock.patch('press.layout.layout.run')
+class TestMountHandler(unittest.TestCase):
+
+    @staticmethod
+    def mount_handler(root, var):
+        volumes = {
+            '/': mock.Mock(devname='/dev/sda2', file_system=root,
+                           spec=['devname', 'file_system']),
+            '/var': mock.Mock(devname='/dev/sda3', file_system=var,
+                              spec=['devname', 'file_system']),
+        }
+        layout = mock.Mock(committed=True, mount_point_index=volumes)
+        return MountHandler('/mnt/press', layout)
+
+    def test_remount(self, run, *_):
+        root = EXT4(install_mount_profile='fast')
+        var = XFS(install_mount_options=['noatime'])
+        handler = self.mount_handler(root, var)
+        handler.mount_physical()
+        handler.remount_physical()
+
+        commands = [call[0][0] for call in run.call_args_list]
+        assert commands == [
+            'mount -o data=writeback,nobarrier,commit=60,noatime /dev/sda2 '
+            '/mnt/press/',
+            'mount -o noatime /dev/sda3 /mnt/press/var',
+            'umount /mnt/press/var',
+            'umount /mnt/press/',
+            'mount -o defaults /dev/sda2 /mnt/press/',
+            'mount -o defaults,inode64 /dev/sda3 /mnt/press/var',
+        ]
+        assert all(mp['mounted'] for mp in handler.mount_points.values())
+
+    def test_remount_changed_only(self, run, *_):
+        handler = self.mount_handler(EXT4(), XFS(install_mount_profile='fast'))
+        handler.mount_physical()
+        handler.remount_physical()
+        assert [call[0][0] for call in run.call_args_list] == [
+            'mount /dev/sda2 /mnt/press/',
+            'mount -o logbufs=8,logbsize=256k,noatime /dev/sda3 '
+            '/mnt/press/var',
+            'umount /mnt/press/var',
+            'mount -o defaults,inode64 /dev/sda3 /mnt/press/var',
+        ]
+
+    def test_remount_fallback(self, run, *_):
+        def fail_final(command, **_):
+            if command.startswith('mount -o defaults'):
+                raise CLIException('invalid argument')
+        run.side_effect = fail_final
+        handler = self.mount_handler(EXT4(), XFS(install_mount_profile='fast'))
+        handler.mount_physical()
+        handler.remount_physical()
+        assert [call[0][0] for call in run.call_args_list][-2:] == [
+            'mount -o defaults,inode64 /dev/sda3 /mnt/press/var',
+            'mount /dev/sda3 /mnt/press/var',
+        ]
+        assert handler.mount_points['/var']['mounted']
+
+    def test_default_profile(self, run, *_):
+        handler = self.mount_handler(EXT4(), XFS())
+        handler.mount_physical()
+        handler.remount_physical()
+        assert [call[0][0] for call in run.call_args_list] == [
+            'mount /dev/sda2 /mnt/press/',
+            'mount /dev/sda3 /mnt/press/var',
+        ]
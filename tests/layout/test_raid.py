@@ -0,0 +1,57 @@
+import unittest
+
+import mock
+import pytest
+
+from press.exceptions import PressCriticalException
+from press.layout.disk import Partition
+from press.layout.raid import MDRaid, metadata_reserve
+
+GiB = 1073741824
+
+
+def partitions(count, size=100 * GiB):
+    members = list()
+    for index in range(count):
+        partition = Partition('raid%d' % index, size)
+        partition.allocated = True
+        partition.devname = '/dev/sd%s1' % 'abcdefgh'[index]
+        members.append(partition)
+    return members
+
+
+@mock.patch('press.layout.raid.MDADM')
+class TestMDRaidSize(unittest.TestCase):
+
+    # usable space on each 100GiB member
+    member = 100 * GiB - metadata_reserve(100 * GiB)
+
+    def size(self, level, count, **kwargs):
+        raid = MDRaid('/dev/md0', level, partitions(count), **kwargs)
+        raid.calculate_size()
+        return raid.size.bytes
+
+    def test_levels(self, _):
+        assert self.size(1, 2) == self.member
+        assert self.size('raid5', 4) == 3 * self.member
+        assert self.size(6, 6) == 4 * self.member
+        assert self.size(10, 4) == 2 * self.member
+        assert self.size(10, 6, layout='f3') == 2 * self.member
+
+    def test_members(self, _):
+        with pytest.raises(PressCriticalException):
+            self.size(6, 3)
+        with pytest.raises(PressCriticalException):
+            self.size(10, 2, layout='n3')
+        with pytest.raises(ValueError):
+            self.size(7, 3)
+
+    def test_create_with_spares(self, mdadm):
+        members = partitions(5)
+        raid = MDRaid('/dev/md0', 5, members[:4], spare_members=members[4:],
+                      layout='left-symmetric')
+        raid.create()
+        args, kwargs = mdadm.return_value.create.call_args
+        assert args == ('/dev/md0', 5, [m.devname for m in members[:4]])
+        assert kwargs['spares'] == ['/dev/sde1']
+        assert kwargs['layout'] == 'left-symmetric'
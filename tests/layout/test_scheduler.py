@@ -0,0 +1,62 @@
+import threading
+import time
+import unittest
+
+import pytest
+
+from press.layout.scheduler import Scheduler
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_dependencies(self):
+        order = list()
+        lock = threading.Lock()
+
+        def record(name, delay=0):
+            time.sleep(delay)
+            with lock:
+                order.append(name)
+
+        scheduler = Scheduler()
+        disk = scheduler.add('partition', record, ('partition', ))
+        mkfs = scheduler.add('mkfs', record, ('mkfs', 0.1), [disk])
+        pv = scheduler.add('pvcreate', record, ('pvcreate', ), [disk])
+        scheduler.add('vgcreate', record, ('vgcreate', ), [pv])
+        scheduler.run()
+
+        assert order[0] == 'partition'
+        # mkfs does not hold back the volume group
+        assert order.index('vgcreate') < order.index('mkfs')
+        assert mkfs.dependencies == [disk]
+        assert mkfs.started >= disk.finished
+        assert all(op.duration is not None for op in scheduler.operations)
+
+    def test_max_workers(self):
+        running = list()
+        peak = list()
+
+        def work():
+            running.append(1)
+            peak.append(len(running))
+            time.sleep(0.05)
+            running.pop()
+
+        scheduler = Scheduler(max_workers=2)
+        for index in range(6):
+            scheduler.add('op %d' % index, work)
+        scheduler.run()
+        assert max(peak) <= 2
+
+    def test_failure(self):
+        ran = list()
+
+        def fail():
+            raise ValueError('mkfs failed')
+
+        scheduler = Scheduler()
+        first = scheduler.add('fail', fail)
+        scheduler.add('never', ran.append, (1, ), [first])
+        with pytest.raises(ValueError):
+            scheduler.run()
+        assert not ran
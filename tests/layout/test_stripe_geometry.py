@@ -0,0 +1,56 @@
+import unittest
+
+import mock
+
+from press.layout.filesystems.extended import EXT4
+from press.layout.filesystems.xfs import XFS
+from press.layout.raid import MDRaid
+
+KiB = 1024
+
+
+class TestStripeGeometry(unittest.TestCase):
+
+    def setUp(self):
+        patches = [
+            mock.patch('press.layout.filesystems.FileSystem.locate_command',
+                       return_value='/sbin/mkfs'),
+            mock.patch('press.layout.raid.MDADM'),
+        ]
+        for patch in patches:
+            self.addCleanup(patch.stop)
+            patch.start()
+
+    def command(self, file_system, run):
+        run.return_value.returncode = 0
+        file_system.create('/dev/md0')
+        return run.call_args[0][0]
+
+    def test_raid_levels(self):
+        members = [mock.Mock()] * 6
+        assert MDRaid('/dev/md0', 6, members).stripe_geometry == (512 * KiB,
+                                                                  4)
+        assert MDRaid('/dev/md0', 10, members,
+                      chunk_size=64 * KiB).stripe_geometry == (64 * KiB, 3)
+        assert MDRaid('/dev/md0', 1, members).stripe_geometry is None
+
+    @mock.patch('press.layout.filesystems.extended.run')
+    def test_ext4(self, run):
+        file_system = EXT4()
+        file_system.set_stripe_geometry(256 * KiB, 4)
+        assert '-E stride=64,stripe_width=256' in self.command(file_system,
+                                                               run)
+
+        file_system = EXT4(stride_size=16, stripe_width=32)
+        file_system.set_stripe_geometry(256 * KiB, 4)
+        assert '-E stride=16,stripe_width=32' in self.command(file_system,
+                                                              run)
+
+    @mock.patch('press.layout.filesystems.xfs.run')
+    def test_xfs(self, run):
+        file_system = XFS(features={'naming_options': [{'ftype': 1}]})
+        file_system.set_stripe_geometry(256 * KiB, 4)
+        command = self.command(file_system, run)
+        assert '-d su=262144,sw=4' in command or \
+            '-d sw=4,su=262144' in command
+        assert '-n ftype=1' in command
@@ -0,0 +1,54 @@
+import unittest
+
+import mock
+import pytest
+
+from press.press import PressOrchestrator
+
+
+@mock.patch('press.press.run_hooks')
+@mock.patch('press.press.deployment.recursive_makedir')
+@mock.patch('press.press.deployment.free_space', return_value=1000)
+class TestPrefetch(unittest.TestCase):
+
+    def orchestrator(self, size):
+        orchestrator = PressOrchestrator.__new__(PressOrchestrator)
+        orchestrator.press_configuration = {
+            'image': {
+                'url': 'http://images.example.com/image.tar.gz',
+                'prefetch': True,
+                'prefetch_directory': '/dev/shm/test'
+            }
+        }
+        orchestrator.imagefile = mock.Mock(cache_hit=False,
+                                           image_exists=False)
+        orchestrator.imagefile.remote_size.return_value = size
+        orchestrator.prefetch_thread = None
+        orchestrator.prefetch_error = None
+        return orchestrator
+
+    def test_fallback(self, *_):
+        # unknown size, or larger than the free space
+        for size in (None, 1001):
+            orchestrator = self.orchestrator(size)
+            orchestrator.start_prefetch()
+            assert orchestrator.prefetch_thread is None
+            assert not orchestrator.imagefile.set_download_directory.called
+            assert not orchestrator.imagefile.download.called
+
+    def test_prefetch(self, *_):
+        orchestrator = self.orchestrator(1000)
+        orchestrator.start_prefetch()
+        orchestrator.wait_for_prefetch()
+        orchestrator.imagefile.set_download_directory.assert_called_once_with(
+            '/dev/shm/test')
+        assert orchestrator.imagefile.download.called
+
+    def test_error(self, *_):
+        orchestrator = self.orchestrator(1000)
+        error = IOError('No space left on device')
+        orchestrator.imagefile.download.side_effect = error
+        orchestrator.start_prefetch()
+        with pytest.raises(IOError) as e:
+            orchestrator.wait_for_prefetch()
+        assert e.value is error